@@ -13,7 +13,7 @@ parser.add_argument("-i", "--inverter-id",
                     type=int, required=True)
 
 parser.add_argument("-d", "--device",
-                    help="RS485 device, e.g. /dev/ttyUSB0",
+                    help="RS485 device, e.g. /dev/ttyUSB0 or tcp://host:port for a RS485 to Ethernet gateway",
                     type=str, required=True)
 
 parser.add_argument("--show-data", help="show data", action="store_true")
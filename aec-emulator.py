@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+import argparse
+import time
+
+from devices import AEConversionInverter
+from devices.aeconversion_emulator import BusNoise, EmulatedInverter, PtyInverterEmulator
+
+parser = argparse.ArgumentParser(description="Emulates AEconversion inverters on a pseudo terminal")
+parser.add_argument("-i", "--inverter-id", help="ID of an emulated inverter, can be given multiple times",
+                    type=int, action="append")
+parser.add_argument("--pv-watt", help="PV power of the emulated inverters, default 300", type=float, default=300.0)
+parser.add_argument("--jitter", help="random delay of up to X seconds before a response", type=float, default=0.0)
+parser.add_argument("--drop-rate", help="share of responses with a missing byte, e.g. 0.05", type=float, default=0.0)
+parser.add_argument("--corrupt-rate", help="share of responses with a flipped bit, e.g. 0.05", type=float,
+                    default=0.0)
+parser.add_argument("--seed", help="seed for the noise, for repeatable runs", type=int)
+parser.add_argument("--bench", help="poll the emulated inverters for X seconds and show the results", type=int)
+parser.add_argument("--retry", help="request retries of the benchmark client, default 5", type=int, default=5)
+
+args = parser.parse_args()
+inverter_ids = args.inverter_id or [12345]
+
+emulator = PtyInverterEmulator(
+    inverters=[EmulatedInverter(inverter_id, pv_watt=args.pv_watt) for inverter_id in inverter_ids],
+    noise=BusNoise(jitter=args.jitter, drop_rate=args.drop_rate, corrupt_rate=args.corrupt_rate, seed=args.seed)
+)
+emulator.start()
+print('emulating inverters %s on %s' % (', '.join(map(str, inverter_ids)), emulator.port))
+
+if not args.bench:
+    try:
+        while True:
+            time.sleep(60)
+            print(emulator.get_stats())
+    except KeyboardInterrupt:
+        pass
+    emulator.stop()
+    exit()
+
+inverters = []
+for inverter_id in inverter_ids:
+    inverter = AEConversionInverter(device=emulator.port, inverter_id=inverter_id, request_retries=args.retry,
+                                    verbose=False)
+    if not inverter.connect():
+        exit(1)
+    inverters.append(inverter)
+
+polls = 0
+failed_polls = 0
+retried_polls = 0
+retry_time = 0.0
+recovery_times = []
+failing_since = None
+start = time.monotonic()
+while time.monotonic() - start < args.bench:
+    for inverter in inverters:
+        requests = inverter.request_count
+        poll_start = time.monotonic()
+        data = inverter.get_data()
+        duration = time.monotonic() - poll_start
+        polls += 1
+        attempts = inverter.request_count - requests
+        if attempts > 1:
+            retried_polls += 1
+            # everything except the last attempt is the price of the noise
+            retry_time += duration - (inverter.last_rtt or 0.0) if data else duration
+        if data is False:
+            failed_polls += 1
+            if failing_since is None:
+                failing_since = poll_start
+        elif failing_since is not None:
+            recovery_times.append(time.monotonic() - failing_since)
+            failing_since = None
+        elif attempts > 1:
+            recovery_times.append(duration)
+
+duration = time.monotonic() - start
+emulator.stop()
+
+print('polls:             %i in %0.1f seconds, %0.2f/s' % (polls, duration, polls / duration))
+print('failed polls:      %i' % failed_polls)
+print('retried polls:     %i, %0.2f seconds spent on retries' % (retried_polls, retry_time))
+if recovery_times:
+    print('recovery time:     avg %0.2f, max %0.2f seconds' % (sum(recovery_times) / len(recovery_times),
+                                                             max(recovery_times)))
+for inverter in inverters:
+    print('inverter %s:    %s' % (inverter.inverter_id, inverter.get_stats()))
+print('emulator:          %s' % emulator.get_stats())
@@ -0,0 +1,235 @@
+"""
+Micro benchmarks of the protocol decoders and the metrics path, run from the repository root:
+
+    python3 -m benchmarks.parsers [--save-baseline] [--tolerance 0.2] [--filter sma]
+
+Every decoder is checked against golden_results.json before it is timed. ns/op is the best of
+several repeats. blocks/op counts the memory blocks that are still allocated by the result of
+one operation, peak/op is the largest amount of temporary memory one operation needs.
+With a stored baseline.json the run fails if an operation got slower than the tolerance allows
+or keeps more blocks.
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+from influxdb.line_protocol import make_lines
+
+from devices.aeconversion_inverter import AEConversionInverter, state_codes
+from devices.rs485 import LoopbackTransport
+from devices.sma_energy_manager import SMAEnergyManager
+from devices.smart_bms import SmartBMS
+from devices.snapshot import InverterSnapshot
+from metrics import Metrics
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+FRAMES_FILE = os.path.join(BENCHMARK_DIR, 'golden_frames.json')
+RESULTS_FILE = os.path.join(BENCHMARK_DIR, 'golden_results.json')
+BASELINE_FILE = os.path.join(BENCHMARK_DIR, 'baseline.json')
+
+
+class FrameSocket:
+    def __init__(self, frame):
+        self.frame = frame
+
+    def recv_into(self, buffer):
+        buffer[:len(self.frame)] = self.frame
+        return len(self.frame)
+
+
+class NullClient:
+    """
+    Serializes points like InfluxDBClient.write_points, without sending them
+    """
+
+    def write_points(self, points, time_precision=None, database=None, protocol='json'):
+        make_lines({'points': points}, precision=time_precision)
+        return True
+
+
+class SerializingMetrics(Metrics):
+    def __init__(self):
+        self.client = NullClient()
+        self.database_name = 'benchmark'
+        self.spill_log = None
+
+
+def load_frames():
+    with open(FRAMES_FILE) as f:
+        return {name: bytes.fromhex(frame) for name, frame in json.load(f).items()}
+
+
+def get_benchmarks(frames):
+    logger = logging.getLogger('benchmark')
+    benchmarks = {}
+
+    em = SMAEnergyManager(logger=logger)
+    speedwire_block = frames['speedwire'][32:156]
+    benchmarks['sma_parse_block_bytes'] = lambda: em.parse_block_bytes(speedwire_block, counter=True)
+
+    em_sum = SMAEnergyManager(logger=logger)
+    em_sum.sock = FrameSocket(frames['speedwire'])
+    benchmarks['sma_read_sum'] = lambda: em_sum.read(phases=False)
+
+    em_phases = SMAEnergyManager(logger=logger)
+    em_phases.sock = FrameSocket(frames['speedwire'])
+    benchmarks['sma_read_phases_counter'] = lambda: em_phases.read(phases=True, counter=True)
+
+    em_frequency = SMAEnergyManager(logger=logger, channels=('p_import', 'p_export', 'frequency'))
+    em_frequency.sock = FrameSocket(frames['speedwire_frequency'])
+    benchmarks['sma_read_selected_channels'] = lambda: em_frequency.read(phases=False)
+
+    crc_payload = frames['aec_data'][1:-1]
+    benchmarks['aec_calc_crc'] = lambda: AEConversionInverter._calc_crc(crc_payload)
+
+    status_hex = frames['aec_status'].hex()[7:14]
+    benchmarks['aec_check_bits'] = lambda: AEConversionInverter._check_bits(status_hex, state_codes)
+
+    responses = {
+        b'\x03\xf6': frames['aec_device_parameters'] + b'\x0d',
+        b'\x03\xed': frames['aec_data'] + b'\x0d',
+    }
+    inverter = AEConversionInverter(device='loopback', inverter_id=123, verbose=False,
+                                    transport=LoopbackTransport(lambda request: responses[request[3:5]]))
+    inverter.connect()
+    benchmarks['aec_get_data'] = inverter.get_data
+
+    bms = SmartBMS(device=None, logger=logger)
+    benchmarks['bms_parse_status_response'] = lambda: bms.parse_status_response(frames['bms_status'])
+    benchmarks['bms_parse_cell_voltages'] = lambda: bms.parse_cell_voltages(frames['bms_cell_voltages'])
+
+    metrics = SerializingMetrics()
+    sample = inverter.get_data()
+
+    def write_metric():
+        snapshot = InverterSnapshot(1, sample['time'], sample)
+        point = snapshot.to_point("AEConversionInverterData", {
+            "inverter_id": 123,
+            "dev": 'loopback',
+        })
+        metrics.write_metric(points=[point])
+        return point
+
+    benchmarks['metrics_write_metric'] = write_metric
+    return benchmarks
+
+
+def normalize(result):
+    # drop receive times, json turns tuples into lists and int keys into strings
+    if isinstance(result, dict):
+        return {str(key): normalize(value) for key, value in result.items() if key != 'time'}
+    if isinstance(result, (list, tuple)):
+        return [normalize(value) for value in result]
+    return result
+
+
+def measure(operation, min_time=0.2, repeat=5):
+    # calibrate the number of iterations to run at least min_time per repeat
+    iterations = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            operation()
+        duration = time.perf_counter() - start
+        if duration >= min_time:
+            break
+        iterations *= 2
+
+    best = duration
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            operation()
+        best = min(best, time.perf_counter() - start)
+    ns_per_op = best / iterations * 1e9
+
+    gc.collect()
+    gc.disable()
+    results = []
+    blocks_before = sys.getallocatedblocks()
+    for _ in range(1000):
+        results.append(operation())
+    blocks = (sys.getallocatedblocks() - blocks_before) / 1000
+    del results
+    gc.enable()
+
+    tracemalloc.start()
+    operation()
+    tracemalloc.reset_peak()
+    current = tracemalloc.get_traced_memory()[0]
+    operation()
+    peak = tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+
+    return {'ns_per_op': ns_per_op, 'blocks_per_op': blocks, 'peak_bytes_per_op': peak}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--filter", help="only run benchmarks containing this string", type=str, default='')
+    parser.add_argument("--save-baseline", help="store the results as new baseline", action="store_true")
+    parser.add_argument("--update-golden", help="store the decoded golden frames as expected results",
+                        action="store_true")
+    parser.add_argument("--tolerance", help="allowed slowdown against the baseline, default 0.2 (20%%)",
+                        type=float, default=0.2)
+    parser.add_argument("--min-time", help="minimum seconds per repeat, default 0.2", type=float, default=0.2)
+    args = parser.parse_args()
+
+    benchmarks = get_benchmarks(load_frames())
+    benchmarks = {name: operation for name, operation in benchmarks.items() if args.filter in name}
+
+    decoded = {name: normalize(operation()) for name, operation in benchmarks.items()}
+    golden = {}
+    if os.path.exists(RESULTS_FILE):
+        with open(RESULTS_FILE) as f:
+            golden = json.load(f)
+    if args.update_golden:
+        golden.update(json.loads(json.dumps(decoded)))
+        with open(RESULTS_FILE, 'w') as f:
+            json.dump(golden, f, indent=2, sort_keys=True)
+
+    baseline = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)
+
+    failed = []
+    results = {}
+    print('%-30s %12s %10s %10s %10s' % ('benchmark', 'ns/op', 'baseline', 'blocks/op', 'peak/op'))
+    for name, operation in benchmarks.items():
+        if json.loads(json.dumps(decoded[name])) != golden.get(name):
+            print('%-30s decoded result differs from golden_results.json' % name)
+            failed.append(name)
+            continue
+        result = measure(operation, min_time=args.min_time)
+        results[name] = result
+        reference = baseline.get(name)
+        status = ''
+        if reference:
+            if result['ns_per_op'] > reference['ns_per_op'] * (1 + args.tolerance):
+                status = 'SLOWER'
+            elif result['blocks_per_op'] > reference['blocks_per_op'] + 0.5:
+                status = 'MORE BLOCKS'
+            if status:
+                failed.append(name)
+        print('%-30s %12.0f %10s %10.1f %10i %s' % (name, result['ns_per_op'],
+                                                   '%0.0f' % reference['ns_per_op'] if reference else '-',
+                                                   result['blocks_per_op'], result['peak_bytes_per_op'], status))
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('baseline saved')
+    elif failed:
+        print('regressions: %s' % ', '.join(failed))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
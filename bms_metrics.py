@@ -0,0 +1,154 @@
+import collections
+import functools
+
+# one point per cell with a cell tag (SmartBMSCellVoltages.voltage)
+TAGGED = 'tagged'
+# one point per pack with a field per cell and the statistics (SmartBMSCells.cell_01 ...)
+WIDE = 'wide'
+# both, while dashboards are moved to the wide schema
+BOTH = 'both'
+SCHEMAS = (TAGGED, WIDE, BOTH)
+
+TAGGED_MEASUREMENT = "SmartBMSCellVoltages"
+WIDE_MEASUREMENT = "SmartBMSCells"
+
+
+def cell_field(cell):
+    return 'cell_%02i' % int(cell)
+
+
+def cell_statistics(cell_voltages):
+    voltages = list(cell_voltages.values())
+    cell_min = min(voltages)
+    cell_max = max(voltages)
+    return {
+        'cell_min': cell_min,
+        'cell_max': cell_max,
+        'cell_delta': round(cell_max - cell_min, 3),
+        'cell_mean': round(sum(voltages) / len(voltages), 4),
+        'cell_count': len(voltages),
+    }
+
+
+def cell_voltage_points(mac_address, cell_voltages, ts, schema=TAGGED):
+    """
+    Points of one cell voltage sample, cell_voltages maps the cell number to its voltage
+    """
+    points = []
+    if not cell_voltages:
+        return points
+    if schema in (TAGGED, BOTH):
+        for cell, voltage in cell_voltages.items():
+            points.append({
+                "measurement": TAGGED_MEASUREMENT,
+                "tags": {
+                    "mac_address": mac_address,
+                    "cell": cell,
+                },
+                "time": ts,
+                "fields": {'voltage': voltage},
+            })
+    if schema in (WIDE, BOTH):
+        fields = {cell_field(cell): voltage for cell, voltage in cell_voltages.items()}
+        fields.update(cell_statistics(cell_voltages))
+        points.append({
+            "measurement": WIDE_MEASUREMENT,
+            "tags": {
+                "mac_address": mac_address,
+            },
+            "time": ts,
+            "fields": fields,
+        })
+    return points
+
+
+def get_cell_schema(bms_config):
+    schema = bms_config.get('cell_schema', TAGGED)
+    if schema not in SCHEMAS:
+        raise ValueError('unknown bms.cell_schema "%s", use one of %s' % (schema, ', '.join(SCHEMAS)))
+    return schema
+
+
+def get_cell_points(bms_config):
+    """
+    cell_points(mac_address, cell_voltages, ts) with the configured schema, for SmartBMSThread
+    """
+    return functools.partial(cell_voltage_points, schema=get_cell_schema(bms_config))
+
+
+def cell_voltages_query(cell_count, schema=TAGGED, mac_address=None, aggregate='mean',
+                        time_filter='$timeFilter', interval='$__interval'):
+    """
+    InfluxQL for a cell voltage panel, the wide query returns one column per cell named like the
+    series of the tagged query ("cell_1" ...), so a dashboard only needs the new query
+    """
+    where = [time_filter]
+    if mac_address:
+        where.insert(0, '"mac_address" = \'%s\'' % mac_address)
+    if schema == TAGGED:
+        return 'SELECT %s("voltage") FROM "%s" WHERE %s GROUP BY time(%s), "cell"' % (
+            aggregate, TAGGED_MEASUREMENT, ' AND '.join(where), interval)
+    columns = ', '.join('%s("%s") AS "cell_%i"' % (aggregate, cell_field(cell), cell)
+                        for cell in range(1, cell_count + 1))
+    return 'SELECT %s FROM "%s" WHERE %s GROUP BY time(%s)' % (columns, WIDE_MEASUREMENT, ' AND '.join(where),
+                                                             interval)
+
+
+def migrate_cell_voltages(client, start, end, chunk=3600, logger=None):
+    """
+    Copy tagged cell voltages between start and end (unix seconds) into the wide schema,
+    return the number of written points
+    """
+    written = 0
+    chunk_start = start
+    while chunk_start < end:
+        chunk_end = min(chunk_start + chunk, end)
+        result = client.query('SELECT "voltage" FROM "%s" WHERE time >= %is AND time < %is GROUP BY "mac_address", '
+                              '"cell"' % (TAGGED_MEASUREMENT, chunk_start, chunk_end), epoch='ms')
+        samples = collections.defaultdict(dict)
+        for (_, tags), rows in result.items():
+            for row in rows:
+                if row['voltage'] is not None:
+                    samples[(tags['mac_address'], row['time'])][int(tags['cell'])] = row['voltage']
+        points = []
+        for (mac_address, ts), cell_voltages in sorted(samples.items()):
+            points.extend(cell_voltage_points(mac_address, dict(sorted(cell_voltages.items())), ts, schema=WIDE))
+        if points:
+            client.write_points(points, time_precision='ms', batch_size=5000)
+            written += len(points)
+        if logger:
+            logger.info('%i-%i: %i samples' % (chunk_start, chunk_end, len(points)))
+        chunk_start = chunk_end
+    return written
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Cell voltage schema helpers")
+    subparsers = parser.add_subparsers(dest='action')
+    query_parser = subparsers.add_parser('query', help="show the panel query of a schema")
+    query_parser.add_argument("--cells", help="number of cells, default 16", type=int, default=16)
+    query_parser.add_argument("--schema", help="tagged or wide (default)", type=str, default=WIDE)
+    query_parser.add_argument("--mac-address", help="only this pack", type=str)
+    query_parser.add_argument("--aggregate", help="default mean", type=str, default='mean')
+    migrate_parser = subparsers.add_parser('migrate', help="copy tagged cell voltages into the wide schema")
+    migrate_parser.add_argument("--database", help="default esc", type=str, default='esc')
+    migrate_parser.add_argument("--days", help="copy the last X days, default 30", type=float, default=30)
+    args = parser.parse_args()
+
+    if args.action == 'query':
+        print(cell_voltages_query(args.cells, schema=args.schema, mac_address=args.mac_address,
+                                  aggregate=args.aggregate))
+    elif args.action == 'migrate':
+        from influxdb import InfluxDBClient
+        from logger import get_logger
+
+        client = InfluxDBClient('localhost', database=args.database, port=8086)
+        end = int(time.time())
+        count = migrate_cell_voltages(client, start=end - int(args.days * 86400), end=end,
+                                      logger=get_logger(level='info'))
+        print('%i points written to %s' % (count, WIDE_MEASUREMENT))
+    else:
+        parser.print_help()
@@ -1,19 +1,40 @@
 #!/usr/bin/python3
 
-from pyedimax.smartplug import SmartPlug
+import argparse
+import sys
 
 from config import config, tz
 from controller.charge_controller import ChargeController
+from controller.charge_levels import calibrate
+from devices.pwm import get_pwm
+from devices.smart_plug import EdimaxSmartPlug
 from logger import get_logger
-from metrics import Metrics
+from metrics import get_metrics
+
+parser = argparse.ArgumentParser(description="Controls the charger to consume the power that would be exported")
+parser.add_argument("--calibrate", help="measure the watt of each PWM volt and save them to charger.levels_file",
+                    action="store_true")
+parser.add_argument("--calibrate-step", help="volt between two measurements, default 0.1", type=float, default=0.1)
+parser.add_argument("--settle-time", help="seconds to wait after each change, default 20", type=int, default=20)
+args = parser.parse_args()
 
 logger = get_logger(level='info')
 
-smart_plug_auth = (config['charger']['smartplug_username'], config['charger']['smartplug_password'])
-smart_plug = SmartPlug(config['charger']['smartplug_ip'], smart_plug_auth)
+if args.calibrate:
+    levels_file = config['charger'].get('levels_file')
+    if not levels_file:
+        logger.error('charger.levels_file is not configured')
+        sys.exit(1)
+    smart_plug = EdimaxSmartPlug(config['charger']['smartplug_ip'],
+                                 (config['charger']['smartplug_username'], config['charger']['smartplug_password']))
+    levels = calibrate(get_pwm(config['charger'], logger=logger), smart_plug, logger, step=args.calibrate_step,
+                       settle_sec=args.settle_time)
+    levels.save(levels_file)
+    logger.info('saved %i levels to %s' % (len(levels.watts), levels_file))
+    sys.exit()
 
-m = Metrics(database_name=config['influxdb']['database_name'])
-cc = ChargeController(config=config, logger=logger, metrics=m, smart_plug=smart_plug, tz=tz)
+m = get_metrics(config['influxdb'])
+cc = ChargeController(config=config, logger=logger, metrics=m, tz=tz)
 volt = cc.pwm.get_pwm_volt()
 logger.info('%0.2f volt at start' % volt)
 
@@ -21,3 +42,6 @@ try:
     cc.loop()
 except KeyboardInterrupt:
     cc.stop()
+finally:
+    cc.shutdown()
+m.stop()
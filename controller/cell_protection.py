@@ -0,0 +1,97 @@
+import struct
+import time
+
+from metrics import Histogram
+
+CELL_FRAME = struct.Struct('>BHHH')
+CELLS_PER_FRAME = 3
+
+
+class CellProtection:
+    """
+    Checks every cell voltage frame of the BMS as soon as it arrives and opens the inverter relay
+    if a cell is below its threshold. The protection stays active until all cells recovered to
+    threshold + hysteresis, until then the relay is opened again whenever it was switched on.
+    Thresholds are kept in millivolt per cell, so a frame is checked without converting it.
+    """
+
+    def __init__(self, relay, logger, min_voltage=2.9, cell_min_voltages=None, hysteresis=0.1, max_cells=32,
+                 on_trip=None):
+        self.relay = relay
+        self.logger = logger
+        self.on_trip = on_trip
+        # index = cell number, index 0 is unused
+        self.thresholds = [int(round(min_voltage * 1000))] * (max_cells + 1)
+        for cell, voltage in (cell_min_voltages or {}).items():
+            if int(cell) <= max_cells:
+                self.thresholds[int(cell)] = int(round(voltage * 1000))
+        self.hysteresis = int(round(hysteresis * 1000))
+        self.max_cells = max_cells
+        # mac_address: cells below the recovery voltage
+        self.low_cells = {}
+        self.trips = 0
+        self.latency = Histogram(buckets=(0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.5))
+
+    def is_active(self, mac_address=None):
+        if mac_address is None:
+            return any(self.low_cells.values())
+        return bool(self.low_cells.get(mac_address))
+
+    def check_frame(self, mac_address, data, received):
+        """
+        data is the payload of one cell voltage frame, received the perf_counter() of its notification.
+        Return the latency if the relay was opened, else None
+        """
+        frame_number, *millivolts = CELL_FRAME.unpack_from(data)
+        first_cell = (frame_number - 1) * CELLS_PER_FRAME + 1
+        low_cells = self.low_cells.setdefault(mac_address, set())
+        was_active = bool(low_cells)
+        tripped_cell = None
+        for cell, millivolt in enumerate(millivolts, first_cell):
+            if cell > self.max_cells or millivolt == 0:
+                # unused slots of the last frame
+                break
+            threshold = self.thresholds[cell]
+            if millivolt < threshold:
+                low_cells.add(cell)
+                if tripped_cell is None:
+                    tripped_cell = (cell, millivolt)
+            elif cell in low_cells and millivolt >= threshold + self.hysteresis:
+                low_cells.discard(cell)
+                self.logger.info('[%s] cell %i recovered (%0.3f V)' % (mac_address, cell, millivolt / 1000))
+
+        if not low_cells:
+            if was_active:
+                self.logger.info('[%s] cell protection released' % mac_address)
+            return None
+        # the cached state avoids a sysfs read per frame, set_state skips the write if the relay is open
+        if not self.relay.set_state(False):
+            return None
+        latency = time.perf_counter() - received
+        self.latency.observe(latency)
+        self.trips += 1
+        if tripped_cell:
+            cell, voltage = tripped_cell[0], tripped_cell[1] / 1000
+            self.logger.warning('[%s] cell %i at %0.3f V, inverter relay opened after %0.1f ms' % (
+                mac_address, cell, voltage, latency * 1000))
+        else:
+            # switched on again before the cell recovered
+            cell, voltage = min(low_cells), None
+            self.logger.warning('[%s] cell %i not recovered yet, inverter relay opened again' % (mac_address, cell))
+        if self.on_trip:
+            self.on_trip(mac_address, cell, voltage, latency)
+        return latency
+
+    def get_fields(self):
+        fields = self.latency.get_fields()
+        fields['trips'] = self.trips
+        fields['active'] = self.is_active()
+        return fields
+
+
+def get_cell_protection(bms_config, relay, logger, on_trip=None):
+    return CellProtection(relay=relay, logger=logger,
+                          min_voltage=bms_config.get('cell_min_voltage', 2.9),
+                          cell_min_voltages=bms_config.get('cell_min_voltages'),
+                          hysteresis=bms_config.get('cell_hysteresis', 0.1),
+                          on_trip=on_trip)
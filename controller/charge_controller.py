@@ -1,8 +1,11 @@
 import datetime
 import time
 
-from devices.pwm_rockpis import PWM
+from controller.charge_levels import get_charge_levels
+from devices.pwm import get_pwm
 from devices.sma_energy_manager import SMAEnergyManagerThread
+from devices.smart_plug import EdimaxSmartPlug, get_smart_plug
+from live_data import LiveDataMeter, LiveDataSmartPlug, get_live_data_reader
 
 from cysystemd.daemon import notify, Notification
 import signal
@@ -33,64 +36,61 @@ class Throttler():
 
 
 class ChargeController():
-    def __init__(self, config, logger, metrics, smart_plug, tz):
+    def __init__(self, config, logger, metrics, tz):
         self.config = config
         self.logger = logger
         self.metrics = metrics
-        self.smart_plug = smart_plug
         self.tz = tz
-        self.pwm = PWM(logger=logger)
+        self.pwm = get_pwm(config['charger'], logger=logger)
         self.is_running = False
 
-        self.logger.info("%s %s" % (self.smart_plug.state, self.smart_plug.now_power))
         self.init_energy_meter()
+        self.init_smart_plug()
+        self.logger.info("%s %s" % (self.smart_plug.state, self.smart_plug.now_power))
 
-        self.levels = {
-            # watt: volt
-            310: 0.4,
-            370: 1.0,  # +60
-            440: 1.2,  # +70
-            510: 1.4,  # +70
-            610: 1.6,  # +100
-            660: 1.8,  # +50
-            740: 2.0,  # +80
-            810: 2.2,  # +70
-            890: 2.4,  # +80
-            980: 2.6,  # +90
-            1060: 2.8,  # +80
-            1170: 3.0,  # +110
-            1270: 3.2,  # +100
-            # the pwm pin supports max. 3.2v
-            1750: 0.1,  # voltages <0.4 set the charger to its maximum
-        }
-        self.min_level = min(self.levels.keys())
+        self.levels = get_charge_levels(config['charger'], logger)
         self.off_throttler = Throttler(60 * 5)
 
         signal.signal(signal.SIGINT, self.stop)
         signal.signal(signal.SIGTERM, self.stop)
 
     def init_energy_meter(self):
+        live_data_reader = get_live_data_reader(self.config)
+        if live_data_reader:
+            # the inverter controller already receives and publishes the meter data
+            self.logger.info("Using energy meter data from the live data file")
+            self.energy_meter = LiveDataMeter(reader=live_data_reader, logger=self.logger)
+            return
         self.logger.info("Connecting to energy meter")
+        # no metrics are written from here, only the grid balance is needed
         self.energy_meter = SMAEnergyManagerThread(serial_number=self.config['sma_energy_manager']['serial_number'],
-                                                   metrics=None, logger=self.logger)
+                                                   metrics=None, logger=self.logger,
+                                                   channels=('p_import', 'p_export'))
         self.energy_meter.start()
         time.sleep(1)
 
-    def set_output_current(self, watt):
-        level = 0
-        for l in self.levels:
-            if l > watt:
-                break
-            level = l
+    def init_smart_plug(self):
+        live_data_reader = get_live_data_reader(self.config)
+        if live_data_reader:
+            # the inverter controller already polls the smart plug
+            self.logger.info("Using smart plug data from the live data file")
+            charger_config = self.config['charger']
+            plug = EdimaxSmartPlug(charger_config['smartplug_ip'],
+                                   (charger_config['smartplug_username'], charger_config['smartplug_password']))
+            self.smart_plug = LiveDataSmartPlug(reader=live_data_reader, plug=plug, logger=self.logger)
+            return
+        self.smart_plug = get_smart_plug(self.config['charger'], logger=self.logger)
+        self.smart_plug.start()
 
-        if level == 0:
+    def set_output_current(self, watt):
+        new_v, level = self.levels.lookup(watt)
+        if new_v is None:
             # the requested watt is lower than the lowest level that the charger supports
             self.logger.info("Turning off smart plug, %s watt requested" % watt)
             self.smart_plug.state = 'OFF'
             # set it to the lowest level, for the next start
-            level = self.min_level
+            new_v, level = self.levels.lookup(self.levels.min_watt)
 
-        new_v = self.levels[level]
         current_v = self.pwm.get_pwm_volt()
         if new_v == current_v:
             self.logger.debug("unchanged %s volt" % new_v)
@@ -100,13 +100,23 @@ class ChargeController():
         return new_v, level
 
     def stop(self, *args):
+        """
+        Signal handler, loop() returns within a second and shutdown() switches the charger off
+        """
         self.logger.info("Stopping...")
         notify(Notification.STOPPING)
         self.is_running = False
+
+    def shutdown(self):
+        """
+        Called on the main thread after loop() returned, so nothing else uses the PWM anymore
+        """
         self.energy_meter.stop()
         self.smart_plug.state = "OFF"
+        self.smart_plug.stop()
         # if the charger turns on while the controller isn't running, limit it as much as possible
-        self.pwm.set_pwm_volt(1.0)
+        self.pwm.set_pwm_volt(1.0, ramp=False)
+        self.pwm.close()
         self.logger.info("Stopped")
 
     def sleep_until_tomorrow(self):
@@ -115,39 +125,51 @@ class ChargeController():
         seconds_left = tomorrow.timestamp() - time.time()
         self.logger.info("Sleeping %0.1f hours" % (seconds_left / 3600))
         self.energy_meter.stop()
-        while seconds_left > 0:
+        while seconds_left > 0 and self.is_running:
             seconds_left -= 30
             notify(Notification.WATCHDOG)
-            time.sleep(30)
+            self.sleep(30)
+        if not self.is_running:
+            return
         self.logger.info("Waking up...")
         self.init_energy_meter()
 
+    def sleep(self, seconds):
+        # returns early after stop()
+        end = time.time() + seconds
+        while self.is_running:
+            left = end - time.time()
+            if left <= 0:
+                break
+            time.sleep(min(left, 1.0))
+
     def loop(self):
         WATT_RESERVED = 50  # leave power for other devices
         LOOP_RUN_SEC = 30
         self.is_running = True
         notify(Notification.READY)
         while self.is_running:
-            if len(self.energy_meter.data) == 0:
+            meter_data = self.energy_meter.data
+            if len(meter_data) == 0:
                 self.logger.warning("No energy meter data")
-                time.sleep(10)
+                self.sleep(10)
                 continue
-            elif time.time() - self.energy_meter.data['time'] > 60:
+            elif time.time() - meter_data['time'] > 60:
                 self.logger.error("Energy meter thread dead")
                 self.energy_meter.stop()
                 self.init_energy_meter()
-                time.sleep(10)
+                self.sleep(10)
                 continue
 
             notify(Notification.WATCHDOG)
 
             ts = time.time()
-            balance = (self.energy_meter.data['p_import'] * -1) + self.energy_meter.data['p_export']
+            balance = (meter_data['p_import'] * -1) + meter_data['p_export']
 
             if self.smart_plug.state == 'OFF':
                 self.logger.info("Charger off")
                 if datetime.datetime.now(self.tz).hour < self.config["charger"]["start_hour"]:
-                    time.sleep(LOOP_RUN_SEC)
+                    self.sleep(LOOP_RUN_SEC)
                     continue
                 elif balance > self.config["charger"]["start_watt_limit"]:
                     # todo: check inverter state
@@ -159,10 +181,14 @@ class ChargeController():
                     continue
                 else:
                     self.pwm.set_pwm_volt(1.0)
-                    time.sleep(LOOP_RUN_SEC)
+                    self.sleep(LOOP_RUN_SEC)
                     continue
 
-            charger_power = float(self.smart_plug.now_power)
+            charger_power = self.smart_plug.now_power
+            if charger_power is None:
+                self.logger.warning("No smart plug data")
+                self.sleep(10)
+                continue
             available_charging_power = balance - WATT_RESERVED + charger_power
 
             if 10 < charger_power < self.config["charger"]["off_watt_limit"]:
@@ -190,4 +216,4 @@ class ChargeController():
             })
             self.metrics.write_metric(points=points)
 
-            time.sleep(LOOP_RUN_SEC)
+            self.sleep(LOOP_RUN_SEC)
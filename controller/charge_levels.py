@@ -0,0 +1,136 @@
+import bisect
+import json
+import os
+import time
+
+# watt: volt, measured by hand with the original charger
+DEFAULT_LEVELS = {
+    310: 0.4,
+    370: 1.0,
+    440: 1.2,
+    510: 1.4,
+    610: 1.6,
+    660: 1.8,
+    740: 2.0,
+    810: 2.2,
+    890: 2.4,
+    980: 2.6,
+    1060: 2.8,
+    1170: 3.0,
+    1270: 3.2,
+}
+# voltages <0.4 set the charger to its maximum
+DEFAULT_FULL_POWER = (1750, 0.1)
+# the pwm pin supports max. 3.2v
+MAX_VOLT = 3.2
+
+
+class ChargeLevels:
+    """
+    Maps the available watt to the PWM volt of the charger, interpolated between the known levels.
+    The full power level (volt below the lowest level) is not part of the interpolation.
+    """
+
+    def __init__(self, levels=None, full_power=DEFAULT_FULL_POWER, calibrated=None):
+        if levels is None:
+            levels = DEFAULT_LEVELS
+        self.watts = []
+        self.volts = []
+        for watt, volt in sorted(levels.items()):
+            # a higher level needs at least the volt of the level below
+            if self.volts and volt <= self.volts[-1]:
+                continue
+            self.watts.append(float(watt))
+            self.volts.append(float(volt))
+        self.full_power = full_power
+        self.calibrated = calibrated
+
+    @property
+    def min_watt(self):
+        return self.watts[0]
+
+    def lookup(self, watt):
+        """
+        Return (volt, watt of the level), (None, 0) if watt is below the lowest level
+        """
+        if watt < self.watts[0]:
+            return None, 0
+        if self.full_power and watt >= self.full_power[0]:
+            return self.full_power[1], self.full_power[0]
+        i = bisect.bisect_right(self.watts, watt)
+        if i == len(self.watts):
+            return self.volts[-1], self.watts[-1]
+        w0, w1 = self.watts[i - 1], self.watts[i]
+        v0, v1 = self.volts[i - 1], self.volts[i]
+        # round down, the charger must not take more than the available power
+        volt = int((v0 + (watt - w0) * (v1 - v0) / (w1 - w0)) * 100) / 100
+        return volt, watt
+
+    def to_dict(self):
+        return {
+            'levels': [[watt, volt] for watt, volt in zip(self.watts, self.volts)],
+            'full_power': list(self.full_power) if self.full_power else None,
+            'calibrated': self.calibrated,
+        }
+
+    def save(self, path):
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            data = json.load(f)
+        full_power = tuple(data['full_power']) if data.get('full_power') else None
+        return ChargeLevels(levels={watt: volt for watt, volt in data['levels']}, full_power=full_power,
+                            calibrated=data.get('calibrated'))
+
+
+def get_charge_levels(charger_config, logger):
+    path = charger_config.get('levels_file')
+    if path and os.path.exists(path):
+        try:
+            levels = ChargeLevels.load(path)
+            logger.info('charge levels from %s (%i levels)' % (path, len(levels.watts)))
+            return levels
+        except (OSError, ValueError, KeyError) as e:
+            logger.error('failed to load charge levels from %s: %s' % (path, e))
+    return ChargeLevels()
+
+
+def _measure(pwm, smart_plug, volt, settle_sec, samples):
+    pwm.set_pwm_volt(volt)
+    time.sleep(settle_sec)
+    watt = 0.0
+    for _ in range(samples):
+        watt += float(smart_plug.now_power)
+        time.sleep(2)
+    return watt / samples
+
+
+def calibrate(pwm, smart_plug, logger, min_volt=0.4, max_volt=MAX_VOLT, step=0.1, settle_sec=20, samples=3):
+    """
+    Sweep the PWM volt with the charger running and measure its power with the smart plug,
+    the battery has to take the full charging power during the sweep
+    """
+    levels = {}
+    smart_plug.state = 'ON'
+    try:
+        for i in range(int(round((max_volt - min_volt) / step)) + 1):
+            volt = round(min_volt + i * step, 2)
+            watt = _measure(pwm, smart_plug, volt, settle_sec, samples)
+            logger.info('%0.2f volt: %0.1f watt' % (volt, watt))
+            if watt > 10:
+                levels[round(watt)] = volt
+        full_power_volt = DEFAULT_FULL_POWER[1]
+        full_power_watt = _measure(pwm, smart_plug, full_power_volt, settle_sec, samples)
+        logger.info('%0.2f volt (full power): %0.1f watt' % (full_power_volt, full_power_watt))
+    finally:
+        # limit the charger as much as possible
+        pwm.set_pwm_volt(1.0)
+        smart_plug.state = 'OFF'
+    if len(levels) < 2:
+        raise ValueError('charger took no power during the calibration')
+    return ChargeLevels(levels=levels, full_power=(round(full_power_watt), full_power_volt), calibrated=time.time())
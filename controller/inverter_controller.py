@@ -4,11 +4,14 @@ from datetime import datetime
 from cysystemd.daemon import notify, Notification
 import signal
 
-from devices.sma_energy_manager import SMAEnergyManagerThread
+from devices.sma_energy_manager import DEFAULT_CHANNELS, SMAEnergyManagerThread
 from devices.aeconversion_inverter import AEConversionInverterThread
-from devices.gpio import GpioPin
-from pyedimax.smartplug import SmartPlug
-from metrics import Metrics
+from devices.aeconversion_bus import AEConversionBusThread
+from devices.gpio import get_gpio_pin
+from devices.smart_plug import get_smart_plug
+from metrics import Histogram, WindowAggregator, get_metrics
+from controller.limit_controller import get_limit_controller
+from live_data import get_live_data_reader, get_live_data_writer
 
 
 class InverterController():
@@ -17,21 +20,47 @@ class InverterController():
         self.logger = logger
         self.tz = tz
         self.logger.info('init...')
-        self.metrics = Metrics(database_name=self.config['influxdb']['database_name'])
+        self.metrics = get_metrics(self.config['influxdb'])
+        # meter and inverter snapshots for the other services, BMS data from smart_bms.py
+        self.live_data = get_live_data_writer(config)
+        self.live_data_reader = get_live_data_reader(config)
         self.logger.info('energy meter...')
+        # one point per window with mean/min/max of every channel and the energy of the active power
+        meter_aggregator = WindowAggregator("SMAEnergyManagerSum",
+                                            {"serial_number": config['sma_energy_manager']['serial_number']},
+                                            tiers=config['sma_energy_manager'].get('metrics_windows', (60, 900)),
+                                            integrate=('p_import', 'p_export'))
         self.energy_meter = SMAEnergyManagerThread(serial_number=config['sma_energy_manager']['serial_number'],
-                                                   metrics=self.metrics, logger=logger)
+                                                   metrics=self.metrics, logger=logger,
+                                                   channels=config['sma_energy_manager'].get('channels',
+                                                                                             DEFAULT_CHANNELS),
+                                                   aggregator=meter_aggregator,
+                                                   live_data=self.live_data)
         self.energy_meter.start()
         self.logger.info('battery inverter...')
-        self.battery_inverter = AEConversionInverterThread(config=config['aeconversion_inverter'],
-                                                           metrics=self.metrics,
-                                                           logger=self.logger)
+        if config['aeconversion_inverter'].get('inverter_ids'):
+            # several inverters on one RS485 bus, the bus thread polls all of them
+            bus_config = dict(config['aeconversion_inverter'])
+            if bus_config['inverter_id'] not in bus_config['inverter_ids']:
+                bus_config['inverter_ids'] = [bus_config['inverter_id']] + bus_config['inverter_ids']
+            self.inverter_bus = AEConversionBusThread(config=bus_config, metrics=self.metrics, logger=self.logger)
+            self.battery_inverter = self.inverter_bus.get_handle(bus_config['inverter_id'])
+        else:
+            self.battery_inverter = AEConversionInverterThread(config=config['aeconversion_inverter'],
+                                                               metrics=self.metrics,
+                                                               logger=self.logger,
+                                                               live_data=self.live_data)
         self.battery_inverter.start()
         self.logger.info('smart plug...')
-        self.smart_plug = SmartPlug(config['charger']['smartplug_ip'],
-                                    (config['charger']['smartplug_username'], config['charger']['smartplug_password']))
+        # polled in the background, published for the charge controller
+        self.smart_plug = get_smart_plug(config['charger'], logger=self.logger, live_data=self.live_data)
+        self.smart_plug.start()
+
+        self.battery_inverter_relay_ac = get_gpio_pin(pin=config['aeconversion_inverter']['gpio_pin'],
+                                                      backend=config['aeconversion_inverter'].get('gpio_backend',
+                                                                                                  'sysfs'))
 
-        self.battery_inverter_relay_ac = GpioPin(pin=config['aeconversion_inverter']['gpio_pin'])
+        self.configure(config.get('inverter_controller', {}))
 
         self.is_running = False
         signal.signal(signal.SIGINT, self.stop)
@@ -39,15 +68,38 @@ class InverterController():
 
         self.logger.info('init done')
 
+    def configure(self, controller_config):
+        self.watt_tolerance = controller_config.get('watt_tolerance', 20)
+        self.set_limit_interval = controller_config.get('set_limit_interval', 120)
+        # max. limit increase per set_limit, in watt
+        self.max_increase = controller_config.get('max_increase', 50)
+        self.loop_interval = controller_config.get('loop_interval', 30)
+        # event driven: react to every meter sample instead of only every loop_interval
+        self.event_driven = controller_config.get('event_driven', False)
+        self.debounce_sec = controller_config.get('debounce_sec', 2)
+        self.hysteresis_watt = controller_config.get('hysteresis_watt', 30)
+        self.min_write_interval = controller_config.get('min_write_interval', 10)
+        self.deviation_since = None
+        # start of the current grid import, kept until a limit change answered it or reaction_timeout passed
+        self.importing = False
+        self.import_since = None
+        self.reaction_timeout = 600
+        self.last_trigger = 0
+        self.reaction_latency = Histogram(buckets=(1, 2, 5, 10, 30, 60, 120, 300, 600))
+        # None: request_energy with max_increase steps, otherwise the controller calculates the limit
+        self.limit_controller = get_limit_controller(controller_config)
+
     def go_idle(self):
         if self.battery_inverter_relay_ac.get_state() == 1:
             self.logger.info('Turning inverter relay off')
             self.battery_inverter_relay_ac.set_state(False)
         self.logger.debug('Inverter relay off')
 
-    def loop_run(self):
+    def loop_run(self, set_limit_interval=None):
         self.logger.debug('==== start of run %s ====' % datetime.now(self.tz))
-        watt_tolerance = 20
+        watt_tolerance = self.watt_tolerance
+        if set_limit_interval is None:
+            set_limit_interval = self.set_limit_interval
         watt_inverter_start = 100
         if not self.energy_meter.is_healthy():
             self.logger.error('no data from energy meter')
@@ -56,8 +108,10 @@ class InverterController():
 
         notify(Notification.WATCHDOG)
 
-        em_import = self.energy_meter.data['p_import']
-        em_export = self.energy_meter.data['p_export']
+        # take the snapshot once, so import and export belong to the same sample
+        meter_data = self.energy_meter.data
+        em_import = meter_data['p_import']
+        em_export = meter_data['p_export']
         em_balanced = False
         self.logger.debug('%s to, %s from grid' % (em_export, em_import))
         if em_export + em_import < watt_tolerance:
@@ -81,10 +135,11 @@ class InverterController():
             return
 
         # print('battery inverter connected')
-        self.logger.debug('Inverter', self.battery_inverter.data)
-        battery_status = self.check_battery_discharge()
+        inverter_data = self.battery_inverter.data
+        self.logger.debug('Inverter %s' % inverter_data)
+        battery_status = self.check_battery_discharge(inverter_data)
         battery_level = 100 / (self.config['battery']['max_voltage'] - self.config['battery']['min_voltage']) * (
-                self.battery_inverter.data['pv_volt'] - self.config['battery']['min_voltage'])
+                inverter_data['pv_volt'] - self.config['battery']['min_voltage'])
         self.logger.debug("Battery Level: %0.2f%%" % battery_level)
 
         max_discharge_watt = self.config['battery']['max_discharge_watt']
@@ -125,6 +180,8 @@ class InverterController():
                 # turn on inverter AC if the battery is at least 40% and we need energy
                 self.logger.info("Turning inverter on")
                 self.battery_inverter_relay_ac.set_state(True)
+                if self.limit_controller:
+                    self.limit_controller.reset()
                 time.sleep(10)
                 self.battery_inverter.queue_command(command='set_limit', args={'limit': 100})
                 return
@@ -133,6 +190,9 @@ class InverterController():
 
         if not inverter_in_operation:
             pass
+        elif self.limit_controller:
+            self.update_limit(em_import - em_export, inverter_data['ac_watt'],
+                              min(max_discharge_watt, inverter_max))
         elif not em_balanced or time.time() - self.battery_inverter.inverter.last_limit_change > 60 * 4:
             self.logger.info('Requesting energy')
             # todo: check vs. watt_max
@@ -140,24 +200,58 @@ class InverterController():
                                                 {
                                                     'watt_request': em_import - em_export,
                                                     'watt_tolerance': watt_tolerance,
-                                                    'set_limit_interval': 120,
+                                                    'set_limit_interval': set_limit_interval,
                                                     'watt_max': max_discharge_watt,
+                                                    'max_increase': self.max_increase,
                                                 })
 
+        self.logger.debug('metrics: %s' % self.metrics.get_stats())
         self.logger.debug('==== end of run ====')
 
-    def check_battery_discharge(self):
-        if self.battery_inverter.data['pv_volt'] > self.config['battery']['min_voltage']:
+    def update_limit(self, grid_watt, ac_watt, watt_max):
+        ts = time.time()
+        limit = self.limit_controller.update(ts, grid_watt, ac_watt, watt_max,
+                                             self.battery_inverter.inverter.last_limit)
+        state = self.limit_controller.get_state()
+        self.logger.debug('limit controller %s' % state)
+        if limit is not None:
+            self.logger.info('set limit %0.1f' % limit)
+            self.battery_inverter.queue_command(command='set_limit', args={'limit': limit})
+        self.metrics.write_metric(points=[{
+            "measurement": "InverterLimitController",
+            "time": ts,
+            "fields": state,
+        }])
+
+    def check_cell_voltages(self):
+        if self.live_data_reader is None:
+            return True
+        bms = self.live_data_reader.read('bms')
+        if not bms or time.time() - bms['time'] > 60:
+            return True
+        # lowest cell of all packs
+        lowest = bms.get('min_cell_voltage')
+        min_cell_voltage = self.config['battery'].get('min_cell_voltage', 2.9)
+        if lowest is not None and lowest < min_cell_voltage:
+            self.logger.warning('lowest cell voltage %0.3f below %0.3f (%i packs)' % (
+                lowest, min_cell_voltage, bms.get('pack_count', 1)))
+            return False
+        return True
+
+    def check_battery_discharge(self, inverter_data):
+        if not self.check_cell_voltages():
+            return False
+        if inverter_data['pv_volt'] > self.config['battery']['min_voltage']:
             return True
 
         self.logger.info("limiting")
-        if self.battery_inverter.data['ac_watt'] > 510:
+        if inverter_data['ac_watt'] > 510:
             self.logger.warning("invalid ac_watt value")
             new_limit = 100
         elif self.battery_inverter.inverter.last_limit:
             new_limit = self.battery_inverter.inverter.last_limit - self.config['aeconversion_inverter']['limit_step']
         else:
-            new_limit = self.battery_inverter.data['ac_watt'] - self.config['aeconversion_inverter']['limit_step']
+            new_limit = inverter_data['ac_watt'] - self.config['aeconversion_inverter']['limit_step']
         if new_limit < 10:
             self.logger.warning("low voltage")
             return False
@@ -171,15 +265,77 @@ class InverterController():
         self.is_running = False
         self.energy_meter.stop()
         self.battery_inverter.stop()
+        self.smart_plug.stop()
         self.battery_inverter_relay_ac.set_state(False)
+        self.metrics.stop()
         self.logger.info("Stopped")
 
+    def check_trigger(self, data):
+        """
+        Return True if the grid balance left the tolerance band for longer than debounce_sec.
+        The band is entered again below watt_tolerance, it is left above watt_tolerance + hysteresis_watt.
+        """
+        ts = data['time']
+        deviation = data['p_import'] - data['p_export']
+        # every transition into import, also a direct flip from export that never enters the band
+        if deviation >= self.watt_tolerance:
+            if not self.importing and self.import_since is None:
+                self.import_since = ts
+            self.importing = True
+        else:
+            self.importing = False
+        if abs(deviation) < self.watt_tolerance:
+            self.deviation_since = None
+            return False
+        if self.deviation_since is None:
+            if abs(deviation) <= self.watt_tolerance + self.hysteresis_watt:
+                return False
+            self.deviation_since = ts
+
+        if ts - self.deviation_since < self.debounce_sec:
+            return False
+        if ts - self.last_trigger < self.min_write_interval:
+            return False
+        self.last_trigger = ts
+        return True
+
+    def record_reaction_latency(self):
+        if self.import_since is None:
+            return
+        last_limit_change = self.battery_inverter.inverter.last_limit_change
+        if not last_limit_change or last_limit_change < self.import_since:
+            if time.time() - self.import_since > self.reaction_timeout:
+                self.logger.info('no limit change within %i seconds after grid import started' %
+                                 self.reaction_timeout)
+                self.import_since = None
+            return
+        latency = last_limit_change - self.import_since
+        self.import_since = None
+        self.reaction_latency.observe(latency)
+        self.logger.info('limit changed %0.1f seconds after grid import started' % latency)
+        fields = self.reaction_latency.get_fields()
+        fields['latency'] = latency
+        self.metrics.write_metric(points=[{
+            "measurement": "InverterControllerReaction",
+            "time": last_limit_change,
+            "fields": fields,
+        }])
+
     def loop(self):
         self.is_running = True
         notify(Notification.READY)
+        last_run = 0
         while self.is_running:
             try:
-                self.loop_run()
-                time.sleep(30)
+                self.energy_meter.wait_for_data(timeout=5)
+                data = self.energy_meter.data
+                triggered = len(data) > 0 and self.check_trigger(data)
+                if (self.event_driven and triggered) or time.time() - last_run >= self.loop_interval:
+                    last_run = time.time()
+                    if self.event_driven:
+                        self.loop_run(set_limit_interval=self.min_write_interval)
+                    else:
+                        self.loop_run()
+                self.record_reaction_latency()
             except KeyboardInterrupt:
                 self.stop()
@@ -0,0 +1,101 @@
+class PILimitController:
+    """
+    Calculates the inverter limit from the grid balance. Load steps above step_watt are answered
+    with a feed-forward jump to the estimated house load (inverter output + grid balance), smaller
+    deviations are corrected by a PI controller whose integrator holds the limit.
+    The integrator is clamped to the possible limits (anti-windup), increases are limited to
+    max_step per write, decreases are written at once.
+    """
+
+    def __init__(self, kp=0.2, ki=0.02, setpoint=-20, step_watt=100, max_step=250, min_limit=10, deadband=20,
+                 min_write_interval=10):
+        self.kp = kp
+        self.ki = ki  # per second
+        self.setpoint = setpoint  # grid power to settle at, negative = export
+        self.step_watt = step_watt
+        self.max_step = max_step
+        self.min_limit = min_limit
+        self.deadband = deadband
+        self.min_write_interval = min_write_interval
+        self.state = {}
+        self.reset()
+
+    def reset(self):
+        self.integrator = None
+        self.last_update = None
+        self.last_write = None
+
+    def update(self, ts, grid_watt, ac_watt, watt_max, last_limit):
+        """
+        Return the new limit, None if the current limit should be kept.
+        grid_watt is import - export, ac_watt the last output reading of the inverter
+        """
+        dt = 0.0 if self.last_update is None else min(ts - self.last_update, 60.0)
+        self.last_update = ts
+
+        error = grid_watt - self.setpoint
+        # ac_watt is polled less often than the meter, after a decrease the limit is the better estimate
+        output_estimate = min(last_limit, ac_watt) if last_limit else ac_watt
+        feed_forward = self.integrator is None or abs(error) > self.step_watt
+        if feed_forward:
+            self.integrator = output_estimate + error
+        elif abs(error) > self.deadband:
+            # inside the deadband no limit is written, integrating there would only wind up
+            self.integrator += self.ki * error * dt
+        saturated = not self.min_limit <= self.integrator <= watt_max
+        self.integrator = max(min(self.integrator, watt_max), self.min_limit)
+        output = self.integrator
+        if not feed_forward:
+            output += self.kp * error
+        target = max(min(output, watt_max), self.min_limit)
+
+        limit = target
+        rate_limited = False
+        if last_limit and limit > last_limit + self.max_step:
+            limit = last_limit + self.max_step
+            rate_limited = True
+
+        write = not last_limit or abs(limit - last_limit) > self.deadband or (limit == self.min_limit != last_limit)
+        if write and self.last_write is not None and ts - self.last_write < self.min_write_interval:
+            write = False
+        if write:
+            self.last_write = ts
+
+        self.state = {
+            'setpoint': float(self.setpoint),
+            'error': float(error),
+            'output_estimate': float(output_estimate),
+            'integrator': float(self.integrator),
+            'p_term': float(self.kp * error),
+            'output': float(output),
+            'limit': float(limit),
+            'feed_forward': feed_forward,
+            'saturated': saturated,
+            'rate_limited': rate_limited,
+            'write': write,
+        }
+        if not write:
+            return None
+        return round(limit, 1)
+
+    def get_state(self):
+        return dict(self.state)
+
+
+def get_limit_controller(controller_config):
+    """
+    None for the default step mode of AEConversionInverter.request_energy
+    """
+    mode = controller_config.get('limit_mode', 'step')
+    if mode == 'step':
+        return None
+    if mode == 'pi':
+        return PILimitController(kp=controller_config.get('pi_kp', 0.2),
+                                 ki=controller_config.get('pi_ki', 0.02),
+                                 setpoint=controller_config.get('pi_setpoint',
+                                                                -controller_config.get('watt_tolerance', 20)),
+                                 step_watt=controller_config.get('pi_step_watt', 100),
+                                 max_step=controller_config.get('pi_max_step', 250),
+                                 deadband=controller_config.get('watt_tolerance', 20),
+                                 min_write_interval=controller_config.get('pi_min_write_interval', 10))
+    raise ValueError('unknown limit_mode "%s"' % mode)
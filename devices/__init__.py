@@ -1,4 +1,5 @@
 from .aeconversion_inverter import AEConversionInverter, AEConversionInverterThread
+from .aeconversion_bus import AEConversionBusThread
 #from .relay import Relay
 from .sma_energy_manager import SMAEnergyManager, SMAEnergyManagerThread
 from .smart_bms import SmartBMS
\ No newline at end of file
@@ -0,0 +1,226 @@
+import collections
+import threading
+import time
+import traceback
+
+from .aeconversion_inverter import AEConversionInverter
+from .command_queue import CommandQueue
+from .rs485 import get_transport
+from .snapshot import InverterSnapshot
+
+
+class AEConversionBusThread(threading.Thread):
+    """
+    Owns one RS485 port and polls several inverters on it round-robin,
+    queued commands are sent before the next routine poll
+    """
+
+    def __init__(self, config, metrics, logger):
+        threading.Thread.__init__(self)
+        self.is_running = False
+        self.start_time = None
+        self.logger = logger
+        self.metrics = metrics
+        self.device = config['device']
+        self.poll_interval = config.get('poll_interval', 10)
+        self.transport = get_transport(self.device)
+        self.inverters = collections.OrderedDict()
+        for inverter_id in config['inverter_ids']:
+            self.inverters[inverter_id] = AEConversionInverter(device=self.device,
+                                                               inverter_id=inverter_id,
+                                                               transport=self.transport,
+                                                               request_retries=config.get('request_retries', 2),
+                                                               verbose=False)
+        self.data = {inverter_id: {} for inverter_id in self.inverters}
+        self.sequence = 0
+        self.next_poll = {inverter_id: 0 for inverter_id in self.inverters}
+        self.last_connection_attempt = {inverter_id: 0 for inverter_id in self.inverters}
+        # failed polls and commands in a row, the inverter is connected again after max_failures
+        self.failures = {inverter_id: 0 for inverter_id in self.inverters}
+        self.max_failures = config.get('max_failures', 3)
+        # routine polls run only when no command is waiting
+        self.command_queue = CommandQueue(max_age=config.get('command_max_age', 60),
+                                          max_attempts=config.get('command_max_attempts', 3))
+        self.last_stats = 0
+
+    def stop(self):
+        self.logger.info('AEConversionBusThread: stopping...')
+        self.is_running = False
+        self.command_queue.wake()
+
+    def queue_command(self, inverter_id, command, args):
+        try:
+            # one command of a kind per inverter, a newer one replaces the waiting one
+            self.command_queue.put(command, args, key=(inverter_id, command))
+        except ValueError as e:
+            self.logger.error('AEConversionBusThread: %s' % e)
+
+    def get_handle(self, inverter_id):
+        return AEConversionBusHandle(bus=self, inverter_id=inverter_id)
+
+    def _execute(self, item):
+        inverter_id = item.key[0]
+        inverter = self.inverters[inverter_id]
+        if not inverter.device_parameters:
+            self.logger.warning('AEConversionBusThread: inverter %s not connected, dropping %s' % (inverter_id,
+                                                                                                item.command))
+            return
+        error = None
+        try:
+            if item.command == 'set_limit':
+                result = inverter.set_limit(**item.args)
+            else:
+                result = inverter.request_energy(**item.args)
+        except OSError as e:
+            error = e
+            result = False
+        except Exception as e:
+            self.logger.error(e)
+            self.logger.error(traceback.format_exc())
+            result = False
+        if result is False:
+            self.logger.error('AEConversionBusThread: %s for inverter %s failed' % (item.command, inverter_id))
+            self._failed(inverter_id, error)
+            if not self.command_queue.retry(item):
+                self.logger.warning('AEConversionBusThread: dropping %s for inverter %s after %i attempts' % (
+                    item.command, inverter_id, item.attempts))
+        else:
+            self.failures[inverter_id] = 0
+            self.command_queue.done(item)
+
+    def _failed(self, inverter_id, error=None):
+        """
+        Count a failed request. After an OSError the port is closed, after an OSError or max_failures
+        failures in a row the inverter is connected again by the next poll.
+        """
+        self.failures[inverter_id] += 1
+        if error is not None:
+            self.logger.error('AEConversionBusThread: %s, closing %s' % (error, self.device))
+            # reopened by the next request, e.g. after the TCP gateway restarted
+            self.transport.close()
+        elif self.failures[inverter_id] < self.max_failures:
+            return
+        self.logger.warning('AEConversionBusThread: reconnecting to inverter %s' % inverter_id)
+        self.failures[inverter_id] = 0
+        self.inverters[inverter_id].device_parameters = None
+
+    def _poll(self, inverter_id):
+        inverter = self.inverters[inverter_id]
+        if not inverter.device_parameters:
+            if time.time() - self.last_connection_attempt[inverter_id] < 60:
+                return
+            self.last_connection_attempt[inverter_id] = time.time()
+            try:
+                inverter.connect()
+            except OSError as e:
+                self.logger.error('AEConversionBusThread: failed to connect to %s: %s' % (inverter_id, e))
+            return
+
+        try:
+            data = inverter.get_data()
+        except OSError as e:
+            self.logger.error('AEConversionBusThread: failed to get data from inverter %s' % inverter_id)
+            self._failed(inverter_id, e)
+            return
+        if data is False:
+            self._failed(inverter_id)
+            return
+        self.failures[inverter_id] = 0
+
+        self.sequence += 1
+        snapshot = InverterSnapshot(self.sequence, data['time'], data)
+        self.data[inverter_id] = snapshot
+        self.metrics.write_metric(points=[snapshot.to_point("AEConversionInverterData", {
+            "inverter_id": inverter_id,
+            "dev": self.device,
+        })])
+
+    def _write_stats(self):
+        points = []
+        ts = time.time()
+        for inverter_id, inverter in self.inverters.items():
+            points.append({
+                "measurement": "AEConversionBusStats",
+                "tags": {
+                    "inverter_id": inverter_id,
+                    "dev": self.device,
+                },
+                "time": ts,
+                "fields": inverter.get_stats(),
+            })
+        points.append({
+            "measurement": "AEConversionCommandQueue",
+            "tags": {
+                "dev": self.device,
+            },
+            "time": ts,
+            "fields": self.command_queue.get_stats(),
+        })
+        self.metrics.write_metric(points=points)
+        self.last_stats = ts
+
+    def get_stats(self):
+        return {inverter_id: inverter.get_stats() for inverter_id, inverter in self.inverters.items()}
+
+    def run(self):
+        self.is_running = True
+        self.start_time = time.time()
+        while self.is_running:
+            item = self.command_queue.get_nowait()
+            if item:
+                self._execute(item)
+                continue
+
+            # poll the inverter that is overdue the longest
+            inverter_id = min(self.next_poll, key=self.next_poll.get)
+            wait = self.next_poll[inverter_id] - time.time()
+            if wait > 0:
+                if self.is_running:
+                    self.command_queue.wait(wait)
+                continue
+            self.next_poll[inverter_id] = time.time() + self.poll_interval
+            self._poll(inverter_id)
+
+            if time.time() - self.last_stats > 60:
+                self._write_stats()
+
+        self.transport.close()
+        self.logger.info('AEConversionBusThread: stopped')
+
+
+class AEConversionBusHandle:
+    """
+    One inverter on a shared bus, with the interface of AEConversionInverterThread
+    """
+
+    def __init__(self, bus, inverter_id):
+        self.bus = bus
+        self.inverter_id = inverter_id
+        self.inverter = bus.inverters[inverter_id]
+
+    @property
+    def data(self):
+        return self.bus.data[self.inverter_id]
+
+    def queue_command(self, command, args):
+        self.bus.queue_command(self.inverter_id, command, args)
+
+    def start(self):
+        if not self.bus.is_alive():
+            self.bus.start()
+
+    def stop(self):
+        self.bus.stop()
+
+    def is_healthy(self):
+        if not self.bus.is_running:
+            return False
+        data = self.data
+        if len(data) == 0:
+            return False
+        t_diff = time.time() - data['time']
+        if t_diff > 60.0:
+            self.bus.logger.warning('AEConversionBusHandle: no data from %s for %s seconds' % (self.inverter_id,
+                                                                                            int(t_diff)))
+            return False
+        return True
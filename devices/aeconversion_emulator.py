@@ -0,0 +1,227 @@
+import os
+import random
+import select
+import struct
+import threading
+import time
+import tty
+
+from .rs485 import FRAME_END, calc_crc
+
+# state bits of the 0x03F0 response, see state_codes in aeconversion_inverter
+STATE_READY_AC = 0x0001
+STATE_ENERGY_DC_OK = 0x0002
+STATE_POWER_LIMIT_SET = 0x0008
+STATE_ATTINY_OK = 0x0080
+STATE_ATTINY_PARAM_OK = 0x0200
+# the highest bit is never decoded by _check_bits, keep one above the interesting ones set
+STATE_SYNC_AC = 0x0800
+
+
+def response_frame(payload):
+    return b'\x21' + payload + bytes([calc_crc(payload)]) + b'\x0d'
+
+
+class EmulatedInverter:
+    """
+    Answers the requests of AEConversionInverter like a real inverter,
+    the AC power follows the PV power and the last set limit
+    """
+
+    def __init__(self, inverter_id, device_type='500-90', max_watt=500, version='TF0.9.21     533',
+                 pv_watt=300.0, pv_volt=36.0, temperature=35.0, efficiency=0.95):
+        self.inverter_id = inverter_id
+        self.device_type = device_type
+        self.max_watt = max_watt
+        self.version = version
+        self.pv_watt = pv_watt
+        self.pv_volt = pv_volt
+        self.temperature = temperature
+        self.efficiency = efficiency
+        self.limit = None
+        self.watt_hours = 0.0
+        self.last_update = time.monotonic()
+        self.requests = {}
+
+    @staticmethod
+    def _encode_value(value):
+        return int(round(value * 2 ** 16)) & 0xffffffff
+
+    def ac_watt(self):
+        watt = min(self.pv_watt * self.efficiency, self.max_watt)
+        if self.limit is not None:
+            watt = min(watt, self.limit)
+        return watt
+
+    def _update_yield(self):
+        now = time.monotonic()
+        self.watt_hours += self.ac_watt() * (now - self.last_update) / 3600
+        self.last_update = now
+
+    def handle_request(self, request):
+        """
+        Answer a complete request frame, usable as LoopbackTransport responder
+        """
+        if request[-1:] == b'\x0d':
+            request = request[:-1]
+        # requests carry the checksum as two bytes
+        if len(request) < 7 or request[-2:] != calc_crc(request[1:-2]).to_bytes(2, byteorder='big'):
+            return None
+        inverter_id, command = struct.unpack('>HH', request[1:5])
+        if inverter_id != self.inverter_id:
+            return None
+        return self.handle(command, request[5:-2])
+
+    def handle(self, command, args):
+        """
+        Return the response frame for a command, None if the real inverter would not answer
+        """
+        self.requests[command] = self.requests.get(command, 0) + 1
+        self._update_yield()
+        if command == 0x03ed:
+            values = (230.0, self.ac_watt() / 230.0, self.pv_watt / self.pv_volt, self.pv_volt,
+                      self.ac_watt(), self.pv_watt, self.temperature, 0.0)
+            return response_frame(b'\x27\x11' + struct.pack('>8I', *map(self._encode_value, values)))
+        if command == 0x03f6:
+            return response_frame(b'\x27\x16' + bytes(4) + self.device_type.encode().ljust(6, b'\x00')[:6]
+                                  + bytes(38) + self.version.encode().ljust(16)[:16]
+                                  + struct.pack('>I', self._encode_value(self.max_watt)))
+        if command == 0x03fd:
+            return response_frame(b'\x27\x1d' + struct.pack('>II', self._encode_value(self.ac_watt()),
+                                                          self._encode_value(self.watt_hours)))
+        if command == 0x03f0:
+            state = STATE_READY_AC | STATE_ATTINY_OK | STATE_ATTINY_PARAM_OK | STATE_SYNC_AC
+            if self.pv_watt > 0:
+                state |= STATE_ENERGY_DC_OK
+            if self.limit is not None:
+                state |= STATE_POWER_LIMIT_SET
+            return response_frame(b'\x27\x13' + struct.pack('>III', state, 0, 0))
+        if command == 0x03fe and len(args) == 4:
+            self.limit = struct.unpack('>I', args)[0] / 2 ** 16
+            return response_frame(b'\x27\x10')
+        return None
+
+
+class BusNoise:
+    """
+    Disturbs response frames: jitter delays the answer, dropped bytes and
+    corrupted frames make the reader fail and retry
+    """
+
+    def __init__(self, jitter=0.0, drop_rate=0.0, corrupt_rate=0.0, seed=None):
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.random = random.Random(seed)
+        self.dropped = 0
+        self.corrupted = 0
+
+    def delay(self):
+        if not self.jitter:
+            return 0.0
+        return self.random.uniform(0, self.jitter)
+
+    def apply(self, frame):
+        frame = bytearray(frame)
+        if self.drop_rate and self.random.random() < self.drop_rate:
+            del frame[self.random.randrange(len(frame))]
+            self.dropped += 1
+        elif self.corrupt_rate and self.random.random() < self.corrupt_rate:
+            # never touch the frame end, the checksum has to catch it
+            frame[self.random.randrange(len(frame) - 1)] ^= 1 << self.random.randrange(8)
+            self.corrupted += 1
+        return bytes(frame)
+
+
+class PtyInverterEmulator(threading.Thread):
+    """
+    Emulates one or more inverters on a pseudo terminal, port is the device path to
+    pass to AEConversionInverter. Requests and responses are paced like a 9600 baud line.
+    """
+
+    def __init__(self, inverters, noise=None, baudrate=9600, response_delay=0.01):
+        threading.Thread.__init__(self, daemon=True)
+        self.inverters = {inverter.inverter_id: inverter for inverter in inverters}
+        self.noise = noise or BusNoise()
+        self.byte_time = 10 / baudrate  # start bit, 8 data bits, stop bit
+        self.response_delay = response_delay
+        self.is_running = False
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.buffer = bytearray()
+        self.request_count = 0
+        self.response_count = 0
+        self.invalid_count = 0
+
+    def stop(self):
+        self.is_running = False
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+    def _next_request(self):
+        # same framing as FrameReader: the first \x0d after a matching two byte checksum ends a request
+        start = self.buffer.find(b'\x21')
+        if start == -1:
+            del self.buffer[:]
+            return None
+        del self.buffer[:start]
+        search_start = 7
+        while True:
+            end = self.buffer.find(FRAME_END, search_start)
+            if end == -1:
+                return None
+            if self.buffer[end - 2:end] == calc_crc(self.buffer[1:end - 2]).to_bytes(2, byteorder='big'):
+                request = bytes(self.buffer[:end])
+                del self.buffer[:end + 1]
+                return request
+            search_start = end + 1
+
+    def _write_paced(self, frame):
+        for i in range(len(frame)):
+            os.write(self.master, frame[i:i + 1])
+            time.sleep(self.byte_time)
+
+    def _handle(self, request):
+        self.request_count += 1
+        inverter_id, command = struct.unpack('>HH', request[1:5])
+        inverter = self.inverters.get(inverter_id)
+        if inverter is None:
+            self.invalid_count += 1
+            return
+        response = inverter.handle(command, request[5:-2])
+        if response is None:
+            self.invalid_count += 1
+            return
+        # the request needs its own transmission time on a real bus
+        time.sleep((len(request) + 1) * self.byte_time + self.response_delay + self.noise.delay())
+        self._write_paced(self.noise.apply(response))
+        self.response_count += 1
+
+    def run(self):
+        self.is_running = True
+        while self.is_running:
+            if not select.select([self.master], [], [], 0.1)[0]:
+                continue
+            try:
+                self.buffer += os.read(self.master, 1024)
+            except OSError:
+                break
+            while True:
+                request = self._next_request()
+                if request is None:
+                    break
+                self._handle(request)
+        self.is_running = False
+
+    def get_stats(self):
+        return {
+            'requests': self.request_count,
+            'responses': self.response_count,
+            'invalid': self.invalid_count,
+            'dropped': self.noise.dropped,
+            'corrupted': self.noise.corrupted,
+        }
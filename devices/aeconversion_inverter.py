@@ -1,11 +1,15 @@
 import math
-import serial
 import struct
 import sys
 import threading
 import time
 import traceback
 
+from .command_queue import CommandQueue
+from .poll_scheduler import get_poll_scheduler
+from .rs485 import FrameReader, calc_crc, get_transport
+from .snapshot import InverterSnapshot
+
 error_codes = (
     "TEMP_SENSOR",
     "TEMP_HIGH",
@@ -69,10 +73,16 @@ disturb_codes = (
     "FREQU_6",
 )
 
+DATA_STRUCT = struct.Struct('>3x I I I I I I I I x')
+YIELD_STRUCT = struct.Struct('>3x I I x')
+DEVICE_PARAMETERS_STRUCT = struct.Struct('>7x 6s 38x 16s I')
+
 
 class AEConversionInverter:
-    def __init__(self, device, inverter_id, request_retries=5, exit_after_retries=False, verbose=True):
-        self.serial = None
+    def __init__(self, device, inverter_id, request_retries=5, exit_after_retries=False, verbose=True,
+                 transport=None):
+        self.transport = transport
+        self.frame_reader = FrameReader()
         self.device = device
         self.inverter_id = inverter_id
         self.inverter_id_bytes = inverter_id.to_bytes(2, byteorder='big')
@@ -83,14 +93,15 @@ class AEConversionInverter:
         self.request_retries = request_retries
         self.exit_after_retries = exit_after_retries
         self.verbose = verbose
+        self.request_count = 0
+        self.error_count = 0
+        self.last_rtt = None
+        self.rtt_sum = 0.0
+        self.rtt_max = 0.0
 
     @staticmethod
     def _calc_crc(message_bytes):
-        x = 0
-        for b in message_bytes:
-            x ^= b
-
-        return x
+        return calc_crc(message_bytes)
 
     def _calc_request_crc(self, message_bytes):
         m = self.inverter_id_bytes + message_bytes
@@ -130,43 +141,30 @@ class AEConversionInverter:
             print('Not connected')
             return False, 'not-connected'
 
-        if not self.serial.isOpen():
-            self.serial.open()
+        if not self.transport.is_open():
+            self.transport.open()
 
         full_message = self._calc_request_crc(message_bytes)
-        self.serial.reset_input_buffer()
-        self.serial.reset_output_buffer()
-        self.serial.write(full_message)
-
-        response_bytes = b""
-        while True:
-            b = self.serial.read(1)
-            if len(b) == 0:
-                if self.verbose:
-                    print("Incomplete response read")
-                return False, 'incomplete'
-            if b == b'\x0d' and len(response_bytes) >= min_length:
-                # valid/complete answers have to end with \x0d
-                break
-            elif b == b'\x0d':
-                # print('found at', len(response_bytes), 'but to short')
-                pass
-            response_bytes += b
+        start = time.monotonic()
+        self.transport.reset_input_buffer()
+        self.transport.write(full_message)
 
-        if len(response_bytes) == 0:
-            if self.verbose:
-                print('No response received')
-            return False, 'empty'
-
-        received_crc = response_bytes[-1]
-        calculated_crc = self._calc_crc(response_bytes[1:-1])
-
-        if received_crc != calculated_crc:
-            if self.verbose:
-                print("Checksum wrong, %s received vs. %s calculated" % (received_crc, calculated_crc))
-            return False, "crc"
+        # valid/complete answers have to end with \x0d and a matching checksum
+        response_bytes, error = self.frame_reader.read_frame(self.transport, min_length=min_length)
+        self.request_count += 1
+        if error:
+            self.error_count += 1
+        else:
+            self.last_rtt = time.monotonic() - start
+            self.rtt_sum += self.last_rtt
+            self.rtt_max = max(self.rtt_max, self.last_rtt)
+        if error and self.verbose:
+            if error == 'crc':
+                print("Checksum wrong")
+            else:
+                print("Incomplete response read")
 
-        return response_bytes, None
+        return response_bytes, error
 
     @staticmethod
     def _decode_value(i):
@@ -175,18 +173,9 @@ class AEConversionInverter:
         return round(i / 2 ** 16, 2)
 
     def connect(self):
-        self.serial = serial.Serial(
-            port=self.device,
-            baudrate=9600,
-            bytesize=serial.EIGHTBITS,
-            parity=serial.PARITY_NONE,
-            stopbits=serial.STOPBITS_ONE,
-            timeout=2,
-            xonxoff=False,
-            rtscts=False,
-            dsrdtr=False,
-            writeTimeout=2
-        )
+        if self.transport is None:
+            self.transport = get_transport(self.device)
+        self.transport.open()
 
         try:
             self.device_parameters = self.get_device_parameters()
@@ -195,7 +184,7 @@ class AEConversionInverter:
             print(traceback.format_exc())
             self.device_parameters = None
         if not self.device_parameters:
-            print('Failed to connect to inverter %s over %s' % (self.inverter_id, self.serial.port))
+            print('Failed to connect to inverter %s over %s' % (self.inverter_id, self.transport.port))
             return False
 
         if self.verbose:
@@ -211,7 +200,8 @@ class AEConversionInverter:
         return True
 
     def stop(self):
-        self.serial.close()
+        if self.transport:
+            self.transport.close()
 
     def get_data(self):
         message = b"\x03\xED"
@@ -227,7 +217,7 @@ class AEConversionInverter:
                 sys.exit(1)
             return False
 
-        parts = struct.unpack('>3x I I I I I I I I x', response_bytes[:36])
+        parts = DATA_STRUCT.unpack_from(response_bytes)
 
         data = {
             # '_u_s_ac': self._decode_value(parts[0]),
@@ -297,7 +287,7 @@ class AEConversionInverter:
         if response_bytes is False or len(response_bytes) != 12:
             return False
 
-        parts = struct.unpack('>3x I I x', response_bytes)
+        parts = YIELD_STRUCT.unpack(response_bytes)
         data = {
             'watt': self._decode_value(parts[0]),
             'watt_hours': self._decode_value(parts[1]),
@@ -309,7 +299,7 @@ class AEConversionInverter:
         if not response_bytes:
             return False
 
-        parts = struct.unpack('>7x 6s 38x 16s I', response_bytes[:71])
+        parts = DEVICE_PARAMETERS_STRUCT.unpack_from(response_bytes)
         data = {
             'max_watt': self._decode_value(parts[2]),
             'type': parts[0].decode(),
@@ -326,18 +316,15 @@ class AEConversionInverter:
 
         _p = int(limit) * 2 ** 16
         message = message_bytes + _p.to_bytes(4, byteorder='big')
-        try:
-            response_bytes = self._read_request(message)
-        except serial.serialutil.SerialException as e:
-            print('setting limit failed')
-            print(e)
-            return False
+        # an OSError is raised to the caller, the bus thread reconnects after it
+        response_bytes = self._read_request(message)
         if not response_bytes:
             return False
         response = response_bytes.hex()
         if not response:
             return False
-        elif response == '212710370d':
+        elif response in ('21271037', '212710370d'):
+            # frames are returned without the trailing \x0d
             status = self.get_status()
             if 'POWER_LIMIT_SET' not in status['states']:
                 print('POWER_LIMIT_SET not in status states')
@@ -374,7 +361,8 @@ class AEConversionInverter:
             if self.last_limit != 10:
                 force_limit = True
 
-        is_in_tolerance = math.isclose(calculated_limit, self.last_limit, abs_tol=watt_tolerance)
+        is_in_tolerance = self.last_limit is not None and math.isclose(calculated_limit, self.last_limit,
+                                                                       abs_tol=watt_tolerance)
         if self.last_limit and is_in_tolerance and not force_limit:
             print('current limit (%0.2f) in tolerance' % self.last_limit)
         else:
@@ -389,6 +377,17 @@ class AEConversionInverter:
                     print('retry next round')
                 else:
                     print('Limit set to %0.1f' % result)
+                return result
+
+    def get_stats(self):
+        successful = self.request_count - self.error_count
+        return {
+            'requests': self.request_count,
+            'errors': self.error_count,
+            'error_rate': self.error_count / self.request_count if self.request_count else 0.0,
+            'rtt_avg': self.rtt_sum / successful if successful else 0.0,
+            'rtt_max': self.rtt_max,
+        }
 
     def is_active(self):
         # is the inverter producing energy?
@@ -403,22 +402,36 @@ class AEConversionInverter:
 
 
 class AEConversionInverterThread(threading.Thread):
-    def __init__(self, config, metrics, logger):
+    def __init__(self, config, metrics, logger, live_data=None):
         threading.Thread.__init__(self)
         self.is_running = False
         self.start_time = None
         self.connected = False
         self.last_connection_attempt = 0
         self.data = {}
-        self.command_queue = []
+        self.command_queue = CommandQueue(max_age=config.get('command_max_age', 60),
+                                          max_attempts=config.get('command_max_attempts', 3))
+        self.last_stats = 0
+        self.scheduler = get_poll_scheduler(config)
+        self.poll_functions = {
+            'data': self.poll_data,
+            'status': self.poll_status,
+            'yield': self.poll_yield,
+        }
+        self.status = {}
+        # set when a command is queued, so it is sent without waiting for the next poll
+        self.command_event = threading.Event()
         self.logger = logger
         self.inverter = AEConversionInverter(device=config['device'],
                                              inverter_id=config['inverter_id'])
         self.metrics = metrics
+        self.live_data = live_data
+        self.sequence = 0
 
     def stop(self):
         self.logger.info('AEConversionInverterThread: stopping...')
         self.is_running = False
+        self.command_event.set()
         self.inverter.stop()
 
     def run(self):
@@ -437,78 +450,138 @@ class AEConversionInverterThread(threading.Thread):
                     return False
                 time.sleep(10)
                 continue
-            # print(self.command_queue)
             retry_queue = []
             while len(self.command_queue) > 0:
                 if not self.is_healthy():
                     self.logger.error("AEConversionInverterThread: unhealthy, not executing commands")
-                    self.logger.debug(self.command_queue)
                     break
-                command, kwargs = self.command_queue.pop(0)
-                self.logger.debug(command, kwargs)
+                item = self.command_queue.get_nowait()
+                if item is None:
+                    break
+                self.logger.debug(item)
+                last_limit_change = self.inverter.last_limit_change
                 try:
-                    if command == 'set_limit':
-                        result = self.inverter.set_limit(**kwargs)
+                    if item.command == 'set_limit':
+                        result = self.inverter.set_limit(**item.args)
                         # todo: set again after 5 minutes
-                    elif command == 'request_energy':
-                        result = self.inverter.request_energy(**kwargs)
                     else:
-                        print('unknown command "%s" in queue' % command)
-                        result = False
+                        result = self.inverter.request_energy(**item.args)
                 except Exception as e:
                     self.logger.error(e)
                     self.logger.error(traceback.format_exc())
                     result = False
                 if result is False:
-                    self.logger.error('%s failed' % command)
-                    # todo: if failure count > 5: drop
-                    retry_queue.append((command, kwargs))
-                    time.sleep(5)
+                    self.logger.error('%s failed' % item.command)
+                    retry_queue.append(item)
+                    self.scheduler.command_failed(time.time())
                 else:
-                    # skip reading data
-                    time.sleep(1)
-                    continue
-
-            self.command_queue.extend(retry_queue)
-            try:
-                data = self.inverter.get_data()
-            except serial.serialutil.SerialException:
-                self.logger.error('AEConversionInverterThread: failed to get data from inverter')
-                data = False
-            if data is not False:
-                self.is_connected = True
-                self.data = data
-                points = []
-                data_copy = data.copy()
-                ts = data_copy['time']
-                del data_copy['time']
-                points.append({
-                    "measurement": "AEConversionInverterData",
-                    "tags": {
-                        "inverter_id": self.inverter.inverter_id,
-                        "dev": self.inverter.device,
-                    },
-                    "time": ts,
-                    "fields": data_copy,
-                })
-                self.metrics.write_metric(points=points)
-
-            time.sleep(10)
+                    self.command_queue.done(item)
+                    if self.inverter.last_limit_change != last_limit_change:
+                        # watch the inverter follow the new limit
+                        self.scheduler.limit_changed(time.time())
+
+            for item in retry_queue:
+                if not self.command_queue.retry(item):
+                    self.logger.warning('AEConversionInverterThread: dropping %s after %i attempts' % (
+                        item.command, item.attempts))
+
+            for task in self.scheduler.due(time.time()):
+                start = time.monotonic()
+                try:
+                    result = self.poll_functions[task]()
+                except OSError:
+                    self.logger.error('AEConversionInverterThread: failed to get %s from inverter' % task)
+                    result = False
+                self.scheduler.done(task, time.time(), time.monotonic() - start,
+                                    data=result if task == 'data' else None)
+                if result is not False:
+                    self.is_connected = True
+
+            if time.time() - self.last_stats > 60:
+                self.write_queue_stats()
+
+            self.command_event.wait(self.scheduler.next_delay(time.time()))
+            self.command_event.clear()
         self.logger.info('AEConversionInverterThread: stopped')
 
+    def poll_data(self):
+        data = self.inverter.get_data()
+        if data is False:
+            return False
+        self.sequence += 1
+        snapshot = InverterSnapshot(self.sequence, data['time'], data)
+        self.data = snapshot
+        if self.live_data:
+            self.live_data.publish('inverter', snapshot, extra={'last_limit': self.inverter.last_limit})
+        self.metrics.write_metric(points=[snapshot.to_point("AEConversionInverterData", {
+            "inverter_id": self.inverter.inverter_id,
+            "dev": self.inverter.device,
+        })])
+        return data
+
+    def poll_status(self):
+        status = self.inverter.get_status()
+        if status is False:
+            return False
+        self.status = status
+        self.metrics.write_metric(points=[{
+            "measurement": "AEConversionInverterStatus",
+            "tags": {
+                "inverter_id": self.inverter.inverter_id,
+                "dev": self.inverter.device,
+            },
+            "time": time.time(),
+            "fields": {key: ','.join(value) for key, value in status.items()},
+        }])
+        return status
+
+    def poll_yield(self):
+        data = self.inverter.get_yield()
+        if data is False:
+            return False
+        self.metrics.write_metric(points=[{
+            "measurement": "AEConversionInverterYield",
+            "tags": {
+                "inverter_id": self.inverter.inverter_id,
+                "dev": self.inverter.device,
+            },
+            "time": time.time(),
+            "fields": data,
+        }])
+        return data
+
     def queue_command(self, command, args):
-        self.command_queue.append([command, args])
+        try:
+            self.command_queue.put(command, args)
+        except ValueError as e:
+            self.logger.error('AEConversionInverterThread: %s' % e)
+            return
+        self.command_event.set()
+
+    def write_queue_stats(self):
+        self.last_stats = time.time()
+        self.metrics.write_metric(points=[{
+            "measurement": "AEConversionCommandQueue",
+            "tags": {
+                "inverter_id": self.inverter.inverter_id,
+                "dev": self.inverter.device,
+            },
+            "time": self.last_stats,
+            "fields": dict(self.command_queue.get_stats(), **self.scheduler.get_stats(self.last_stats)),
+        }])
 
     def is_healthy(self):
         if not self.is_running or not self.is_connected:
             return False
-        if len(self.data) == 0:
+        data = self.data
+        if len(data) == 0:
             return False
-        t_diff = time.time() - self.data['time']
-        if t_diff > 120.0:
-            self.logger.warning(
-                'AEConversionInverterThread: no data for %s seconds' % int(time.time() - self.data['time']))
-        if t_diff > 60.0:
+        t_diff = time.time() - data['time']
+        # the poll interval is minutes while the inverter is off
+        max_age = self.scheduler.max_data_age(time.time())
+        if t_diff > max_age * 2:
+            self.logger.warning('AEConversionInverterThread: no data for %s seconds' % int(t_diff))
+        if t_diff > max_age:
             self.logger.warning("disconnecting")
             self.inverter.stop()
             if time.time() - self.last_connection_attempt > 60:
@@ -0,0 +1,122 @@
+import struct
+import threading
+import time
+
+MAGIC = b'ESCCAP01'
+RECORD = struct.Struct('<dBH')  # timestamp, kind, payload length
+
+KIND_SPEEDWIRE = 1
+KIND_BLE_NOTIFICATION = 2
+KIND_NAMES = {
+    KIND_SPEEDWIRE: 'speedwire',
+    KIND_BLE_NOTIFICATION: 'ble-notification',
+}
+
+
+class CaptureWriter:
+    """
+    Appends raw datagrams and notifications with their receive time to a capture file
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.lock = threading.Lock()
+
+    def record(self, kind, payload, ts=None):
+        if ts is None:
+            ts = time.time()
+        with self.lock:
+            self.file.write(RECORD.pack(ts, kind, len(payload)))
+            self.file.write(payload)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_capture(path, kinds=None):
+    """
+    Yield (timestamp, kind, payload) of all records, optionally only of the given kinds
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a capture file' % path)
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            ts, kind, length = RECORD.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                break
+            if kinds is None or kind in kinds:
+                yield ts, kind, payload
+
+
+class ReplayClock:
+    """
+    Maps capture timestamps to wall clock time, speed 2.0 replays twice as fast, 0 without any delay
+    """
+
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self.first_ts = None
+        self.start = None
+
+    def wait(self, ts):
+        if self.first_ts is None:
+            self.first_ts = ts
+            self.start = time.monotonic()
+            return
+        if not self.speed:
+            return
+        delay = (ts - self.first_ts) / self.speed - (time.monotonic() - self.start)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ReplaySocket:
+    """
+    Replaces the multicast socket of SMAEnergyManager, raises EOFError at the end of the capture
+    """
+
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.clock = ReplayClock(speed=speed)
+        self.records = read_capture(path, kinds=(KIND_SPEEDWIRE,))
+
+    def recv_into(self, buffer):
+        try:
+            ts, _, payload = next(self.records)
+        except StopIteration:
+            raise EOFError('end of capture %s' % self.path)
+        self.clock.wait(ts)
+        length = min(len(payload), len(buffer))
+        buffer[:length] = payload[:length]
+        return length
+
+    def recv(self, size):
+        buffer = bytearray(size)
+        return bytes(buffer[:self.recv_into(buffer)])
+
+    def close(self):
+        self.records.close()
+
+
+if __name__ == '__main__':
+    import sys
+
+    counts = {}
+    first_ts = None
+    last_ts = None
+    for ts, kind, payload in read_capture(sys.argv[1]):
+        if first_ts is None:
+            first_ts = ts
+        last_ts = ts
+        count, size = counts.get(kind, (0, 0))
+        counts[kind] = (count + 1, size + len(payload))
+    if first_ts is not None:
+        print('%0.1f seconds' % (last_ts - first_ts))
+    for kind, (count, size) in counts.items():
+        print('%s: %i records, %i bytes' % (KIND_NAMES.get(kind, kind), count, size))
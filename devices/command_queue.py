@@ -0,0 +1,147 @@
+import heapq
+import itertools
+import threading
+import time
+
+# lower value = executed first
+COMMAND_PRIORITIES = {
+    'set_limit': 0,
+    'request_energy': 1,
+}
+
+
+class Command:
+    __slots__ = ('key', 'command', 'args', 'priority', 'queued', 'deadline', 'attempts', 'cancelled')
+
+    def __init__(self, key, command, args, priority, queued, deadline):
+        self.key = key
+        self.command = command
+        self.args = args
+        self.priority = priority
+        self.queued = queued
+        self.deadline = deadline
+        self.attempts = 0
+        self.cancelled = False
+
+    def __repr__(self):
+        return '<Command %s %s attempt %i>' % (self.command, self.args, self.attempts)
+
+
+class CommandQueue:
+    """
+    Thread-safe priority queue for inverter commands. A new command replaces a waiting command
+    with the same key (default: the command name), commands older than max_age seconds are dropped
+    instead of executed, failed commands are retried at most max_attempts times.
+    """
+
+    def __init__(self, priorities=COMMAND_PRIORITIES, max_age=60, max_attempts=3):
+        self.priorities = priorities
+        self.max_age = max_age
+        self.max_attempts = max_attempts
+        self.heap = []
+        self.pending = {}
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.woken = False
+        self.stats = {
+            'queued': 0,
+            'coalesced': 0,
+            'expired': 0,
+            'failed': 0,
+            'retried': 0,
+            'executed': 0,
+        }
+        self.wait_sum = 0.0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def put(self, command, args, key=None, max_age=None):
+        if command not in self.priorities:
+            raise ValueError('unknown command "%s"' % command)
+        if key is None:
+            key = command
+        now = time.time()
+        item = Command(key, command, args, self.priorities[command], now, now + (max_age or self.max_age))
+        with self.condition:
+            self._push(item)
+            self.stats['queued'] += 1
+            self.condition.notify_all()
+        return item
+
+    def _push(self, item):
+        old = self.pending.get(item.key)
+        if old is not None:
+            # only the newest command of a kind is executed
+            old.cancelled = True
+            self.stats['coalesced'] += 1
+        self.pending[item.key] = item
+        heapq.heappush(self.heap, (item.priority, next(self.counter), item))
+
+    def get_nowait(self):
+        """
+        Return the next command, None if the queue is empty
+        """
+        now = time.time()
+        with self.condition:
+            while self.heap:
+                item = heapq.heappop(self.heap)[2]
+                if item.cancelled:
+                    continue
+                del self.pending[item.key]
+                if now > item.deadline:
+                    self.stats['expired'] += 1
+                    continue
+                item.attempts += 1
+                return item
+        return None
+
+    def wait(self, timeout):
+        """
+        Block until a command is queued or wake() is called, at most timeout seconds
+        """
+        with self.condition:
+            if not self.pending and not self.woken:
+                self.condition.wait(timeout)
+            self.woken = False
+            return len(self.pending) > 0
+
+    def wake(self):
+        with self.condition:
+            self.woken = True
+            self.condition.notify_all()
+
+    def done(self, item):
+        with self.condition:
+            self.stats['executed'] += 1
+            self.wait_sum += time.time() - item.queued
+
+    def retry(self, item):
+        """
+        Queue a failed command again, return False if it was dropped
+        """
+        with self.condition:
+            if item.key in self.pending:
+                # a newer command of this kind is waiting
+                self.stats['coalesced'] += 1
+                return False
+            if item.attempts >= self.max_attempts or time.time() > item.deadline:
+                self.stats['failed'] += 1
+                return False
+            self._push(item)
+            self.stats['retried'] += 1
+            return True
+
+    def oldest_age(self):
+        with self.condition:
+            if not self.pending:
+                return 0.0
+            return time.time() - min(item.queued for item in self.pending.values())
+
+    def get_stats(self):
+        with self.condition:
+            stats = dict(self.stats)
+            stats['depth'] = len(self.pending)
+            stats['wait_avg'] = self.wait_sum / stats['executed'] if stats['executed'] else 0.0
+        stats['oldest_age'] = self.oldest_age()
+        return stats
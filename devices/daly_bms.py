@@ -0,0 +1,334 @@
+import asyncio
+import struct
+import time
+
+from .capture import KIND_BLE_NOTIFICATION, read_capture
+
+NOTIFY_UUID = "0000fff1-0000-1000-8000-00805f9b34fb"
+WRITE_UUID = "0000fff2-0000-1000-8000-00805f9b34fb"
+
+FRAME_LENGTH = 13
+START_BYTE = 0xA5
+HOST_ADDRESS = 0x80
+
+CMD_SOC = 0x90
+CMD_STATUS = 0x94
+CMD_CELL_VOLTAGES = 0x95
+
+CELLS_PER_FRAME = 3
+
+
+def format_request(command):
+    frame = bytes((START_BYTE, HOST_ADDRESS, command, 0x08)) + bytes(8)
+    return frame + bytes((sum(frame) & 0xFF,))
+
+
+def parse_soc(data):
+    total_voltage, _, current, soc = struct.unpack('>HHHH', data)
+    return {
+        'total_voltage': total_voltage / 10,
+        # offset 30000, positive while charging
+        'current': (current - 30000) / 10,
+        'soc_percent': soc / 10,
+    }
+
+
+def parse_status(data):
+    cell_count, temperature_sensors, charger_running, load_running, _, cycles = struct.unpack('>BBBBBH', data[:7])
+    return {
+        'cell_count': cell_count,
+        'temperature_sensors': temperature_sensors,
+        'charger_running': bool(charger_running),
+        'load_running': bool(load_running),
+        'cycles': cycles,
+    }
+
+
+def parse_cell_voltages(frames, cell_count=None):
+    voltages = {}
+    for data in frames:
+        frame_number = data[0]
+        for i, millivolt in enumerate(struct.unpack('>HHH', data[1:7])):
+            cell = (frame_number - 1) * CELLS_PER_FRAME + i + 1
+            if cell_count and cell > cell_count:
+                break
+            voltages[cell] = millivolt / 1000
+    return voltages
+
+
+class FrameBuffer:
+    """
+    Ring buffer that reassembles the 13 byte frames from BLE notifications of any length,
+    bytes in front of a frame start and frames with a wrong checksum are skipped
+    """
+
+    def __init__(self, size=512):
+        if size < FRAME_LENGTH:
+            raise ValueError('buffer size %i < frame length' % size)
+        self.buffer = bytearray(size)
+        self.size = size
+        self.start = 0
+        self.length = 0
+        self.skipped = 0
+        self.frames = 0
+
+    def feed(self, data):
+        """
+        Append a notification, return the complete frames as (command, data)
+        """
+        # less than a frame is left after parsing, so chunks of this size never push out a frame start
+        chunk = self.size - FRAME_LENGTH + 1
+        if len(data) > chunk:
+            frames = []
+            for start in range(0, len(data), chunk):
+                frames.extend(self.feed(data[start:start + chunk]))
+            return frames
+        end = (self.start + self.length) % self.size
+        first = min(len(data), self.size - end)
+        self.buffer[end:end + first] = data[:first]
+        self.buffer[:len(data) - first] = data[first:]
+        self.length += len(data)
+
+        frames = []
+        while self.length >= FRAME_LENGTH:
+            if self.buffer[self.start] != START_BYTE:
+                self._skip(1)
+                continue
+            frame = self._peek(FRAME_LENGTH)
+            if sum(frame[:-1]) & 0xFF != frame[-1]:
+                self._skip(1)
+                continue
+            self._skip(FRAME_LENGTH, skipped=False)
+            self.frames += 1
+            frames.append((frame[2], bytes(frame[4:12])))
+        return frames
+
+    def _peek(self, length):
+        end = self.start + length
+        if end <= self.size:
+            return self.buffer[self.start:end]
+        return self.buffer[self.start:] + self.buffer[:end - self.size]
+
+    def _skip(self, length, skipped=True):
+        self.start = (self.start + length) % self.size
+        self.length -= length
+        if skipped:
+            self.skipped += length
+
+
+class DalyBMSClient:
+    """
+    Daly BMS over BLE, requests of different commands are sent without waiting for the
+    previous response, the responses are matched by their command byte
+    """
+
+    def __init__(self, mac_address, logger, timeout=5.0, capture=None, client_factory=None, frame_listener=None):
+        self.mac_address = mac_address
+        self.logger = logger
+        self.timeout = timeout
+        self.capture = capture
+        self.client_factory = client_factory
+        # frame_listener(mac_address, command, data, received) sees every frame as soon as it is complete
+        self.frame_listener = frame_listener
+        self.client = None
+        self.frames = FrameBuffer()
+        # command: [future, collected frames]
+        self.pending = {}
+        self.cell_count = None
+        self.last_frame = 0
+
+    @property
+    def is_connected(self):
+        return self.client is not None and self.client.is_connected
+
+    async def connect(self):
+        if self.client_factory:
+            self.client = self.client_factory(self.mac_address)
+        else:
+            from bleak import BleakClient
+            self.client = BleakClient(self.mac_address)
+        self.frames = FrameBuffer()
+        await self.client.connect(timeout=self.timeout * 2)
+        await self.client.start_notify(NOTIFY_UUID, self.on_notification)
+
+    async def disconnect(self):
+        for future, _ in self.pending.values():
+            if not future.done():
+                future.cancel()
+        self.pending = {}
+        if self.client:
+            try:
+                await self.client.disconnect()
+            finally:
+                self.client = None
+
+    def on_notification(self, sender, data):
+        received = time.perf_counter()
+        ts = time.time()
+        if self.capture:
+            self.capture.record(KIND_BLE_NOTIFICATION, bytes(data), ts)
+        for command, frame in self.frames.feed(data):
+            self.last_frame = ts
+            if self.frame_listener:
+                self.frame_listener(self.mac_address, command, frame, received)
+            pending = self.pending.get(command)
+            if pending is None or pending[0].done():
+                continue
+            future, collected = pending
+            collected.append(frame)
+            if command != CMD_CELL_VOLTAGES:
+                future.set_result(collected)
+            elif self.cell_count and len(collected) * CELLS_PER_FRAME >= self.cell_count:
+                future.set_result(collected)
+
+    async def request(self, command):
+        """
+        Return the data of the response frames, a running request for the same command is shared
+        """
+        pending = self.pending.get(command)
+        if pending and not pending[0].done():
+            return await asyncio.shield(pending[0])
+        future = asyncio.get_event_loop().create_future()
+        collected = []
+        self.pending[command] = [future, collected]
+        await self.client.write_gatt_char(WRITE_UUID, format_request(command))
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            if command == CMD_CELL_VOLTAGES and collected:
+                # without the cell count the end of the response is the timeout
+                return collected
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+
+    async def get_soc(self):
+        frames = await self.request(CMD_SOC)
+        return parse_soc(frames[0])
+
+    async def get_status(self):
+        frames = await self.request(CMD_STATUS)
+        status = parse_status(frames[0])
+        self.cell_count = status['cell_count']
+        return status
+
+    async def get_cell_voltages(self):
+        frames = await self.request(CMD_CELL_VOLTAGES)
+        return parse_cell_voltages(frames, self.cell_count)
+
+    async def get_all(self):
+        """
+        SOC, status and cell voltages with all three requests in flight at once
+        """
+        if self.cell_count is None:
+            # the number of cells tells when the cell voltage response is complete
+            await self.get_status()
+        results = await asyncio.gather(self.get_soc(), self.get_status(), self.get_cell_voltages(),
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+
+class DalyBMSPack:
+    """
+    Polls one pack every interval seconds and reconnects with a growing delay after errors,
+    callback(pack, soc, status, cell_voltages) is awaited after every update
+    """
+
+    def __init__(self, mac_address, logger, callback, interval=10, capture=None, client_factory=None,
+                 frame_listener=None):
+        self.mac_address = mac_address
+        self.logger = logger
+        self.callback = callback
+        self.interval = interval
+        self.client = DalyBMSClient(mac_address=mac_address, logger=logger, capture=capture,
+                                    client_factory=client_factory, frame_listener=frame_listener)
+        self.is_running = False
+        self.last_data_received = None
+        self.errors = 0
+        self.reconnects = 0
+
+    async def run(self):
+        self.is_running = True
+        delay = 5
+        while self.is_running:
+            try:
+                if not self.client.is_connected:
+                    self.logger.info('[%s] connecting' % self.mac_address)
+                    await self.client.connect()
+                    self.reconnects += 1
+                soc, status, cell_voltages = await self.client.get_all()
+            except asyncio.TimeoutError:
+                self.errors += 1
+                if isinstance(self.client.client, ReplayClient) and not self.client.is_connected:
+                    self.logger.info('[%s] end of replay' % self.mac_address)
+                    break
+                self.logger.warning('[%s] no response' % self.mac_address)
+                await self.reset(delay)
+                delay = min(delay * 2, 300)
+                continue
+            except Exception as e:
+                self.errors += 1
+                self.logger.error('[%s] %s' % (self.mac_address, e))
+                await self.reset(delay)
+                delay = min(delay * 2, 300)
+                continue
+            delay = 5
+            self.last_data_received = time.time()
+            await self.callback(self, soc, status, cell_voltages)
+            await asyncio.sleep(self.interval)
+        await self.client.disconnect()
+        self.logger.info('[%s] stopped' % self.mac_address)
+
+    async def reset(self, delay):
+        try:
+            await self.client.disconnect()
+        except Exception as e:
+            self.logger.debug('[%s] disconnect failed: %s' % (self.mac_address, e))
+        await asyncio.sleep(delay)
+
+    def stop(self):
+        self.is_running = False
+
+
+class ReplayClient:
+    """
+    Replaces BleakClient, every written request is answered with the next response to that command
+    from a capture file. The client disconnects when a command has no responses left.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.is_connected = False
+        self.callback = None
+        self.responses = {}
+        frames = FrameBuffer()
+        for _, _, payload in read_capture(path, kinds=(KIND_BLE_NOTIFICATION,)):
+            for command, data in frames.feed(payload):
+                responses = self.responses.setdefault(command, [])
+                if not responses or command != CMD_CELL_VOLTAGES or data[0] == 1:
+                    responses.append([])
+                responses[-1].append(data)
+
+    async def connect(self, timeout=None):
+        self.is_connected = True
+
+    async def start_notify(self, uuid, callback):
+        self.callback = callback
+
+    async def write_gatt_char(self, uuid, data):
+        command = data[2]
+        responses = self.responses.get(command)
+        if not responses:
+            self.is_connected = False
+            return
+        for frame_data in responses.pop(0):
+            frame = bytes((START_BYTE, 0x01, command, 0x08)) + frame_data
+            frame += bytes((sum(frame) & 0xFF,))
+            asyncio.get_event_loop().call_soon(self.callback, self.path, bytearray(frame))
+
+    async def disconnect(self):
+        self.is_connected = False
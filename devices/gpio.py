@@ -1,17 +1,39 @@
 import sys
 import os
+import select
+import shutil
+import tempfile
+import threading
+import time
 
 BASE_DIR = "/sys/class/gpio"
 
 
 class GpioPin:
-    def __init__(self, pin, direction="out"):
+    """
+    GPIO pin in sysfs, the value file stays open. The last read or written state is cached,
+    set_state skips the write if the pin already has the state. Other processes may switch
+    the pin too, the cache is only trusted for max_cache_age seconds.
+    With edge ("rising", "falling" or "both") wait_for_edge blocks until the value changes.
+    """
+
+    def __init__(self, pin, direction="out", edge=None, base_dir=BASE_DIR, max_cache_age=5.0):
         self.pin = pin
-        self.pin_dir = "%s/gpio%i" % (BASE_DIR, pin)
+        self.base_dir = base_dir
+        self.pin_dir = "%s/gpio%i" % (base_dir, pin)
+        self.max_cache_age = max_cache_age
         if not os.path.isdir(self.pin_dir):
-            with open("%s/export" % BASE_DIR, 'w') as f:
+            with open("%s/export" % base_dir, 'w') as f:
                 f.write("%i\n" % pin)
         self.set_direction(direction)
+        if edge:
+            self.set_edge(edge)
+        self.direction = direction
+        self.value_fd = os.open("%s/value" % self.pin_dir, os.O_RDWR if direction == "out" else os.O_RDONLY)
+        self.state = None
+        self.state_time = 0
+        self.writes = 0
+        self.poller = None
 
     def set_direction(self, direction):
         with open("%s/direction" % self.pin_dir, 'r') as f:
@@ -22,19 +44,143 @@ class GpioPin:
         with open("%s/direction" % self.pin_dir, 'w') as f:
             f.write("%s\n" % direction)
 
+    def set_edge(self, edge):
+        with open("%s/edge" % self.pin_dir, 'w') as f:
+            f.write("%s\n" % edge)
+
+    def read_value(self):
+        value = int(os.pread(self.value_fd, 8, 0))
+        self.state = value
+        self.state_time = time.monotonic()
+        return value
+
     def get_state(self):
-        with open("%s/value" % self.pin_dir, 'r') as f:
-            value = f.readline()
-        return int(value)
+        if self.direction == "out" and self.state is not None \
+                and time.monotonic() - self.state_time < self.max_cache_age:
+            return self.state
+        return self.read_value()
 
     def set_state(self, state):
+        state = int(state)
+        if self.get_state() == state:
+            return False
+        os.pwrite(self.value_fd, b"%i\n" % state, 0)
+        self.state = state
+        self.state_time = time.monotonic()
+        self.writes += 1
+        return True
+
+    def edge_fd(self):
+        # sysfs signals an edge as priority data on the value file
+        return self.value_fd, select.POLLPRI | select.POLLERR
+
+    def wait_for_edge(self, timeout=None):
+        """
+        Return the new value, None after timeout seconds without an edge
+        """
+        if self.poller is None:
+            fd, events = self.edge_fd()
+            self.poller = select.poll()
+            self.poller.register(fd, events)
+            # the first poll returns at once, until the value was read
+            self.read_value()
+        if not self.poller.poll(None if timeout is None else timeout * 1000):
+            return None
+        return self.read_value()
+
+    def close(self):
+        os.close(self.value_fd)
+
+
+class FakeGpioPin(GpioPin):
+    """
+    GPIO pin in a temporary directory with the sysfs layout, edges are triggered with set_input
+    """
+
+    def __init__(self, pin, direction="out", edge=None, base_dir=None, max_cache_age=5.0):
+        self.temp_dir = None
+        if base_dir is None:
+            self.temp_dir = base_dir = tempfile.mkdtemp(prefix='esc-gpio-')
+        pin_dir = "%s/gpio%i" % (base_dir, pin)
+        os.makedirs(pin_dir, exist_ok=True)
+        for name, value in (("direction", "in"), ("edge", "none"), ("value", 0)):
+            if not os.path.exists("%s/%s" % (pin_dir, name)):
+                with open("%s/%s" % (pin_dir, name), 'w') as f:
+                    f.write("%s\n" % value)
+        self.edge_pipe = os.pipe()
+        os.set_blocking(self.edge_pipe[0], False)
+        GpioPin.__init__(self, pin=pin, direction=direction, edge=edge, base_dir=base_dir,
+                         max_cache_age=max_cache_age)
+
+    def set_input(self, value):
+        """
+        Change the value from outside, like the connected hardware would
+        """
         with open("%s/value" % self.pin_dir, 'w') as f:
-            f.write("%s\n" % int(state))
+            f.write("%i\n" % int(value))
+        os.write(self.edge_pipe[1], b'1')
 
+    def edge_fd(self):
+        return self.edge_pipe[0], select.POLLIN
 
-if __name__ == '__main__':
-    import time
+    def read_value(self):
+        try:
+            os.read(self.edge_pipe[0], 64)
+        except BlockingIOError:
+            pass
+        return GpioPin.read_value(self)
 
+    def close(self):
+        GpioPin.close(self)
+        for fd in self.edge_pipe:
+            os.close(fd)
+        if self.temp_dir:
+            shutil.rmtree(self.temp_dir)
+
+
+class GpioEdgeMonitor(threading.Thread):
+    """
+    Calls callback(pin, value) for every edge of the given input pins
+    """
+
+    def __init__(self, pins, callback, logger, interval=1.0):
+        threading.Thread.__init__(self, daemon=True)
+        self.is_running = False
+        self.pins = {}
+        self.callback = callback
+        self.logger = logger
+        self.interval = interval
+        self.poller = select.poll()
+        for pin in pins:
+            fd, events = pin.edge_fd()
+            self.poller.register(fd, events)
+            self.pins[fd] = pin
+            pin.read_value()
+
+    def stop(self):
+        self.is_running = False
+
+    def run(self):
+        self.is_running = True
+        while self.is_running:
+            for fd, _ in self.poller.poll(self.interval * 1000):
+                pin = self.pins[fd]
+                value = pin.read_value()
+                try:
+                    self.callback(pin.pin, value)
+                except Exception as e:
+                    self.logger.error('GpioEdgeMonitor: callback failed for pin %i: %s' % (pin.pin, e))
+
+
+def get_gpio_pin(pin, direction="out", backend="sysfs"):
+    if backend == "sysfs":
+        return GpioPin(pin=pin, direction=direction)
+    if backend == "fake":
+        return FakeGpioPin(pin=pin, direction=direction)
+    raise ValueError('unknown GPIO backend "%s"' % backend)
+
+
+if __name__ == '__main__':
     pin = int(sys.argv[1])
     relais = GpioPin(pin=pin)
     print(relais.get_state())
@@ -0,0 +1,111 @@
+import time
+
+TASKS = ('data', 'status', 'yield')
+
+
+class PollScheduler:
+    """
+    Decides when the inverter thread reads data, status and yield.
+    Data is read every fast_interval seconds for fast_duration seconds after a limit change or a load step
+    of at least step_watt, every interval seconds while the inverter runs and every idle_interval
+    (night_interval during night_hours) while it is off. Status and yield are read at their own intervals,
+    never more often than data. No request is repeated before it used at most bus_budget of the time
+    since its last run, measured with the average duration of the request.
+    """
+
+    def __init__(self, fast_interval=1, fast_duration=30, interval=10, idle_interval=60, night_interval=300,
+                 night_hours=(22, 6), status_interval=60, yield_interval=300, step_watt=100, bus_budget=0.2,
+                 retry_delay=5):
+        self.fast_interval = fast_interval
+        self.fast_duration = fast_duration
+        self.interval = interval
+        self.idle_interval = idle_interval
+        self.night_interval = night_interval
+        self.night_hours = night_hours
+        self.intervals = {
+            'status': status_interval,
+            'yield': yield_interval,
+        }
+        self.step_watt = step_watt
+        self.bus_budget = bus_budget
+        self.retry_delay = retry_delay
+        self.next_run = {task: 0.0 for task in TASKS}
+        # average seconds on the bus per request
+        self.durations = {task: 0.0 for task in TASKS}
+        self.requests = {task: 0 for task in TASKS}
+        self.fast_until = 0.0
+        self.ac_watt = None
+
+    def is_night(self, now):
+        start, end = self.night_hours
+        hour = time.localtime(now).tm_hour
+        if start > end:
+            return hour >= start or hour < end
+        return start <= hour < end
+
+    def data_interval(self, now):
+        if now < self.fast_until:
+            return self.fast_interval
+        if self.ac_watt == 0.0:
+            return self.night_interval if self.is_night(now) else self.idle_interval
+        return self.interval
+
+    def task_interval(self, task, now):
+        interval = self.data_interval(now)
+        if task != 'data':
+            interval = max(self.intervals[task], interval)
+        return max(interval, self.durations[task] / self.bus_budget)
+
+    def due(self, now):
+        return [task for task in TASKS if self.next_run[task] <= now]
+
+    def done(self, task, now, duration, data=None):
+        """
+        Record a finished request, data is the result of get_data
+        """
+        self.requests[task] += 1
+        # exponential moving average, the first request counts fully
+        weight = max(0.2, 1.0 / self.requests[task])
+        self.durations[task] += (duration - self.durations[task]) * weight
+        if data:
+            if self.ac_watt is not None and abs(data['ac_watt'] - self.ac_watt) >= self.step_watt:
+                self.fast_until = now + self.fast_duration
+            self.ac_watt = data['ac_watt']
+        self.next_run[task] = now + self.task_interval(task, now)
+
+    def limit_changed(self, now):
+        self.fast_until = now + self.fast_duration
+        self.next_run['data'] = min(self.next_run['data'], now + self.fast_interval)
+
+    def command_failed(self, now):
+        # let the bus recover before the next request
+        for task in TASKS:
+            self.next_run[task] = max(self.next_run[task], now + self.retry_delay)
+
+    def next_delay(self, now):
+        return max(min(self.next_run.values()) - now, 0.0)
+
+    def max_data_age(self, now):
+        """
+        Data older than this is missing at least two polls
+        """
+        return max(60.0, 2 * self.data_interval(now) + 10)
+
+    def get_stats(self, now):
+        stats = {'data_interval': float(self.data_interval(now))}
+        for task in TASKS:
+            stats['%s_duration' % task] = self.durations[task]
+            stats['%s_requests' % task] = self.requests[task]
+        return stats
+
+
+def get_poll_scheduler(config):
+    return PollScheduler(fast_interval=config.get('poll_fast_interval', 1),
+                         fast_duration=config.get('poll_fast_duration', 30),
+                         interval=config.get('poll_interval', 10),
+                         idle_interval=config.get('poll_idle_interval', 60),
+                         night_interval=config.get('poll_night_interval', 300),
+                         night_hours=tuple(config.get('night_hours', (22, 6))),
+                         status_interval=config.get('status_interval', 60),
+                         yield_interval=config.get('yield_interval', 300),
+                         bus_budget=config.get('bus_budget', 0.2))
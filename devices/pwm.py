@@ -0,0 +1,147 @@
+import os
+import shutil
+import tempfile
+import time
+
+MODEL_PATHS = ("/proc/device-tree/model", "/sys/firmware/devicetree/base/model")
+
+
+class SysfsPWM:
+    """
+    PWM output in sysfs, the duty cycle file stays open and the last written duty is cached,
+    unchanged values are not written again. With ramp_step (volt) the output changes in steps
+    of ramp_step every ramp_interval seconds instead of at once.
+    """
+    BASE_DIR = None
+    BASE_VOLTAGE = 3.3
+    BASE_FACTOR = 100
+    # the highest volt that is written, higher values are limited to it
+    MAX_VOLTAGE = 3.3
+    DUTY_FILE = "duty_cycle"
+
+    def __init__(self, logger, base_dir=None, ramp_step=0.0, ramp_interval=0.05):
+        self.logger = logger
+        self.base_dir = base_dir or self.BASE_DIR
+        self.ramp_step = ramp_step
+        self.ramp_interval = ramp_interval
+        self.writes = 0
+        self.pwm_init()
+        self.duty_fd = os.open(os.path.join(self.base_dir, self.DUTY_FILE), os.O_RDWR)
+        self.duty = self.read_duty()
+
+    def pwm_init(self):
+        pass
+
+    def write_file(self, name, value):
+        with open(os.path.join(self.base_dir, name), 'w') as f:
+            f.write("%s\n" % value)
+
+    def read_duty(self):
+        return int(os.pread(self.duty_fd, 32, 0))
+
+    def write_duty(self, duty):
+        if duty == self.duty:
+            return False
+        data = b"%i\n" % duty
+        os.pwrite(self.duty_fd, data, 0)
+        self.duty = duty
+        self.writes += 1
+        return True
+
+    def volt_to_duty(self, volt):
+        return int(self.BASE_FACTOR / self.BASE_VOLTAGE * volt)
+
+    def duty_to_volt(self, duty):
+        return round(self.BASE_VOLTAGE / self.BASE_FACTOR * duty, 2)
+
+    def set_pwm_volt(self, volt, ramp=True):
+        if volt > self.MAX_VOLTAGE:
+            self.logger.error("Voltage %s > %s, setting to maximum" % (volt, self.MAX_VOLTAGE))
+            volt = self.MAX_VOLTAGE
+        if ramp and self.ramp_step:
+            current = self.duty_to_volt(self.duty)
+            steps = int(abs(volt - current) / self.ramp_step)
+            direction = 1 if volt > current else -1
+            for step in range(1, steps + 1):
+                self.write_duty(self.volt_to_duty(current + direction * step * self.ramp_step))
+                time.sleep(self.ramp_interval)
+        duty = self.volt_to_duty(volt)
+        self.logger.debug("%s Volt (%s)" % (volt, duty))
+        self.write_duty(duty)
+
+    def get_pwm_volt(self):
+        return self.duty_to_volt(self.duty)
+
+    def close(self):
+        os.close(self.duty_fd)
+
+
+class FakePWM(SysfsPWM):
+    """
+    PWM in a temporary directory with the sysfs layout of the Rock Pi S, for running without the board
+    """
+    BASE_VOLTAGE = 3.33
+    BASE_FACTOR = 98140
+    MAX_VOLTAGE = 3.2
+
+    def __init__(self, logger, base_dir=None, ramp_step=0.0, ramp_interval=0.05):
+        self.temp_dir = None
+        if base_dir is None:
+            self.temp_dir = base_dir = tempfile.mkdtemp(prefix='esc-pwm-')
+        SysfsPWM.__init__(self, logger=logger, base_dir=base_dir, ramp_step=ramp_step, ramp_interval=ramp_interval)
+
+    def pwm_init(self):
+        for name, value in (("period", 100000), ("enable", 1), ("polarity", "normal"), (self.DUTY_FILE, 0)):
+            if not os.path.exists(os.path.join(self.base_dir, name)):
+                self.write_file(name, value)
+
+    def write_duty(self, duty):
+        written = SysfsPWM.write_duty(self, duty)
+        if written:
+            # a regular file keeps the old content behind a shorter value
+            os.ftruncate(self.duty_fd, len(b"%i\n" % duty))
+        return written
+
+    def close(self):
+        SysfsPWM.close(self)
+        if self.temp_dir:
+            shutil.rmtree(self.temp_dir)
+
+
+def detect_board():
+    for path in MODEL_PATHS:
+        try:
+            with open(path) as f:
+                model = f.read().strip('\x00\n ')
+        except OSError:
+            continue
+        if 'ROCK Pi S' in model or 'Rock Pi S' in model:
+            return 'rockpis'
+        if 'ODROID' in model.upper():
+            return 'odroid'
+        return model
+    return None
+
+
+def get_pwm(charger_config, logger):
+    """
+    charger.pwm_board: auto (default), rockpis, odroid or fake
+    """
+    board = charger_config.get('pwm_board', 'auto')
+    if board == 'auto':
+        board = detect_board()
+    kwargs = {
+        'logger': logger,
+        'ramp_step': charger_config.get('pwm_ramp_step', 0.0),
+        'ramp_interval': charger_config.get('pwm_ramp_interval', 0.05),
+    }
+    if board == 'rockpis':
+        from devices.pwm_rockpis import PWM
+    elif board == 'odroid':
+        from devices.pwm_odroid import PWM
+    elif board == 'fake':
+        return FakePWM(base_dir=charger_config.get('pwm_fake_dir'), **kwargs)
+    else:
+        raise ValueError('no PWM support for board "%s", set charger.pwm_board' % board)
+    logger.info('PWM on %s' % board)
+    return PWM(**kwargs)
@@ -1,16 +1,19 @@
 import subprocess
 import sys
 
+from devices.pwm import SysfsPWM
+
 BASE_DIR = "/sys/devices/pwm-ctrl"
 BASE_VOLTAGE = 3.2
 BASE_FACTOR = 1024
 
 
-class PWM():
-    def __init__(self, logger):
-        self.load_modules()
-        self.pwm_init()
-        self.logger = logger
+class PWM(SysfsPWM):
+    BASE_DIR = BASE_DIR
+    BASE_VOLTAGE = BASE_VOLTAGE
+    BASE_FACTOR = BASE_FACTOR
+    MAX_VOLTAGE = BASE_VOLTAGE
+    DUTY_FILE = "duty0"
 
     def load_modules(self):
         modules_required = ('pwm-meson', 'pwm-ctrl')
@@ -30,23 +33,6 @@ class PWM():
                 sys.exit(1)
 
     def pwm_init(self):
-        with open("%s/freq0" % BASE_DIR, 'w') as f:
-            f.write("100000\n")
-
-        with open("%s/enable0" % BASE_DIR, 'w') as f:
-            f.write("1\n")
-
-    def set_pwm_volt(self, volt):
-        duty = BASE_FACTOR / BASE_VOLTAGE * volt
-        self.logger.debug("%s Volt (%s)" % (volt, duty))
-
-        with open("%s/duty0" % BASE_DIR, 'w') as f:
-            f.write("%s\n" % duty)
-
-    def get_pwm_volt(self):
-        with open("%s/duty0" % BASE_DIR, 'r') as f:
-            l = f.readline()
-        duty = int(l)
-        volt = round(BASE_VOLTAGE / BASE_FACTOR * duty, 2)
-
-        return volt
+        self.load_modules()
+        self.write_file("freq0", 100000)
+        self.write_file("enable0", 1)
@@ -0,0 +1,188 @@
+import select
+import socket
+import time
+
+import serial
+
+FRAME_END = 0x0d
+
+
+def calc_crc(message_bytes):
+    x = 0
+    for b in message_bytes:
+        x ^= b
+
+    return x
+
+
+class SerialTransport:
+    def __init__(self, device, baudrate=9600, timeout=2):
+        self.port = device
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.serial = None
+
+    def open(self):
+        if self.serial is None:
+            self.serial = serial.Serial(
+                port=self.port,
+                baudrate=self.baudrate,
+                bytesize=serial.EIGHTBITS,
+                parity=serial.PARITY_NONE,
+                stopbits=serial.STOPBITS_ONE,
+                timeout=self.timeout,
+                xonxoff=False,
+                rtscts=False,
+                dsrdtr=False,
+                writeTimeout=self.timeout
+            )
+        elif not self.serial.isOpen():
+            self.serial.open()
+
+    def is_open(self):
+        return self.serial is not None and self.serial.isOpen()
+
+    def close(self):
+        if self.serial is not None:
+            self.serial.close()
+
+    def reset_input_buffer(self):
+        self.serial.reset_input_buffer()
+        self.serial.reset_output_buffer()
+
+    def write(self, data):
+        return self.serial.write(data)
+
+    def read_into(self, view):
+        # block for the first byte only, then take everything that is already waiting
+        data = self.serial.read(max(1, min(self.serial.in_waiting, len(view))))
+        view[:len(data)] = data
+        return len(data)
+
+
+class TcpTransport:
+    """
+    RS485 to Ethernet gateway in transparent mode, device is given as tcp://host:port
+    """
+
+    def __init__(self, host, port, timeout=2):
+        self.host = host
+        self.port = '%s:%s' % (host, port)
+        self.tcp_port = int(port)
+        self.timeout = timeout
+        self.sock = None
+
+    def open(self):
+        if self.sock is None:
+            self.sock = socket.create_connection((self.host, self.tcp_port), timeout=self.timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def is_open(self):
+        return self.sock is not None
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _closed(self):
+        # the next request connects again
+        self.close()
+        return ConnectionResetError('connection to %s closed' % self.port)
+
+    def reset_input_buffer(self):
+        while select.select([self.sock], [], [], 0)[0]:
+            if not self.sock.recv(4096):
+                raise self._closed()
+
+    def write(self, data):
+        self.sock.sendall(data)
+        return len(data)
+
+    def read_into(self, view):
+        try:
+            n = self.sock.recv_into(view)
+        except socket.timeout:
+            return 0
+        if n == 0:
+            raise self._closed()
+        return n
+
+
+class LoopbackTransport:
+    """
+    In memory transport, every written request is passed to responder(request_bytes)
+    and the returned bytes are read back
+    """
+
+    def __init__(self, responder, port='loopback'):
+        self.responder = responder
+        self.port = port
+        self.pending = bytearray()
+        self.opened = False
+
+    def open(self):
+        self.opened = True
+
+    def is_open(self):
+        return self.opened
+
+    def close(self):
+        self.opened = False
+
+    def reset_input_buffer(self):
+        del self.pending[:]
+
+    def write(self, data):
+        response = self.responder(bytes(data))
+        if response:
+            self.pending += response
+        return len(data)
+
+    def read_into(self, view):
+        n = min(len(view), len(self.pending))
+        view[:n] = self.pending[:n]
+        del self.pending[:n]
+        return n
+
+
+class FrameReader:
+    """
+    Reads chunks into a reusable buffer and splits off the first frame that ends
+    with \\x0d and carries a valid checksum, \\x0d inside the payload is skipped
+    """
+
+    def __init__(self, size=256):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+
+    def read_frame(self, transport, min_length=4, timeout=2.0):
+        length = 0
+        search_start = min_length
+        deadline = time.monotonic() + timeout
+        while True:
+            if length == len(self.buffer):
+                return False, 'overflow'
+            n = transport.read_into(self.view[length:])
+            if n == 0:
+                if search_start > min_length:
+                    return False, 'crc'
+                return False, 'incomplete'
+            length += n
+
+            while True:
+                end = self.buffer.find(FRAME_END, search_start, length)
+                if end == -1:
+                    break
+                search_start = end + 1
+                if self.buffer[end - 1] == calc_crc(self.view[1:end - 1]):
+                    return bytes(self.view[:end]), None
+            if time.monotonic() > deadline:
+                return False, 'crc'
+
+
+def get_transport(device):
+    if device.startswith('tcp://'):
+        host, port = device[len('tcp://'):].rsplit(':', 1)
+        return TcpTransport(host=host, port=port)
+    return SerialTransport(device=device)
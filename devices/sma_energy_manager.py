@@ -3,21 +3,161 @@ import struct
 import threading
 import time
 
+from .capture import KIND_SPEEDWIRE
+from .snapshot import MeterSnapshot
+
+MULTICAST_GROUP = '239.12.255.254'
+MULTICAST_PORT = 9522
+BUFFER_SIZE = 1024
+PROTOCOL_ID = 0x6069
+DATA_START = 28
+
+U16 = struct.Struct('>H')
+U32 = struct.Struct('>I')
+U64 = struct.Struct('>Q')
+
+# OBIS measurement index and divisor of the current value, counters are divided by 3600000
+SUM_CHANNELS = {
+    'p_import': (1, 10),
+    'p_export': (2, 10),
+    'q_import': (3, 10),
+    'q_export': (4, 10),
+    's_import': (9, 10),
+    's_export': (10, 10),
+    'cos_phi': (13, 1000),
+    'frequency': (14, 1000),
+}
+PHASE_CHANNELS = {
+    'p_import': (21, 10),
+    'p_export': (22, 10),
+    'q_import': (23, 10),
+    'q_export': (24, 10),
+    's_import': (29, 10),
+    's_export': (30, 10),
+    'thd': (31, 1000),
+    'v': (32, 1000),
+    'cos_phi': (33, 1000),
+}
+PHASE_OFFSETS = (('L1', 0), ('L2', 20), ('L3', 40))
+COUNTER_CHANNELS = ('p_import', 'p_export', 'q_import', 'q_export', 's_import', 's_export')
+# fields of the fixed block layout that parse_block_bytes decodes
+DEFAULT_CHANNELS = ('p_import', 'p_export', 'q_import', 'q_export', 's_import', 's_export', 'thd', 'v', 'cos_phi')
+
+MEASUREMENT_VALUE = 4
+MEASUREMENT_COUNTER = 8
+OBIS_VERSION = 0x90
+
+
+def create_multicast_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', MULTICAST_PORT))
+    multicast_request = struct.pack("4sl", socket.inet_aton(MULTICAST_GROUP), socket.INADDR_ANY)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, multicast_request)
+    return sock
+
+
+class SpeedwireParser:
+    """
+    Walks the OBIS entries of an energy meter datagram and decodes only the selected channels.
+    The offsets of the selected channels are cached per datagram length, later datagrams are decoded
+    with one precompiled struct that also reads the OBIS headers at the cached offsets to detect a changed layout.
+    """
+
+    def __init__(self, phases=False, counter=False, channels=DEFAULT_CHANNELS):
+        # (index << 8 | type) -> (block, key, divisor, struct)
+        self.fields = {}
+        blocks = [('sum', SUM_CHANNELS, 0)]
+        if phases:
+            blocks += [(block, PHASE_CHANNELS, offset) for block, offset in PHASE_OFFSETS]
+        for block, block_channels, offset in blocks:
+            for key, (index, divisor) in block_channels.items():
+                if key not in channels:
+                    continue
+                index += offset
+                self.fields[index << 8 | MEASUREMENT_VALUE] = (block, key, divisor, U32)
+                if counter and key in COUNTER_CHANNELS:
+                    self.fields[index << 8 | MEASUREMENT_COUNTER] = (block, '%s_counter' % key, 3600000, U64)
+        self.blocks = [block for block, _, _ in blocks]
+        # length: (struct, OBIS headers, (block, key, divisor) of every value)
+        self.layouts = {}
+
+    def parse(self, view, length):
+        layout = self.layouts.get(length)
+        if layout is not None:
+            layout_struct, headers, fields = layout
+            values = layout_struct.unpack_from(view)
+            # protocol id, serial number, then OBIS header and value of every field
+            if values[0] == PROTOCOL_ID and values[2::2] == headers:
+                data = {block: {} for block in self.blocks}
+                for (block, key, divisor), value in zip(fields, values[3::2]):
+                    data[block][key] = value / divisor
+                return values[1], data
+        return self.walk(view, length)
+
+    def walk(self, view, length):
+        if length < DATA_START or U16.unpack_from(view, 16)[0] != PROTOCOL_ID:
+            return None, None
+        serial_number = U32.unpack_from(view, 20)[0]
+
+        data = {block: {} for block in self.blocks}
+        fields = self.fields
+        found = []
+        pos = DATA_START
+        while pos + 4 <= length and len(found) < len(fields):
+            if view[pos] == OBIS_VERSION:
+                pos += 8
+                continue
+            index = view[pos + 1]
+            measurement_type = view[pos + 2]
+            if measurement_type != MEASUREMENT_VALUE and measurement_type != MEASUREMENT_COUNTER:
+                # end marker or unknown entry, the size of the value is unknown
+                break
+            pos += 4
+            field = fields.get(index << 8 | measurement_type)
+            if field is not None and pos + measurement_type <= length:
+                block, key, divisor, value_struct = field
+                data[block][key] = value_struct.unpack_from(view, pos)[0] / divisor
+                found.append((pos, field))
+            pos += measurement_type
+
+        self.layouts[length] = self.compile_layout(view, found)
+        return serial_number, data
+
+    def compile_layout(self, view, found):
+        """
+        Struct, OBIS headers and fields for the offsets that walk() found
+        """
+        layout_format = ['>16xH2xI']
+        headers = []
+        fields = []
+        end = 24
+        for pos, (block, key, divisor, value_struct) in found:
+            layout_format.append('%ixI%s' % (pos - 4 - end, value_struct.format[-1]))
+            headers.append(U32.unpack_from(view, pos - 4)[0])
+            end = pos + value_struct.size
+            fields.append((block, key, divisor))
+        return struct.Struct(''.join(layout_format)), tuple(headers), tuple(fields)
+
 
 class SMAEnergyManager:
-    def __init__(self, logger):
+    def __init__(self, logger, channels=DEFAULT_CHANNELS, capture=None, replay=None):
         self.sock = None
         self.logger = logger
+        self.channels = channels
+        self.capture = capture  # CaptureWriter that records every received datagram
+        self.replay = replay  # ReplaySocket that is used instead of the multicast socket
+        self.parsers = {}
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
 
     def connect(self):
+        if self.replay:
+            self.sock = self.replay
+            return
         if self.sock:
             self.sock.close()
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind(('', 9522))
-        multicast_request = struct.pack("4sl", socket.inet_aton('239.12.255.254'), socket.INADDR_ANY)
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, multicast_request)
-        self.sock = sock
+        self.sock = create_multicast_socket()
 
     def parse_block_bytes(self, block_bytes, counter=False):
         block_data = {}
@@ -44,26 +184,31 @@ class SMAEnergyManager:
 
         return block_data
 
-    def read(self, phases, counter=False):
-        message_bytes = self.sock.recv(608)
-        serial_number = struct.unpack('>I', message_bytes[20:24])[0]
+    def get_parser(self, phases, counter):
+        parser = self.parsers.get((phases, counter))
+        if parser is None:
+            parser = SpeedwireParser(phases=phases, counter=counter, channels=self.channels)
+            self.parsers[(phases, counter)] = parser
+        return parser
 
-        if len(message_bytes) == 58:
+    def read(self, phases, counter=False):
+        length = self.sock.recv_into(self.buffer)
+        if self.capture:
+            self.capture.record(KIND_SPEEDWIRE, self.view[:length])
+        if length == 58:
             return False, False
-        elif len(message_bytes) < 558:
-            self.logger.warning("response length %i < 558 bytes, phases=%s, counter=%s" % (len(message_bytes), phases, counter))
+
+        serial_number, data = self.get_parser(phases, counter).parse(self.view, length)
+        if not data or not data['sum']:
+            self.logger.warning("no measurements in %i bytes, phases=%s, counter=%s" % (length, phases, counter))
             return False, False
 
-        data = {}
-        data['time'] = time.time()
-        data['sum'] = self.parse_block_bytes(message_bytes[32:156], counter=counter)
+        ts = time.time()
         if phases:
-            data['L1'] = self.parse_block_bytes(message_bytes[160:300], counter=counter)
-            data['L2'] = self.parse_block_bytes(message_bytes[304:444], counter=counter)
-            data['L3'] = self.parse_block_bytes(message_bytes[448:588], counter=counter)
+            data['time'] = ts
             return serial_number, data
         else:
-            data['sum']['time'] = data['time']
+            data['sum']['time'] = ts
             return serial_number, data['sum']
 
     def stop(self):
@@ -74,11 +219,12 @@ class SMAEnergyManager:
 
 
 class SMAEnergyManagerThread(threading.Thread):
-    def __init__(self, serial_number, metrics, logger):
+    def __init__(self, serial_number, metrics, logger, channels=DEFAULT_CHANNELS, live_data=None, capture=None,
+                 replay=None, aggregator=None):
         threading.Thread.__init__(self)
         self.is_running = False
         self.logger = logger
-        self.smaem = SMAEnergyManager(logger=logger)
+        self.smaem = SMAEnergyManager(logger=logger, channels=channels, capture=capture, replay=replay)
         self.data = {}
         self.start_time = None
         if serial_number:
@@ -86,7 +232,11 @@ class SMAEnergyManagerThread(threading.Thread):
         else:
             self.serial_number = None
         self.metrics = metrics
-        self.last_metrics = 0
+        self.live_data = live_data
+        self.sequence = 0
+        # metrics.WindowAggregator, every sample is aggregated and one point per window is written
+        self.aggregator = aggregator if metrics else None
+        self.new_data = threading.Condition()
 
     def stop(self):
         self.logger.info('SMAEnergyManagerThread stopping...')
@@ -98,38 +248,49 @@ class SMAEnergyManagerThread(threading.Thread):
         self.start_time = time.time()
         self.smaem.connect()
         while self.is_running:
-            serial_number, data = self.smaem.read(phases=False)
+            try:
+                serial_number, data = self.smaem.read(phases=False)
+            except EOFError:
+                self.logger.info('SMAEnergyManagerThread: end of replay')
+                break
             if data is False:
                 continue
             if self.serial_number:
-                self.data = data
-                points = []
-                data_copy = data.copy()
-                ts = data_copy['time']
-                del data_copy['time']
-                points.append({
-                    "measurement": "SMAEnergyManagerSum",
-                    "tags": {
-                        "serial_number": self.serial_number,
-                    },
-                    "time": ts,
-                    "fields": data_copy,
-                })
-                if time.time() - self.last_metrics > 5 and self.metrics:
-                    self.metrics.write_metric(points=points)
-                    self.last_metrics = time.time()
+                self.sequence += 1
+                snapshot = MeterSnapshot(self.sequence, data['time'], data)
+                self.data = snapshot
+                if self.live_data:
+                    self.live_data.publish('meter', snapshot)
+                with self.new_data:
+                    self.new_data.notify_all()
+                if self.aggregator:
+                    points = self.aggregator.add(snapshot.time, snapshot.fields())
+                    if points:
+                        self.metrics.write_metric(points=points)
             else:
                 self.data[serial_number] = data
+        if self.aggregator:
+            points = self.aggregator.flush()
+            if points:
+                self.metrics.write_metric(points=points)
         self.logger.info('SMAEnergyManagerThread stopped')
 
+    def wait_for_data(self, timeout):
+        """
+        Block until the next sample arrived, returns False after timeout seconds without a sample
+        """
+        with self.new_data:
+            return self.new_data.wait(timeout)
+
     def is_healthy(self):
         if not self.is_running:
             return False
-        if len(self.data) == 0:
+        data = self.data
+        if len(data) == 0:
             return False
-        t_diff = time.time() - self.data['time']
+        t_diff = time.time() - data['time']
         if t_diff > 120.0:
-            self.logger.warning('SMAEnergyManagerThread: no data for %s seconds' % int(time.time() - self.data['time']))
+            self.logger.warning('SMAEnergyManagerThread: no data for %s seconds' % int(t_diff))
             return False
         elif t_diff > 60.0:
             self.logger.warning('SMAEnergyManagerThread: reconnecting')
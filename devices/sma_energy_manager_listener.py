@@ -0,0 +1,173 @@
+import asyncio
+import socket
+import struct
+import time
+
+from .sma_energy_manager import DEFAULT_CHANNELS, MULTICAST_GROUP, SpeedwireParser, create_multicast_socket
+
+
+class SMAEnergyManagerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, listener):
+        self.listener = listener
+
+    def datagram_received(self, data, addr):
+        self.listener.datagram_received(data)
+
+    def error_received(self, exc):
+        self.listener.logger.warning('SMAEnergyManagerListener: %s' % exc)
+
+    def connection_lost(self, exc):
+        self.listener.connection_lost(exc)
+
+
+class SMAEnergyManagerListener:
+    """
+    Receives the energy meter multicast on an asyncio loop and pushes every sample
+    to callbacks and async iterators, optionally filtered by serial number
+    """
+
+    def __init__(self, logger, phases=False, counter=False, channels=DEFAULT_CHANNELS, timeout=30, queue_size=10):
+        self.logger = logger
+        self.phases = phases
+        self.parser = SpeedwireParser(phases=phases, counter=counter, channels=channels)
+        self.timeout = timeout
+        self.queue_size = queue_size
+        self.data = {}
+        self.callbacks = []  # (serial_number, callback)
+        self.queues = []  # (serial_number, asyncio.Queue)
+        self.transport = None
+        self.sock = None
+        self.watchdog = None
+        self.reconnecting = None
+        self.last_datagram = None
+        self.is_running = False
+
+    async def start(self):
+        self.is_running = True
+        await self.connect()
+        self.watchdog = asyncio.get_running_loop().create_task(self.watch())
+
+    async def connect(self):
+        self.close_transport()
+        sock = create_multicast_socket()
+        sock.setblocking(False)
+        self.sock = sock
+        self.transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: SMAEnergyManagerProtocol(self), sock=sock)
+        self.last_datagram = time.time()
+        self.logger.info('SMAEnergyManagerListener: listening')
+
+    def close_transport(self):
+        if self.transport is None:
+            return
+        try:
+            multicast_request = struct.pack("4sl", socket.inet_aton(MULTICAST_GROUP), socket.INADDR_ANY)
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, multicast_request)
+        except OSError:
+            pass
+        transport = self.transport
+        self.transport = None
+        transport.close()
+
+    async def watch(self):
+        while self.is_running:
+            await asyncio.sleep(self.timeout / 2)
+            if time.time() - self.last_datagram > self.timeout:
+                self.logger.warning('SMAEnergyManagerListener: no data for %i seconds, reconnecting' %
+                                    (time.time() - self.last_datagram))
+                await self.reconnect()
+
+    async def reconnect(self):
+        try:
+            await self.connect()
+        except OSError as e:
+            self.logger.error('SMAEnergyManagerListener: reconnect failed: %s' % e)
+        finally:
+            self.reconnecting = None
+
+    def connection_lost(self, exc):
+        # a transport that was closed on purpose is already detached
+        if self.transport is None or not self.is_running or self.reconnecting:
+            return
+        self.logger.warning('SMAEnergyManagerListener: connection lost (%s)' % exc)
+        self.transport = None
+        self.reconnecting = asyncio.get_running_loop().create_task(self.reconnect())
+
+    def datagram_received(self, data):
+        serial_number, blocks = self.parser.parse(memoryview(data), len(data))
+        if not blocks or not blocks['sum']:
+            return
+        self.last_datagram = ts = time.time()
+        if self.phases:
+            sample = blocks
+        else:
+            sample = blocks['sum']
+        sample['time'] = ts
+        self.data[serial_number] = sample
+
+        for subscribed_serial, callback in self.callbacks:
+            if subscribed_serial is None or subscribed_serial == serial_number:
+                try:
+                    callback(serial_number, sample)
+                except Exception as e:
+                    self.logger.error('SMAEnergyManagerListener: callback failed: %s' % e)
+        for subscribed_serial, queue in self.queues:
+            if subscribed_serial is None or subscribed_serial == serial_number:
+                if queue.full():
+                    # slow consumers get the newest samples
+                    queue.get_nowait()
+                queue.put_nowait((serial_number, sample))
+
+    def subscribe(self, callback, serial_number=None):
+        """
+        Call callback(serial_number, sample) for every sample, returns a function to unsubscribe
+        """
+        entry = (serial_number, callback)
+        self.callbacks.append(entry)
+        return lambda: self.callbacks.remove(entry)
+
+    async def samples(self, serial_number=None):
+        """
+        Async iterator over (serial_number, sample), ends when the listener is stopped
+        """
+        entry = (serial_number, asyncio.Queue(maxsize=self.queue_size))
+        self.queues.append(entry)
+        try:
+            while True:
+                item = await entry[1].get()
+                if item is None:
+                    break
+                yield item
+        finally:
+            self.queues.remove(entry)
+
+    async def stop(self):
+        self.is_running = False
+        if self.watchdog:
+            self.watchdog.cancel()
+        if self.reconnecting:
+            self.reconnecting.cancel()
+        self.close_transport()
+        for _, queue in self.queues:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(None)
+        self.logger.info('SMAEnergyManagerListener: stopped')
+
+
+if __name__ == '__main__':
+    from logger import get_logger
+
+    async def main():
+        listener = SMAEnergyManagerListener(logger=get_logger(level='info'))
+        await listener.start()
+        try:
+            async for serial_number, sample in listener.samples():
+                print(serial_number, sample['p_import'], sample['p_export'])
+        finally:
+            await listener.stop()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -5,6 +5,8 @@ import time
 import threading
 import gatt
 
+from .capture import KIND_BLE_NOTIFICATION
+
 
 class SmartBMS:
     BASE_REQUEST = 'DDA50%i00FFF%s77'
@@ -147,6 +149,8 @@ class SmartBMS:
 
 
 class AnyDevice(gatt.Device):
+    capture = None
+
     def connect_succeeded(self):
         super().connect_succeeded()
         self.logger.info("[%s] Connected" % (self.mac_address))
@@ -192,21 +196,26 @@ class AnyDevice(gatt.Device):
 
     def characteristic_value_updated(self, characteristic, value):
         # print("value:", len(value), repr(value))
-        self.response_queue.append([time.time(), value])
+        ts = time.time()
+        if self.capture:
+            self.capture.record(KIND_BLE_NOTIFICATION, bytes(value), ts)
+        self.response_queue.append([ts, value])
 
 
 class BluetoothThread(threading.Thread):
-    def __init__(self, mac_address, logger):
+    def __init__(self, mac_address, logger, capture=None):
         threading.Thread.__init__(self)
         self.is_running = False
         self.mac_address = mac_address
         self.logger = logger
+        self.capture = capture
 
     def run(self):
         self.is_running = True
         self.manager = gatt.DeviceManager(adapter_name='hci0')
         self.device = AnyDevice(mac_address=self.mac_address, manager=self.manager)
         self.device.logger = self.logger
+        self.device.capture = self.capture
         # self.is_disconnected = False
         self.device.connect()
         try:
@@ -224,9 +233,12 @@ class BluetoothThread(threading.Thread):
             self.logger.error("Writing '%s' to bluetooth device failed" % request_bytes)
             self.logger.error(e)
 
+    def stop(self):
+        self.manager.stop()
+
 
 class SmartBMSThread(threading.Thread):
-    def __init__(self, mac_address, metrics, logger):
+    def __init__(self, mac_address, metrics, logger, capture=None, cell_points=None):
         threading.Thread.__init__(self)
         self.is_running = False
         self.mac_address = mac_address
@@ -234,9 +246,13 @@ class SmartBMSThread(threading.Thread):
         self.logger = logger
         self.data = {'status': None, 'cell_voltages': None}
         self.last_run_completed = None
+        self.capture = capture  # CaptureWriter that records every notification
+        # cell_points(mac_address, cell_voltages, ts) returns the points of a sample,
+        # e.g. bms_metrics.get_cell_points(config['bms']), default: one point per cell
+        self.cell_points = cell_points
 
     def init_bt_thread(self):
-        self.bt_thread = BluetoothThread(mac_address=self.mac_address, logger=self.logger)
+        self.bt_thread = BluetoothThread(mac_address=self.mac_address, logger=self.logger, capture=self.capture)
         self.bt_thread.start()
 
     def run(self):
@@ -307,10 +323,10 @@ class SmartBMSThread(threading.Thread):
                             "time": ts,
                             "fields": data_copy,
                         })
+                    elif name == 'cell_voltages' and self.cell_points:
+                        points.extend(self.cell_points(self.mac_address, data_copy, ts))
                     elif name == 'cell_voltages':
                         for cell, voltage in data_copy.items():
-                            if cell == 'time':
-                                continue
                             points.append({
                                 "measurement": "SmartBMSCellVoltages",
                                 "tags": {
@@ -322,7 +338,7 @@ class SmartBMSThread(threading.Thread):
                             })
                     self.metrics.write_metric(points=points)
 
-            self.logger.debug('==== end of run ====', flush=True)
+            self.logger.debug('==== end of run ====')
             self.last_run_completed = time.time()
             time.sleep(15)
         self.logger.info('SmartBMSThread: stopped')
@@ -331,5 +347,5 @@ class SmartBMSThread(threading.Thread):
     def stop(self):
         self.logger.info('SmartBMSThread: stopping')
         self.is_running = False
-        self.bt_thread.manager.stop()
+        self.bt_thread.stop()
 
@@ -0,0 +1,202 @@
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+
+import requests
+from requests.auth import HTTPDigestAuth
+
+# state and power with one request
+GET_XML = ('<?xml version="1.0" encoding="utf-8"?><SMARTPLUG id="edimax"><CMD id="get">'
+           '<Device.System.Power.State></Device.System.Power.State>'
+           '<NOW_POWER><Device.System.Power.NowPower></Device.System.Power.NowPower></NOW_POWER>'
+           '</CMD></SMARTPLUG>')
+SET_STATE_XML = ('<?xml version="1.0" encoding="utf-8"?><SMARTPLUG id="edimax"><CMD id="setup">'
+                 '<Device.System.Power.State>%s</Device.System.Power.State>'
+                 '</CMD></SMARTPLUG>')
+
+
+class EdimaxSmartPlug:
+    """
+    Edimax SP-2101W on a keep-alive HTTP session, same state/now_power interface as pyedimax.SmartPlug
+    """
+
+    def __init__(self, host, auth, timeout=5):
+        self.url = "http://%s:10000/smartplug.cgi" % host
+        self.auth = auth
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers['Connection'] = 'keep-alive'
+        self.auth_checked = False
+
+    def _post(self, xml):
+        if not self.auth_checked:
+            # newer firmware uses digest auth, the digest nonce is reused by the session afterwards
+            response = self.session.head(self.url, timeout=self.timeout)
+            if response.headers.get('WWW-Authenticate', '').startswith('Digest'):
+                self.session.auth = HTTPDigestAuth(*self.auth)
+            else:
+                self.session.auth = tuple(self.auth)
+            self.auth_checked = True
+        response = self.session.post(self.url, files={'file': xml}, timeout=self.timeout)
+        response.raise_for_status()
+        return ElementTree.fromstring(response.content)
+
+    def read(self):
+        root = self._post(GET_XML)
+        state = root.findtext('CMD/Device.System.Power.State')
+        now_power = root.findtext('CMD/NOW_POWER/Device.System.Power.NowPower')
+        if state not in ('ON', 'OFF'):
+            raise ValueError('unexpected smart plug response: %s' % ElementTree.tostring(root))
+        return {
+            'time': time.time(),
+            'state': state,
+            'now_power': float(now_power) if now_power else 0.0,
+        }
+
+    def set_state(self, state):
+        root = self._post(SET_STATE_XML % state)
+        if root.findtext('CMD') != 'OK':
+            raise ValueError('smart plug did not accept state %s' % state)
+
+    @property
+    def state(self):
+        return self.read()['state']
+
+    @state.setter
+    def state(self, state):
+        self.set_state(state)
+
+    @property
+    def now_power(self):
+        return self.read()['now_power']
+
+    def close(self):
+        self.session.close()
+
+
+class SmartPlugThread(threading.Thread):
+    """
+    Polls the smart plug in the background, state and now_power are served from the last poll.
+    Data older than ttl seconds triggers an immediate poll, the caller waits at most wait_timeout for it.
+    New states are written by the thread, the state property returns them at once.
+    """
+
+    def __init__(self, plug, logger, poll_interval=5, ttl=15, wait_timeout=2, live_data=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.is_running = False
+        self.plug = plug
+        self.logger = logger
+        self.poll_interval = poll_interval
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self.live_data = live_data
+        self.data = {}
+        self.pending_state = None
+        self.errors = 0
+        self.wake = threading.Event()
+        self.new_data = threading.Condition()
+
+    def stop(self, timeout=10):
+        """
+        A state that was set but not written yet (e.g. OFF on shutdown) is written before the thread ends
+        """
+        self.logger.info('SmartPlugThread stopping...')
+        self.is_running = False
+        self.wake.set()
+        if self.is_alive():
+            if self is not threading.current_thread():
+                self.join(timeout)
+        else:
+            self.write_pending_state()
+
+    def run(self):
+        self.is_running = True
+        while self.is_running:
+            self.wake.clear()
+            state = self.pending_state
+            try:
+                if state:
+                    self.plug.set_state(state)
+                    self.logger.info('SmartPlugThread: switched %s' % state)
+                data = self.plug.read()
+            except (requests.RequestException, ElementTree.ParseError, ValueError) as e:
+                self.errors += 1
+                self.logger.warning('SmartPlugThread: %s' % e)
+            else:
+                if state and self.pending_state == state:
+                    self.pending_state = None
+                self.data = data
+                if self.live_data:
+                    self.live_data.publish('plug', {
+                        'time': data['time'],
+                        'state': 1.0 if data['state'] == 'ON' else 0.0,
+                        'now_power': data['now_power'],
+                    })
+                with self.new_data:
+                    self.new_data.notify_all()
+            self.wake.wait(self.poll_interval)
+        self.write_pending_state()
+        self.plug.close()
+        self.logger.info('SmartPlugThread stopped')
+
+    def write_pending_state(self):
+        state = self.pending_state
+        if not state:
+            return
+        try:
+            self.plug.set_state(state)
+        except (requests.RequestException, ElementTree.ParseError, ValueError) as e:
+            self.errors += 1
+            self.logger.error('SmartPlugThread: failed to switch %s: %s' % (state, e))
+            return
+        self.pending_state = None
+        self.logger.info('SmartPlugThread: switched %s' % state)
+
+    def get_data(self):
+        data = self.data
+        if not data or time.time() - data['time'] > self.ttl:
+            with self.new_data:
+                self.wake.set()
+                self.new_data.wait(self.wait_timeout)
+            data = self.data
+        return data
+
+    @property
+    def state(self):
+        if self.pending_state:
+            return self.pending_state
+        return self.get_data().get('state')
+
+    @state.setter
+    def state(self, state):
+        if state != self.data.get('state') or self.pending_state:
+            self.pending_state = state
+            self.wake.set()
+
+    @property
+    def now_power(self):
+        """
+        None if the plug was not reachable yet
+        """
+        return self.get_data().get('now_power')
+
+    def is_healthy(self):
+        if not self.is_running:
+            return False
+        data = self.data
+        if len(data) == 0:
+            return False
+        t_diff = time.time() - data['time']
+        if t_diff > 60.0:
+            self.logger.warning('SmartPlugThread: no data for %s seconds' % int(t_diff))
+            return False
+        return True
+
+
+def get_smart_plug(charger_config, logger, live_data=None):
+    plug = EdimaxSmartPlug(charger_config['smartplug_ip'],
+                           (charger_config['smartplug_username'], charger_config['smartplug_password']))
+    return SmartPlugThread(plug=plug, logger=logger,
+                           poll_interval=charger_config.get('smartplug_poll_interval', 5),
+                           ttl=charger_config.get('smartplug_ttl', 15),
+                           live_data=live_data)
@@ -0,0 +1,66 @@
+class Snapshot:
+    """
+    Immutable sample of a device, threads publish a new instance by replacing their reference,
+    readers take the reference once and get fields that belong to one sample
+    """
+    __slots__ = ('seq', 'time')
+    FIELDS = ()
+
+    def __init__(self, seq, ts, data):
+        set_field = object.__setattr__
+        set_field(self, 'seq', seq)
+        set_field(self, 'time', ts)
+        for field in self.FIELDS:
+            set_field(self, field, data.get(field))
+
+    def __setattr__(self, key, value):
+        raise AttributeError('%s is immutable' % self.__class__.__name__)
+
+    def __delattr__(self, key):
+        raise AttributeError('%s is immutable' % self.__class__.__name__)
+
+    def __getitem__(self, key):
+        if key != 'time' and key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key == 'time' or key in self.FIELDS
+
+    def __len__(self):
+        return len(self.FIELDS) + 1
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        value = getattr(self, key)
+        return default if value is None else value
+
+    def fields(self):
+        fields = {}
+        for field in self.FIELDS:
+            value = getattr(self, field)
+            if value is not None:
+                fields[field] = value
+        return fields
+
+    def to_point(self, measurement, tags):
+        return {
+            "measurement": measurement,
+            "tags": tags,
+            "time": self.time,
+            "fields": self.fields(),
+        }
+
+    def __repr__(self):
+        return '%s(seq=%s, time=%s, %s)' % (self.__class__.__name__, self.seq, self.time, self.fields())
+
+
+class MeterSnapshot(Snapshot):
+    FIELDS = ('p_import', 'p_export', 'q_import', 'q_export', 's_import', 's_export', 'cos_phi', 'frequency')
+    __slots__ = FIELDS
+
+
+class InverterSnapshot(Snapshot):
+    FIELDS = ('pv_amp', 'pv_volt', 'ac_watt', 'pv_watt', 'temperature')
+    __slots__ = FIELDS
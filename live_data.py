@@ -0,0 +1,248 @@
+import math
+import mmap
+import os
+import struct
+import time
+
+DEFAULT_PATH = '/dev/shm/esc-live-data'
+MAX_CELLS = 32
+
+# every slot is written by exactly one process, values are stored as float64
+SLOTS = (
+    ('meter', ('time', 'p_import', 'p_export', 'q_import', 'q_export', 's_import', 's_export', 'cos_phi')),
+    ('inverter', ('time', 'pv_amp', 'pv_volt', 'ac_watt', 'pv_watt', 'temperature', 'last_limit')),
+    # the pack with the lowest cell voltage, pack_count packs had fresh data
+    ('bms', ('time', 'total_voltage', 'current', 'soc_percent', 'cell_count', 'pack_count', 'min_cell_voltage')
+     + tuple('cell_%i' % cell for cell in range(1, MAX_CELLS + 1))),
+    # state: 1.0 on, 0.0 off
+    ('plug', ('time', 'state', 'now_power')),
+)
+
+HEADER = struct.Struct('<8sI4x')
+MAGIC = b'ESCLIVE1'
+SEQUENCE = struct.Struct('<I4x')
+
+
+class LiveDataLayout:
+    def __init__(self):
+        self.slots = {}
+        offset = HEADER.size
+        for name, fields in SLOTS:
+            payload = struct.Struct('<%id' % len(fields))
+            self.slots[name] = (offset, fields, payload)
+            offset += SEQUENCE.size + payload.size
+        self.size = offset
+
+
+class LiveDataWriter:
+    """
+    Publishes snapshots into a memory mapped file, readers use the sequence counter of a slot
+    as seqlock: it is odd while the slot is written
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.layout = LiveDataLayout()
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != self.layout.size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.layout.size)
+            self.mm = mmap.mmap(fd, self.layout.size)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(self.mm, 0, MAGIC, self.layout.size)
+
+    def publish(self, slot, data, extra=None):
+        offset, fields, payload = self.layout.slots[slot]
+        values = []
+        for field in fields:
+            value = data.get(field)
+            if value is None and extra:
+                value = extra.get(field)
+            values.append(math.nan if value is None else float(value))
+        sequence = SEQUENCE.unpack_from(self.mm, offset)[0]
+        if sequence % 2:
+            # a previous writer died while writing
+            sequence += 1
+        SEQUENCE.pack_into(self.mm, offset, (sequence + 1) & 0xffffffff)
+        payload.pack_into(self.mm, offset + SEQUENCE.size, *values)
+        SEQUENCE.pack_into(self.mm, offset, (sequence + 2) & 0xffffffff)
+
+    def publish_cells(self, data, cell_voltages):
+        bms = dict(data)
+        bms['cell_count'] = len(cell_voltages)
+        for cell, voltage in cell_voltages.items():
+            if int(cell) <= MAX_CELLS:
+                bms['cell_%i' % int(cell)] = voltage
+        self.publish('bms', bms)
+
+    def publish_packs(self, packs, now, max_age=60):
+        """
+        packs: mac_address: (time, data, cell_voltages) of the last update of every pack.
+        Publish the pack with the lowest cell voltage of all packs updated in the last max_age seconds
+        """
+        fresh = [pack for pack in packs.values() if now - pack[0] <= max_age and pack[2]]
+        if not fresh:
+            return
+        ts, data, cell_voltages = min(fresh, key=lambda pack: min(pack[2].values()))
+        self.publish_cells(dict(data, time=ts, pack_count=len(fresh), min_cell_voltage=min(cell_voltages.values())),
+                           cell_voltages)
+
+    def close(self):
+        self.mm.close()
+
+
+class LiveDataReader:
+    def __init__(self, path=DEFAULT_PATH):
+        self.layout = LiveDataLayout()
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, size = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or size != self.layout.size:
+            self.mm.close()
+            raise ValueError('%s has an unknown live data layout' % path)
+
+    def sequence(self, slot):
+        return SEQUENCE.unpack_from(self.mm, self.layout.slots[slot][0])[0]
+
+    def read(self, slot, retries=100):
+        """
+        Return a consistent snapshot of a slot, {} if it was never written
+        """
+        offset, fields, payload = self.layout.slots[slot]
+        for _ in range(retries):
+            before = SEQUENCE.unpack_from(self.mm, offset)[0]
+            if before == 0:
+                return {}
+            if before % 2:
+                continue
+            values = payload.unpack_from(self.mm, offset + SEQUENCE.size)
+            if SEQUENCE.unpack_from(self.mm, offset)[0] == before:
+                return {field: value for field, value in zip(fields, values) if not math.isnan(value)}
+        return {}
+
+    def close(self):
+        self.mm.close()
+
+
+class LiveDataMeter:
+    """
+    Energy meter data from the live data file, with the interface of SMAEnergyManagerThread
+    """
+
+    def __init__(self, reader, logger):
+        self.reader = reader
+        self.logger = logger
+        self.last_sequence = 0
+
+    @property
+    def data(self):
+        return self.reader.read('meter')
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def wait_for_data(self, timeout):
+        end = time.time() + timeout
+        while time.time() < end:
+            sequence = self.reader.sequence('meter')
+            if sequence != self.last_sequence and sequence % 2 == 0:
+                self.last_sequence = sequence
+                return True
+            time.sleep(0.1)
+        return False
+
+    def is_healthy(self):
+        data = self.data
+        if len(data) == 0:
+            return False
+        t_diff = time.time() - data['time']
+        if t_diff > 60.0:
+            self.logger.warning('LiveDataMeter: no data for %s seconds' % int(t_diff))
+            return False
+        return True
+
+
+class LiveDataSmartPlug:
+    """
+    Smart plug data polled by the inverter controller, with the interface of SmartPlugThread.
+    New states are written to the plug directly and returned until a newer poll was published,
+    the plug is read directly if the published data is older than max_age seconds.
+    """
+
+    def __init__(self, reader, plug, logger, max_age=30):
+        self.reader = reader
+        self.plug = plug
+        self.logger = logger
+        self.max_age = max_age
+        self.written_state = None
+        self.written_time = 0
+
+    @property
+    def data(self):
+        data = self.reader.read('plug')
+        if len(data) == 0 or time.time() - data['time'] > self.max_age:
+            try:
+                return self.plug.read()
+            except Exception as e:
+                self.logger.warning('LiveDataSmartPlug: %s' % e)
+                return {}
+        data['state'] = 'ON' if data['state'] else 'OFF'
+        return data
+
+    @property
+    def state(self):
+        data = self.data
+        if self.written_state and data.get('time', 0) <= self.written_time:
+            return self.written_state
+        return data.get('state')
+
+    @state.setter
+    def state(self, state):
+        self.plug.set_state(state)
+        self.written_state = state
+        self.written_time = time.time()
+
+    @property
+    def now_power(self):
+        return self.data.get('now_power')
+
+    def start(self):
+        pass
+
+    def stop(self):
+        self.plug.close()
+
+    def is_healthy(self):
+        return len(self.data) > 0
+
+
+def get_live_data_writer(config):
+    live_data_config = config.get('live_data', {})
+    if not live_data_config.get('enabled', False):
+        return None
+    return LiveDataWriter(path=live_data_config.get('path', DEFAULT_PATH))
+
+
+def get_live_data_reader(config):
+    live_data_config = config.get('live_data', {})
+    if not live_data_config.get('enabled', False):
+        return None
+    try:
+        return LiveDataReader(path=live_data_config.get('path', DEFAULT_PATH))
+    except (OSError, ValueError) as e:
+        print('live data not available: %s' % e)
+        return None
+
+
+if __name__ == '__main__':
+    import sys
+    from pprint import pprint
+
+    reader = LiveDataReader(path=sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PATH)
+    for name, _ in SLOTS:
+        print(name)
+        pprint(reader.read(name))
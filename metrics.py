@@ -1,11 +1,31 @@
 from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError
+from influxdb.line_protocol import make_lines
 
-import datetime
+import collections
+import threading
+import time
 import traceback
 
+from spill_log import SpillLog
+
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+# client errors that may succeed on retry, other 4xx answers are final
+RETRY_STATUS_CODES = (408, 429)
+
+
+def is_rejected(error):
+    """
+    True if InfluxDB refused the points for good, e.g. a field type conflict,
+    they must not be spilled and replayed
+    """
+    return isinstance(error, InfluxDBClientError) and error.code is not None \
+        and 400 <= error.code < 500 and error.code not in RETRY_STATUS_CODES
+
 
 class Metrics:
-    def __init__(self, database_name):
+    def __init__(self, database_name, spill_log=None, replay_rate=100):
+        # the client keeps a requests session, so all writes share one keep-alive connection
         self.client = InfluxDBClient('localhost', database=database_name, port=8086)
         self.database_name = database_name
         db_found = False
@@ -18,16 +38,360 @@ class Metrics:
             self.client.create_database(database_name)
 
         self.client.switch_database(database_name)
+        self.spill_log = spill_log
+        # write_metric is called from several device threads
+        self.spill_lock = threading.Lock()
+        self.replay_rate = replay_rate  # points per second
+        self.last_replay = time.monotonic()
+        self.spill_stats = {
+            'spilled': 0,
+            'replayed': 0,
+            'rejected': 0,
+        }
 
-    def write_metric(self, points):
+    @staticmethod
+    def _convert_time(points):
+        # integer milliseconds are passed through by the line protocol encoder,
+        # no datetime object and iso string per point
         for point in points:
-            point['time'] = datetime.datetime.fromtimestamp(point['time']).isoformat()
+            point['time'] = int(point['time'] * 1000)
+
+    def _write_points(self, points):
+        """
+        Return True if the points were written, None if InfluxDB rejected them and False if they should be retried
+        """
         try:
-            self.client.write_points(points, database=self.database_name)
+            self.client.write_points(points, time_precision='ms', database=self.database_name)
         except Exception as e:
+            if is_rejected(e):
+                print('InfluxDB rejected %i points: %s' % (len(points), e))
+                self.spill_stats['rejected'] += len(points)
+                return None
             print('faied to write metrics')
             print(e)
             print(traceback.format_exc())
+            return False
+        return True
+
+    def _spill(self, points):
+        if self.spill_log is None:
+            return
+        lines = make_lines({'points': points}, precision='ms')
+        with self.spill_lock:
+            if self.spill_log.append(lines):
+                self.spill_stats['spilled'] += len(points)
+
+    def _replay_spill_log(self):
+        if self.spill_log is None or self.spill_log.is_empty():
+            return
+        with self.spill_lock:
+            self._replay_lines()
+
+    def _replay_lines(self):
+        now = time.monotonic()
+        max_lines = int((now - self.last_replay) * self.replay_rate)
+        if max_lines < 1:
+            return
+        self.last_replay = now
+        lines = self.spill_log.read_lines(min(max_lines, self.replay_rate * 10))
+        if not lines:
+            return
+        try:
+            self.client.write_points(lines, time_precision='ms', database=self.database_name, protocol='line')
+        except Exception as e:
+            if not is_rejected(e):
+                print('failed to replay spilled metrics: %s' % e)
+                return
+            # the valid points of a partial write are stored, the lines are not replayed again
+            print('InfluxDB rejected spilled metrics: %s' % e)
+            self.spill_log.commit()
+            self.spill_stats['rejected'] += len(lines)
+            return
+        self.spill_log.commit()
+        self.spill_stats['replayed'] += len(lines)
+
+    def write_metric(self, points):
+        self._convert_time(points)
+        result = self._write_points(points)
+        if result is False:
+            self._spill(points)
+        else:
+            self._replay_spill_log()
+
+    def get_stats(self):
+        stats = dict(self.spill_stats)
+        if self.spill_log is not None:
+            stats['spill_log_size'] = self.spill_log.size()
+        return stats
+
+    def stop(self):
+        if self.spill_log is not None:
+            self.spill_log.close()
+
+
+class BufferedMetrics(Metrics):
+    """
+    Queue points in memory and write them in batches from a background thread,
+    write_metric never waits for InfluxDB
+    """
+
+    def __init__(self, database_name, batch_size=500, flush_interval=5.0, queue_size=10000,
+                 overflow_policy='drop_oldest', spill_log=None, replay_rate=100):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError('unknown overflow policy "%s"' % overflow_policy)
+        Metrics.__init__(self, database_name=database_name, spill_log=spill_log, replay_rate=replay_rate)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.stats = {
+            'queued': 0,
+            'written': 0,
+            'dropped': 0,
+            'failed': 0,
+            'flushes': 0,
+            'last_flush_latency': 0.0,
+            'max_flush_latency': 0.0,
+        }
+        self.is_running = True
+        self.writer_thread = threading.Thread(target=self._run, name='BufferedMetrics', daemon=True)
+        self.writer_thread.start()
+
+    def write_metric(self, points):
+        self._convert_time(points)
+        with self.condition:
+            for point in points:
+                if len(self.queue) >= self.queue_size:
+                    if self.overflow_policy == 'drop_newest':
+                        self.stats['dropped'] += 1
+                        continue
+                    elif self.overflow_policy == 'drop_oldest':
+                        self.queue.popleft()
+                        self.stats['dropped'] += 1
+                    else:
+                        while len(self.queue) >= self.queue_size and self.is_running:
+                            self.condition.wait(1.0)
+                self.queue.append(point)
+                self.stats['queued'] += 1
+            if len(self.queue) >= self.batch_size:
+                self.condition.notify_all()
+
+    def _take_batch(self):
+        with self.condition:
+            if len(self.queue) < self.batch_size and self.is_running:
+                self.condition.wait(self.flush_interval)
+            batch = []
+            while self.queue and len(batch) < self.batch_size:
+                batch.append(self.queue.popleft())
+            # wake up writers blocked by the 'block' overflow policy
+            self.condition.notify_all()
+        return batch
+
+    def _flush(self, batch):
+        start = time.monotonic()
+        result = self._write_points(batch)
+        latency = time.monotonic() - start
+        self.stats['flushes'] += 1
+        self.stats['last_flush_latency'] = latency
+        self.stats['max_flush_latency'] = max(self.stats['max_flush_latency'], latency)
+        if result:
+            self.stats['written'] += len(batch)
+        elif result is False:
+            self.stats['failed'] += len(batch)
+            self._spill(batch)
+        return result
+
+    def _run(self):
+        while self.is_running or self.queue:
+            batch = self._take_batch()
+            if not batch or self._flush(batch) is not False:
+                self._replay_spill_log()
+
+    def get_stats(self):
+        stats = Metrics.get_stats(self)
+        stats.update(self.stats)
+        stats['queue_depth'] = len(self.queue)
+        return stats
+
+    def stop(self, timeout=10):
+        with self.condition:
+            self.is_running = False
+            self.condition.notify_all()
+        self.writer_thread.join(timeout)
+        Metrics.stop(self)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+
+    def get_fields(self):
+        # cumulative counts like a Prometheus histogram
+        fields = {}
+        total = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            total += count
+            fields['le_%s' % bucket] = total
+        fields['le_inf'] = self.count
+        fields['count'] = self.count
+        fields['sum'] = self.sum
+        return fields
+
+
+class AggregationWindow:
+    __slots__ = ('length', 'measurement', 'start', 'count', 'sums', 'mins', 'maxs', 'integrals')
+
+    def __init__(self, length, measurement):
+        self.length = length
+        self.measurement = measurement
+        self.start = None
+        self.reset(None)
+
+    def reset(self, start):
+        self.start = start
+        self.count = 0
+        self.sums = {}
+        self.mins = {}
+        self.maxs = {}
+        self.integrals = {}
+
+    def add(self, values):
+        self.count += 1
+        for key, value in values.items():
+            if key in self.sums:
+                self.sums[key] += value
+                if value < self.mins[key]:
+                    self.mins[key] = value
+                elif value > self.maxs[key]:
+                    self.maxs[key] = value
+            else:
+                self.sums[key] = value
+                self.mins[key] = value
+                self.maxs[key] = value
+
+    def integrate(self, key, value_from, value_to, seconds):
+        # trapezoid in value hours, W -> Wh
+        self.integrals[key] = self.integrals.get(key, 0.0) + (value_from + value_to) * seconds / 7200
+
+    def to_point(self, tags):
+        fields = {'samples': self.count}
+        for key, value in self.sums.items():
+            fields[key] = round(value / self.count, 4)
+            fields['%s_min' % key] = self.mins[key]
+            fields['%s_max' % key] = self.maxs[key]
+        for key, value in self.integrals.items():
+            fields['%s_wh' % key] = round(value, 6)
+        return {
+            "measurement": self.measurement,
+            "tags": tags,
+            "time": self.start,
+            "fields": fields,
+        }
+
+
+class WindowAggregator:
+    """
+    Streaming min/max/mean of every value and the trapezoidal integral of the integrate keys
+    in wall clock aligned windows, one window per tier (seconds) in O(1) per sample.
+    add() returns one point per finished window, the point time is the start of the window.
+    The first tier is written to measurement, the others to measurement_<seconds>s.
+    Samples more than max_gap seconds apart are not integrated.
+    """
+
+    def __init__(self, measurement, tags, tiers=(60, 900), integrate=(), max_gap=10):
+        self.tags = tags
+        self.windows = [AggregationWindow(tier, measurement if i == 0 else '%s_%is' % (measurement, tier))
+                        for i, tier in enumerate(tiers)]
+        self.integrate = tuple(integrate)
+        self.max_gap = max_gap
+        self.last_time = None
+        self.last_values = None
+
+    def add(self, ts, values):
+        points = []
+        segment = None
+        if self.last_time is not None and 0 < ts - self.last_time <= self.max_gap:
+            segment = (self.last_time, self.last_values, ts, values)
+        for window in self.windows:
+            start = ts - ts % window.length
+            if window.start != start:
+                if window.count:
+                    if segment and self.last_time < start:
+                        # the part of the segment up to the window end belongs to the finished window
+                        self._integrate(window, segment, self.last_time, min(window.start + window.length, ts))
+                    points.append(window.to_point(self.tags))
+                window.reset(start)
+            if segment:
+                self._integrate(window, segment, max(self.last_time, start), ts)
+            window.add(values)
+        self.last_time = ts
+        self.last_values = values
+        return points
+
+    def _integrate(self, window, segment, seg_start, seg_end):
+        """
+        Integrate the segment between two samples from seg_start to seg_end,
+        the values at both ends are interpolated
+        """
+        seconds = seg_end - seg_start
+        if seconds <= 0:
+            return
+        time_from, values_from, time_to, values_to = segment
+        span = time_to - time_from
+        for key in self.integrate:
+            value_from = values_from.get(key)
+            value_to = values_to.get(key)
+            if value_from is None or value_to is None:
+                continue
+            slope = (value_to - value_from) / span
+            window.integrate(key, value_from + slope * (seg_start - time_from),
+                             value_from + slope * (seg_end - time_from), seconds)
+
+    def flush(self):
+        """
+        Points of the unfinished windows, e.g. on shutdown
+        """
+        points = [window.to_point(self.tags) for window in self.windows if window.count]
+        for window in self.windows:
+            window.reset(None)
+        self.last_time = None
+        self.last_values = None
+        return points
+
+
+def get_metrics(influxdb_config):
+    spill_log = None
+    if influxdb_config.get('spill_dir'):
+        spill_log = SpillLog(directory=influxdb_config['spill_dir'],
+                             segment_size=influxdb_config.get('spill_segment_size', 1024 * 1024),
+                             max_size=influxdb_config.get('spill_max_size', 64 * 1024 * 1024))
+    replay_rate = influxdb_config.get('spill_replay_rate', 100)
+
+    if not influxdb_config.get('buffered', False):
+        return Metrics(database_name=influxdb_config['database_name'], spill_log=spill_log, replay_rate=replay_rate)
+
+    return BufferedMetrics(database_name=influxdb_config['database_name'],
+                           batch_size=influxdb_config.get('batch_size', 500),
+                           flush_interval=influxdb_config.get('flush_interval', 5.0),
+                           queue_size=influxdb_config.get('queue_size', 10000),
+                           overflow_policy=influxdb_config.get('overflow_policy', 'drop_oldest'),
+                           spill_log=spill_log,
+                           replay_rate=replay_rate)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+
+import argparse
+import csv
+import itertools
+import json
+import sys
+import time
+
+import numpy as np
+import pytz
+
+from controller.charge_levels import get_charge_levels
+from logger import get_logger
+from simulation.day_replay import PARAMETERS, History, config_parameters, sweep
+
+parser = argparse.ArgumentParser(description="Replays recorded days for a grid of controller parameters")
+parser.add_argument("history", help="CSV (time;p_import;p_export;ac_watt;pv_volt;plug_power) or InfluxDB export")
+parser.add_argument("--config", help="config file with the base parameters, default config.json", type=str,
+                    default="config.json")
+parser.add_argument("--param", help="NAME=V1,V2,... or NAME=START:STOP:STEP, can be given multiple times",
+                    type=str, action="append", default=[])
+parser.add_argument("--sort", help="result column to sort by, default import_kwh", type=str, default="import_kwh")
+parser.add_argument("--top", help="show the best X configurations, default 20", type=int, default=20)
+parser.add_argument("--workers", help="processes, default: number of CPUs", type=int)
+parser.add_argument("--batch-size", help="configurations per batch, default 256", type=int, default=256)
+parser.add_argument("--csv", help="write all results to this file", type=str)
+parser.add_argument("--list-params", help="show the parameters that can be varied", action="store_true")
+
+args = parser.parse_args()
+
+with open(args.config) as f:
+    config = json.load(f)
+base = config_parameters(config)
+
+if args.list_params:
+    for name, (section, key, default) in PARAMETERS.items():
+        print('%-20s %s.%s = %s' % (name, section, key, base[name]))
+    sys.exit()
+
+grid = {}
+for param in args.param:
+    name, values = param.split('=', 1)
+    if name not in PARAMETERS:
+        print('unknown parameter %s, see --list-params' % name)
+        sys.exit(1)
+    if ':' in values:
+        start, stop, step = map(float, values.split(':'))
+        grid[name] = list(np.arange(start, stop + step / 2, step))
+    else:
+        grid[name] = [float(value) for value in values.split(',')]
+
+tz = pytz.timezone(config["general"]["time_zone"])
+if args.history.endswith('.csv'):
+    history = History.from_csv(args.history, tz)
+else:
+    history = History.from_influx_export(args.history, tz)
+print('%0.1f hours of history' % (len(history) / 3600))
+
+configurations = []
+for values in itertools.product(*grid.values()):
+    configuration = dict(base)
+    configuration.update(zip(grid.keys(), values))
+    configurations.append(configuration)
+
+start = time.monotonic()
+# charger.levels_file if it exists, like ChargeController
+levels = get_charge_levels(config.get('charger', {}), get_logger(level='info'))
+results = sweep(history, configurations, levels=levels, workers=args.workers, batch_size=args.batch_size)
+duration = time.monotonic() - start
+print('%i configurations in %0.1f seconds, %0.0f per minute' % (len(results), duration,
+                                                               len(results) / duration * 60))
+
+results.sort(key=lambda result: result[args.sort])
+columns = list(grid.keys()) + ['import_kwh', 'export_kwh', 'discharge_kwh', 'charge_kwh', 'set_limit_writes',
+                               'plug_switches']
+print(' '.join('%14s' % column[:14] for column in columns))
+for result in results[:args.top]:
+    print(' '.join('%14.3f' % result[column] for column in columns))
+
+if args.csv:
+    with open(args.csv, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0].keys()), delimiter=';')
+        writer.writeheader()
+        writer.writerows(results)
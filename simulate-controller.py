@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+
+import argparse
+import itertools
+import json
+import logging
+
+import pytz
+
+from logger import get_logger
+from simulation import LoadProfile, run_simulation
+from simulation.closed_loop import DEFAULT_PROFILE
+
+parser = argparse.ArgumentParser(description="Runs the inverter controller against a simulated house and inverter")
+parser.add_argument("--config", help="config file, default config.json", type=str, default="config.json")
+parser.add_argument("--profile", help="house load CSV (seconds or HH:MM:SS;watt), default: built-in load steps",
+                    type=str)
+parser.add_argument("--duration", help="simulated seconds, default: until the end of the profile", type=int)
+parser.add_argument("--watt-tolerance", help="values to compare", type=int, nargs='+')
+parser.add_argument("--set-limit-interval", help="values to compare", type=int, nargs='+')
+parser.add_argument("--max-increase", help="values to compare", type=int, nargs='+')
+parser.add_argument("--event-driven", help="use the event driven mode", action="store_true")
+parser.add_argument("--limit-mode", help="step (default) or pi", type=str)
+parser.add_argument("--time-constant", help="seconds until the inverter reached 63%% of a limit change, default 5",
+                    type=float, default=5.0)
+parser.add_argument("--band", help="grid power counted as converged, default 50 watt", type=float, default=50)
+parser.add_argument("--output", help="text (default), json", type=str, default="text")
+parser.add_argument("--verbose", help="show the controller output", action="store_true")
+
+args = parser.parse_args()
+
+with open(args.config) as f:
+    config = json.load(f)
+tz = pytz.timezone(config["general"]["time_zone"])
+logger = get_logger(level='debug' if args.verbose else 'error')
+if not args.verbose:
+    logging.getLogger().setLevel(logging.ERROR)
+
+if args.profile:
+    profile = LoadProfile.from_csv(args.profile)
+else:
+    profile = LoadProfile(DEFAULT_PROFILE)
+
+controller_config = config.get('inverter_controller', {})
+grid = list(itertools.product(args.watt_tolerance or [controller_config.get('watt_tolerance', 20)],
+                              args.set_limit_interval or [controller_config.get('set_limit_interval', 120)],
+                              args.max_increase or [controller_config.get('max_increase', 50)]))
+
+results = []
+for watt_tolerance, set_limit_interval, max_increase in grid:
+    run_config = dict(config)
+    run_config['inverter_controller'] = dict(controller_config, watt_tolerance=watt_tolerance,
+                                             set_limit_interval=set_limit_interval, max_increase=max_increase,
+                                             event_driven=args.event_driven)
+    if args.limit_mode:
+        run_config['inverter_controller']['limit_mode'] = args.limit_mode
+    result = run_simulation(config=run_config, logger=logger, tz=tz, profile=profile, duration=args.duration,
+                            time_constant=args.time_constant, band=args.band, verbose=args.verbose)
+    result.update({
+        'watt_tolerance': watt_tolerance,
+        'set_limit_interval': set_limit_interval,
+        'max_increase': max_increase,
+    })
+    results.append(result)
+
+if args.output == 'json':
+    print(json.dumps(results, indent=2))
+else:
+    print('%9s %9s %9s %10s %10s %10s %10s %10s %10s' % ('tolerance', 'interval', 'increase', 'import kWh',
+                                                        'export kWh', 'set_limit', 'conv. avg', 'conv. max',
+                                                        'not conv.'))
+    for result in results:
+        print('%9i %9i %9i %10.3f %10.3f %10i %10s %10s %10i' % (
+            result['watt_tolerance'], result['set_limit_interval'], result['max_increase'],
+            result['import_kwh'], result['export_kwh'], result['set_limit_writes'],
+            '-' if result['convergence_avg'] is None else '%0.0fs' % result['convergence_avg'],
+            '-' if result['convergence_max'] is None else '%0.0fs' % result['convergence_max'],
+            result['not_converged']))
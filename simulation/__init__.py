@@ -0,0 +1,2 @@
+from .clock import SimClock
+from .closed_loop import LoadProfile, run_simulation
@@ -0,0 +1,54 @@
+import contextlib
+import datetime
+import types
+
+
+class SimClock:
+    """
+    Simulated time, replaces the time module of the patched modules:
+    sleep() only advances the clock, time() and monotonic() return the simulated time
+    """
+
+    def __init__(self, start):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.now += seconds
+
+    def datetime_class(self):
+        clock = self
+
+        class SimDatetime(datetime.datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return datetime.datetime.fromtimestamp(clock.now, tz)
+
+        return SimDatetime
+
+    @contextlib.contextmanager
+    def patch(self, *modules):
+        """
+        Replace the time module and the datetime class in the given modules while the context is active
+        """
+        originals = []
+        sim_datetime = self.datetime_class()
+        for module in modules:
+            for name, replacement, kind in (('time', self, types.ModuleType), ('datetime', sim_datetime, type)):
+                if isinstance(getattr(module, name, None), kind):
+                    originals.append((module, name, getattr(module, name)))
+                    setattr(module, name, replacement)
+        try:
+            yield self
+        finally:
+            for module, name, original in originals:
+                setattr(module, name, original)
@@ -0,0 +1,303 @@
+import bisect
+import contextlib
+import datetime
+import math
+import os
+
+import controller.inverter_controller
+import devices.aeconversion_emulator
+import devices.aeconversion_inverter
+import devices.rs485
+from controller.inverter_controller import InverterController
+from devices.aeconversion_emulator import EmulatedInverter
+from devices.aeconversion_inverter import AEConversionInverter
+from devices.rs485 import LoopbackTransport
+from .clock import SimClock
+
+SIMULATED_MODULES = (controller.inverter_controller, devices.aeconversion_inverter, devices.rs485,
+                     devices.aeconversion_emulator)
+
+# house load in watt from the given second on
+DEFAULT_PROFILE = (
+    (0, 150),
+    (900, 400),
+    (1800, 250),
+    (2700, 700),
+    (3600, 180),
+    (4500, 60),
+    (5400, 320),
+)
+
+
+class LoadProfile:
+    def __init__(self, steps):
+        self.steps = sorted(steps)
+        self.offsets = [offset for offset, _ in self.steps]
+
+    def load(self, offset):
+        index = bisect.bisect_right(self.offsets, offset) - 1
+        return self.steps[max(index, 0)][1]
+
+    def duration(self):
+        # the last step is held as long as the step before
+        if len(self.offsets) < 2:
+            return 3600
+        return self.offsets[-1] + self.offsets[-1] - self.offsets[-2]
+
+    @staticmethod
+    def from_csv(path):
+        """
+        One step per line: seconds or HH:MM:SS since the start;watt
+        """
+        steps = []
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                offset, watt = line.split(';')[:2]
+                if ':' in offset:
+                    h, m, s = offset.split(':')
+                    offset = int(h) * 3600 + int(m) * 60 + float(s)
+                steps.append((float(offset), float(watt)))
+        return LoadProfile(steps)
+
+
+class LaggingInverter(EmulatedInverter):
+    """
+    Emulated inverter whose AC power follows limit changes with a first order lag,
+    it only feeds in while the AC relay is on
+    """
+
+    def __init__(self, inverter_id, time_constant=5.0, **kwargs):
+        EmulatedInverter.__init__(self, inverter_id, **kwargs)
+        self.time_constant = time_constant
+        self.enabled = False
+        self.output = 0.0
+
+    def target_watt(self):
+        if not self.enabled:
+            return 0.0
+        return EmulatedInverter.ac_watt(self)
+
+    def ac_watt(self):
+        return self.output
+
+    def advance(self, seconds):
+        target = self.target_watt()
+        if self.time_constant <= 0:
+            self.output = target
+        else:
+            self.output += (target - self.output) * (1 - math.exp(-seconds / self.time_constant))
+
+
+class SimRelay:
+    def __init__(self, inverter):
+        self.inverter = inverter
+
+    def get_state(self):
+        return int(self.inverter.enabled)
+
+    def set_state(self, state):
+        self.inverter.enabled = bool(state)
+
+
+class SimSmartPlug:
+    state = 'OFF'
+
+
+class NullMetrics:
+    def write_metric(self, points):
+        pass
+
+    def get_stats(self):
+        return {}
+
+    def stop(self):
+        pass
+
+
+class SimMeter:
+    """
+    Grid meter with the interface of SMAEnergyManagerThread, every wait_for_data advances the simulation
+    """
+
+    def __init__(self, world, interval=1.0):
+        self.world = world
+        self.interval = interval
+        self.data = {}
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def is_healthy(self):
+        return len(self.data) > 0
+
+    def wait_for_data(self, timeout):
+        self.world.clock.sleep(self.interval)
+        self.world.update()
+        return True
+
+
+class SimInverterThread:
+    """
+    AEConversionInverter on a loopback transport with the interface of AEConversionInverterThread,
+    queued commands are executed at once
+    """
+
+    def __init__(self, world, inverter_id, poll_interval=10):
+        self.world = world
+        self.poll_interval = poll_interval
+        self.inverter = AEConversionInverter(device='simulation', inverter_id=inverter_id, request_retries=2,
+                                             verbose=False,
+                                             transport=LoopbackTransport(world.inverter.handle_request))
+        self.data = {}
+        self.last_poll = None
+
+    def start(self):
+        self.inverter.connect()
+        self.poll()
+
+    def stop(self):
+        pass
+
+    def poll(self):
+        data = self.inverter.get_data()
+        if data is not False:
+            self.data = data
+        self.last_poll = self.world.clock.time()
+
+    def queue_command(self, command, args):
+        if command == 'set_limit':
+            self.inverter.set_limit(**args)
+        elif command == 'request_energy':
+            self.inverter.request_energy(**args)
+
+    def is_healthy(self):
+        return len(self.data) > 0 and self.world.clock.time() - self.data['time'] < 60
+
+
+class SimWorld:
+    """
+    House load, grid meter and inverter, integrates the grid energy between two meter samples
+    and measures how long the controller needs to get back into the band after a load step
+    """
+
+    def __init__(self, clock, profile, inverter, duration, band=50, hold=30):
+        self.clock = clock
+        self.start = clock.time()
+        self.profile = profile
+        self.inverter = inverter
+        self.duration = duration
+        self.band = band
+        self.hold = hold
+        self.meter = SimMeter(world=self)
+        self.relay = SimRelay(inverter)
+        self.inverter_thread = None
+        self.controller = None
+        self.last_update = self.start
+        self.grid_watt = 0.0
+        self.import_wh = 0.0
+        self.export_wh = 0.0
+        self.in_band_since = None
+        self.step_index = 0
+        self.convergence = [None] * len(profile.steps)
+
+    def update(self):
+        now = self.clock.time()
+        seconds = now - self.last_update
+        self.last_update = now
+        if self.grid_watt > 0:
+            self.import_wh += self.grid_watt * seconds / 3600
+        else:
+            self.export_wh -= self.grid_watt * seconds / 3600
+
+        self.inverter.advance(seconds)
+        offset = now - self.start
+        self.grid_watt = self.profile.load(offset) - self.inverter.ac_watt()
+        self.meter.data = {
+            'time': now,
+            'p_import': max(self.grid_watt, 0.0),
+            'p_export': max(-self.grid_watt, 0.0),
+        }
+
+        while self.step_index + 1 < len(self.profile.offsets) and offset >= self.profile.offsets[self.step_index + 1]:
+            self.step_index += 1
+            self.in_band_since = None
+        if abs(self.grid_watt) <= self.band:
+            if self.in_band_since is None:
+                self.in_band_since = now
+            elif now - self.in_band_since >= self.hold and self.convergence[self.step_index] is None:
+                self.convergence[self.step_index] = self.in_band_since - self.start - self.profile.offsets[
+                    self.step_index]
+        else:
+            self.in_band_since = None
+
+        if self.inverter_thread and now - self.inverter_thread.last_poll >= self.inverter_thread.poll_interval:
+            self.inverter_thread.poll()
+        if offset >= self.duration and self.controller:
+            self.controller.is_running = False
+
+
+class SimulatedInverterController(InverterController):
+    """
+    InverterController with the simulated meter, inverter, relay and smart plug of a SimWorld
+    """
+
+    def __init__(self, config, logger, tz, world):
+        self.config = config
+        self.logger = logger
+        self.tz = tz
+        self.metrics = NullMetrics()
+        self.live_data = None
+        self.live_data_reader = None
+        self.energy_meter = world.meter
+        self.battery_inverter = world.inverter_thread
+        self.smart_plug = SimSmartPlug()
+        self.battery_inverter_relay_ac = world.relay
+        self.configure(config.get('inverter_controller', {}))
+        self.is_running = False
+
+
+def run_simulation(config, logger, tz, profile, start_time=None, duration=None, time_constant=5.0, band=50,
+                   hold=30, verbose=False):
+    """
+    Run the inverter controller against the simulated house and return the results
+    """
+    if start_time is None:
+        # after the charging hours, when the controller discharges the battery
+        start_time = tz.localize(datetime.datetime(2024, 1, 15, 18, 0)).timestamp()
+    if duration is None:
+        duration = profile.duration()
+    battery = config['battery']
+    clock = SimClock(start_time)
+    with clock.patch(*SIMULATED_MODULES):
+        inverter = LaggingInverter(config['aeconversion_inverter']['inverter_id'], time_constant=time_constant,
+                                   pv_watt=battery['max_discharge_watt'] * 2,
+                                   pv_volt=battery['min_voltage'] + (battery['max_voltage'] - battery[
+                                       'min_voltage']) * 0.6)
+        world = SimWorld(clock=clock, profile=profile, inverter=inverter, duration=duration, band=band, hold=hold)
+        # AEConversionInverter reports every limit on stdout
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull) if not verbose \
+                else contextlib.nullcontext():
+            world.inverter_thread = SimInverterThread(world=world, inverter_id=inverter.inverter_id,
+                                                      poll_interval=config['aeconversion_inverter'].get(
+                                                          'poll_interval', 10))
+            world.inverter_thread.start()
+            world.update()
+            world.controller = SimulatedInverterController(config=config, logger=logger, tz=tz, world=world)
+            world.controller.loop()
+
+    converged = [seconds for seconds in world.convergence[1:] if seconds is not None]
+    return {
+        'import_kwh': world.import_wh / 1000,
+        'export_kwh': world.export_wh / 1000,
+        'set_limit_writes': inverter.requests.get(0x03fe, 0),
+        'convergence': world.convergence[1:],
+        'convergence_avg': sum(converged) / len(converged) if converged else None,
+        'convergence_max': max(converged) if converged else None,
+        'not_converged': len(world.convergence) - 1 - len(converged),
+    }
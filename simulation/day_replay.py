@@ -0,0 +1,325 @@
+"""
+Offline replay of recorded meter, inverter and smart plug data for parameter sweeps.
+
+The house load is reconstructed from the history (grid balance + inverter output - charger power),
+the decision logic of InverterController and ChargeController is then evaluated for a whole batch
+of configurations at once: every array holds one value per configuration and the time loop only
+steps over the controller loop intervals. Simplifications against the real controllers:
+- limits and charger levels take effect immediately, the battery voltage is taken from the history
+- the inverter goes idle below battery.min_voltage instead of lowering its limit in steps
+- the charger draws the watt of its level, capped by the charger_acceptance column if the history has one
+"""
+import concurrent.futures
+import datetime
+import math
+import re
+
+import numpy as np
+
+from controller.charge_levels import ChargeLevels
+
+COLUMNS = ('p_import', 'p_export', 'ac_watt', 'pv_volt', 'plug_power', 'charger_acceptance')
+
+# measurement and field of the metrics that are written by the services
+INFLUX_FIELDS = {
+    ('SMAEnergyManagerSum', 'p_import'): 'p_import',
+    ('SMAEnergyManagerSum', 'p_export'): 'p_export',
+    ('AEConversionInverterData', 'ac_watt'): 'ac_watt',
+    ('AEConversionInverterData', 'pv_volt'): 'pv_volt',
+    ('ChargeController', 'power_real'): 'plug_power',
+}
+
+# name: (config section, config key, default)
+PARAMETERS = {
+    'watt_tolerance': ('inverter_controller', 'watt_tolerance', 20),
+    'set_limit_interval': ('inverter_controller', 'set_limit_interval', 120),
+    'max_increase': ('inverter_controller', 'max_increase', 50),
+    'loop_interval': ('inverter_controller', 'loop_interval', 30),
+    'watt_inverter_start': ('inverter_controller', 'watt_inverter_start', 100),
+    'inverter_max_watt': ('aeconversion_inverter', 'max_watt', 500),
+    'min_voltage': ('battery', 'min_voltage', 46.2),
+    'max_voltage': ('battery', 'max_voltage', 57.4),
+    'max_discharge_watt': ('battery', 'max_discharge_watt', 500),
+    'start_watt_limit': ('charger', 'start_watt_limit', 600),
+    'off_watt_limit': ('charger', 'off_watt_limit', 100),
+    'start_hour': ('charger', 'start_hour', 8),
+    'sleep_hour': ('charger', 'sleep_hour', 19),
+    'watt_reserved': ('charger', 'watt_reserved', 50),
+    'charge_interval': ('charger', 'loop_interval', 30),
+    'off_delay': ('charger', 'off_delay', 300),
+}
+
+
+class History:
+    """
+    1 Hz series of one or more days, missing seconds are filled with the previous value
+    """
+
+    def __init__(self, time, columns, tz):
+        self.time = time
+        self.tz = tz
+        for name in COLUMNS:
+            setattr(self, name, columns.get(name))
+        if self.charger_acceptance is None:
+            self.charger_acceptance = np.full(len(time), np.inf)
+        for name in COLUMNS:
+            if getattr(self, name) is None:
+                setattr(self, name, np.zeros(len(time)))
+        self.load = self.p_import - self.p_export + self.ac_watt - self.plug_power
+        self._local_time()
+
+    def __len__(self):
+        return len(self.time)
+
+    def _local_time(self):
+        # the utc offset only changes on full hours
+        hours = np.arange(self.time[0] - self.time[0] % 3600, self.time[-1] + 3600, 3600)
+        offsets = np.array([datetime.datetime.fromtimestamp(ts, self.tz).utcoffset().total_seconds()
+                            for ts in hours])
+        local = self.time + offsets[((self.time - hours[0]) // 3600).astype(int)]
+        self.hour = ((local % 86400) // 3600).astype(np.int8)
+        day_hour = (local // 3600).astype(np.int64)
+        # ChargeController.sleep_until_tomorrow wakes up at 4:00 of the next day
+        wake_keys = (local // 86400 + 1).astype(np.int64) * 24 + 4
+        self.wake_index = np.searchsorted(day_hour, wake_keys)
+
+    @staticmethod
+    def resample(series, tz, start=None, end=None):
+        """
+        series: {column: (timestamps, values)}
+        """
+        first = min(times[0] for times, _ in series.values())
+        last = max(times[-1] for times, _ in series.values())
+        start = math.floor(first if start is None else start)
+        end = math.ceil(last if end is None else end)
+        time = np.arange(start, end, 1.0)
+        columns = {}
+        for name, (times, values) in series.items():
+            index = np.searchsorted(times, time, side='right') - 1
+            columns[name] = np.asarray(values, dtype=float)[np.maximum(index, 0)]
+        return History(time, columns, tz)
+
+    @staticmethod
+    def from_csv(path, tz):
+        """
+        CSV with a header line, separated by ; or , and a time column in seconds since the epoch
+        """
+        with open(path) as f:
+            header = f.readline().strip()
+        delimiter = ';' if ';' in header else ','
+        names = [name.strip() for name in header.split(delimiter)]
+        data = np.genfromtxt(path, delimiter=delimiter, skip_header=1, dtype=float, ndmin=2)
+        data = data[np.argsort(data[:, names.index('time')])]
+        times = data[:, names.index('time')]
+        series = {name: (times, data[:, i]) for i, name in enumerate(names) if name in COLUMNS}
+        return History.resample(series, tz)
+
+    @staticmethod
+    def from_influx_export(path, tz):
+        """
+        Line protocol as written by influx_inspect export or the spill log
+        """
+        line_re = re.compile(r'^([^, ]+)(?:,\S*)? (\S+) (\d+)$')
+        points = {name: [] for name in INFLUX_FIELDS.values()}
+        with open(path) as f:
+            for line in f:
+                match = line_re.match(line.strip())
+                if not match:
+                    continue
+                measurement, fields, ts = match.groups()
+                ts = int(ts)
+                # ns, us, ms or s precision
+                while ts > 1e11:
+                    ts /= 1000
+                for field in fields.split(','):
+                    key, _, value = field.partition('=')
+                    name = INFLUX_FIELDS.get((measurement, key))
+                    if name:
+                        points[name].append((ts, float(value.rstrip('i'))))
+        series = {}
+        for name, values in points.items():
+            if values:
+                values.sort()
+                series[name] = (np.array([ts for ts, _ in values]), np.array([value for _, value in values]))
+        return History.resample(series, tz)
+
+
+def config_parameters(config):
+    parameters = {}
+    for name, (section, key, default) in PARAMETERS.items():
+        parameters[name] = config.get(section, {}).get(key, default)
+    return parameters
+
+
+def evaluate(history, configurations, levels=None):
+    """
+    Replay the history for a list of parameter dicts, returns one result dict per configuration.
+    levels are the ChargeLevels of the charger, default: the built-in table
+    """
+    n = len(configurations)
+    p = {name: np.array([float(configuration[name]) for configuration in configurations])
+         for name in PARAMETERS}
+    loop_interval = p['loop_interval'].astype(int)
+    charge_interval = p['charge_interval'].astype(int)
+    tick = math.gcd(*loop_interval, *charge_interval)
+    if levels is None:
+        levels = ChargeLevels()
+    level_watts = np.array(levels.watts)
+    level_volts = np.array(levels.volts)
+    full_power = levels.full_power
+
+    # inverter
+    inverter_on = np.zeros(n, dtype=bool)
+    limit = np.zeros(n)
+    last_change = np.full(n, -np.inf)
+    inverter_watt = np.zeros(n)
+    set_limit_writes = np.zeros(n, dtype=int)
+    # charger
+    plug_on = np.zeros(n, dtype=bool)
+    charger_watt = np.zeros(n)
+    sleep_until = np.zeros(n, dtype=int)
+    throttle_timer = np.full(n, np.nan)
+    throttle_last_try = np.zeros(n)
+    plug_switches = np.zeros(n, dtype=int)
+
+    import_wh = np.zeros(n)
+    export_wh = np.zeros(n)
+    discharge_wh = np.zeros(n)
+    charge_wh = np.zeros(n)
+
+    load = history.load
+    for i in range(0, len(history), tick):
+        t = history.time[i]
+        hour = history.hour[i]
+        grid = load[i] - inverter_watt + charger_watt
+        em_import = np.maximum(grid, 0)
+        em_export = np.maximum(-grid, 0)
+
+        # InverterController.loop_run
+        due = (i % loop_interval) == 0
+        if due.any():
+            pv_volt = history.pv_volt[i]
+            battery_level = 100 / (p['max_voltage'] - p['min_voltage']) * (pv_volt - p['min_voltage'])
+            max_discharge = np.where(battery_level < 20, p['max_discharge_watt'] / 2, p['max_discharge_watt'])
+            battery_ok = pv_volt > p['min_voltage']
+            too_much_export = em_export > p['inverter_max_watt']
+            low_limit = limit == 10
+            go_off = due & (~battery_ok | too_much_export | low_limit)
+            inverter_on &= ~go_off
+            limit = np.where(due & low_limit & battery_ok & ~too_much_export, 0, limit)
+
+            active = due & ~go_off & inverter_on & (inverter_watt > 0)
+            charging_time = 11 < hour < 16
+            start = (due & ~go_off & ~active & ~plug_on & (battery_level > 25)
+                     & (em_import > p['watt_inverter_start']))
+            if charging_time:
+                start[:] = False
+            inverter_on |= start
+            limit = np.where(start, 100, limit)
+            last_change = np.where(start, t, last_change)
+            set_limit_writes += start
+
+            # AEConversionInverter.request_energy
+            balanced = em_export + em_import < p['watt_tolerance']
+            request = active & (~balanced | (t - last_change > 240))
+            used_watt = em_import - em_export + inverter_watt
+            watt_max = np.minimum(max_discharge, p['inverter_max_watt'])
+            capped = (limit > 0) & (watt_max > limit) & (watt_max - limit > p['max_increase'])
+            watt_max = np.where(capped, limit + p['max_increase'], watt_max)
+            calculated = np.minimum(used_watt + p['watt_tolerance'], watt_max)
+            force = (calculated < 0) & (limit != 10)
+            calculated = np.where(calculated < 0, 10, calculated)
+            in_tolerance = (limit > 0) & (np.abs(calculated - limit) <= p['watt_tolerance']) & ~force
+            waiting = t - last_change < p['set_limit_interval']
+            change = request & ~in_tolerance & ~waiting
+            limit = np.where(change, calculated, limit)
+            last_change = np.where(change, t, last_change)
+            set_limit_writes += change
+            inverter_watt = np.where(inverter_on, np.minimum(limit, p['inverter_max_watt']), 0)
+            grid = load[i] - inverter_watt + charger_watt
+            em_import = np.maximum(grid, 0)
+            em_export = np.maximum(-grid, 0)
+
+        # ChargeController.loop
+        due = ((i % charge_interval) == 0) & (i >= sleep_until)
+        if due.any():
+            balance = em_export - em_import
+            turn_on = due & ~plug_on & (hour >= p['start_hour']) & (balance > p['start_watt_limit'])
+            go_sleep = due & ~plug_on & ~turn_on & (hour >= p['sleep_hour'])
+            sleep_until = np.where(go_sleep, history.wake_index[i], sleep_until)
+            plug_on |= turn_on
+            plug_switches += turn_on
+            throttle_timer = np.where(turn_on, np.nan, throttle_timer)
+            throttle_last_try = np.where(turn_on, 0, throttle_last_try)
+
+            running = due & plug_on
+            available = balance - p['watt_reserved'] + charger_watt
+            # Throttler.trigger of the off throttler
+            full = running & (10 < charger_watt) & (charger_watt < p['off_watt_limit'])
+            restart = full & (np.isnan(throttle_timer) | (t - throttle_last_try > p['off_delay'] * 2))
+            fire = full & ~restart & (t - throttle_timer > p['off_delay'])
+            wait = full & ~restart & ~fire
+            throttle_timer = np.where(restart, t, np.where(fire, np.nan, throttle_timer))
+            throttle_last_try = np.where(restart | wait, t, np.where(fire, 0, throttle_last_try))
+            sleep_until = np.where(fire, history.wake_index[i], sleep_until)
+
+            # ChargeController.set_output_current with ChargeLevels.lookup, the charger draws the watt
+            # of the volt that was rounded down
+            too_low = running & ~fire & (available < level_watts[0])
+            plug_off = fire | too_low
+            plug_on &= ~plug_off
+            plug_switches += plug_off
+            volt = np.floor(np.interp(available, level_watts, level_volts) * 100) / 100
+            level = np.interp(volt, level_volts, level_watts)
+            if full_power:
+                level = np.where(available >= full_power[0], full_power[0], level)
+            charger_watt = np.where(plug_on, np.where(running, np.minimum(level, history.charger_acceptance[i]),
+                                                      charger_watt), 0)
+
+        window = load[i:i + tick]
+        grid = window[None, :] - inverter_watt[:, None] + charger_watt[:, None]
+        import_wh += np.maximum(grid, 0).sum(axis=1) / 3600
+        export_wh += np.maximum(-grid, 0).sum(axis=1) / 3600
+        discharge_wh += inverter_watt * len(window) / 3600
+        charge_wh += charger_watt * len(window) / 3600
+
+    results = []
+    for x, configuration in enumerate(configurations):
+        result = dict(configuration)
+        result.update({
+            'import_kwh': float(import_wh[x] / 1000),
+            'export_kwh': float(export_wh[x] / 1000),
+            'discharge_kwh': float(discharge_wh[x] / 1000),
+            'charge_kwh': float(charge_wh[x] / 1000),
+            'set_limit_writes': int(set_limit_writes[x]),
+            'plug_switches': int(plug_switches[x]),
+        })
+        results.append(result)
+    return results
+
+
+_history = None
+
+
+def _init_worker(history):
+    global _history
+    _history = history
+
+
+def _evaluate_batch(configurations, levels):
+    return evaluate(_history, configurations, levels)
+
+
+def sweep(history, configurations, levels=None, workers=None, batch_size=256):
+    """
+    Evaluate the configurations in batches on a process pool, every worker receives the history once
+    """
+    # configurations with the same intervals share the loop ticks
+    configurations = sorted(configurations, key=lambda c: (c['loop_interval'], c['charge_interval']))
+    batches = [configurations[i:i + batch_size] for i in range(0, len(configurations), batch_size)]
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                initargs=(history,)) as executor:
+        for batch_results in executor.map(_evaluate_batch, batches, [levels] * len(batches)):
+            results.extend(batch_results)
+    return results
@@ -8,6 +8,8 @@ import datetime
 from texttable import Texttable
 
 from devices import SMAEnergyManager
+from devices.capture import CaptureWriter, ReplaySocket
+from logger import get_logger
 
 parser = argparse.ArgumentParser()
 
@@ -18,10 +20,37 @@ parser.add_argument("-s", "--serial-number",
 parser.add_argument("--check", help="Nagios style check", action="store_true")
 parser.add_argument("--output", help="text (default), csv, json output for show commands", type=str, default="text")
 parser.add_argument("--loop", help="Endless loop, CTL+C to stop", action="store_true")
+parser.add_argument("--record", help="Record all received datagrams to a capture file", type=str)
+parser.add_argument("--replay", help="Read datagrams from a capture file instead of the network", type=str)
+parser.add_argument("--speed", help="Replay speed factor, 0 for no delay, default 1", type=float, default=1.0)
+parser.add_argument("--benchmark", help="Decode all datagrams of the replay file and show the throughput",
+                    action="store_true")
 
 args = parser.parse_args()
 
-em = SMAEnergyManager()
+logger = get_logger(level='info')
+capture = CaptureWriter(args.record) if args.record else None
+replay = ReplaySocket(args.replay, speed=args.speed) if args.replay else None
+em = SMAEnergyManager(logger=logger, capture=capture, replay=replay)
+em.connect()
+
+if args.benchmark:
+    if not args.replay:
+        print('--benchmark requires --replay')
+        sys.exit(1)
+    replay.clock.speed = 0
+    packets = 0
+    start = time.perf_counter()
+    while True:
+        try:
+            sn, em_data = em.read(phases=True, counter=True)
+        except EOFError:
+            break
+        packets += 1
+    duration = time.perf_counter() - start
+    print("%i datagrams in %0.3f seconds, %0.1f us per datagram" % (packets, duration,
+                                                                  duration / max(packets, 1) * 1000000))
+    sys.exit()
 if args.serial_number:
     header = ['Time', 'External power supply', 'Grid feed-in']
 else:
@@ -76,5 +105,8 @@ while True:
             break
         if not args.loop:
             break
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, EOFError):
         break
+
+if capture:
+    capture.close()
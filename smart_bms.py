@@ -1,134 +1,157 @@
 #!/usr/bin/python3
+import argparse
+import asyncio
+import multiprocessing
 import time
+
 from cysystemd.daemon import notify, Notification
 
-from dalybms import DalyBMSBluetooth
-from devices.gpio import GpioPin
+from bms_metrics import cell_voltage_points, get_cell_schema
+from controller.cell_protection import get_cell_protection
+from devices.capture import CaptureWriter
+from devices.daly_bms import CMD_CELL_VOLTAGES, DalyBMSPack, ReplayClient
+from devices.gpio import get_gpio_pin
 from logger import get_logger
-from metrics import Metrics
+from metrics import get_metrics
+from live_data import get_live_data_writer
 
 from config import config
 
+parser = argparse.ArgumentParser(description="Reads the Daly BMS of all battery packs")
+parser.add_argument("--capture", help="record all BLE notifications to this file", type=str)
+parser.add_argument("--replay", help="answer the requests of the first pack from a capture file", type=str)
+args = parser.parse_args()
+
 logger = get_logger(level='info')
-received_data = False
 time.sleep(3)
 
-battery_inverter_relay_ac = GpioPin(pin=config['aeconversion_inverter']['gpio_pin'])
+battery_inverter_relay_ac = get_gpio_pin(pin=config['aeconversion_inverter']['gpio_pin'],
+                                         backend=config['aeconversion_inverter'].get('gpio_backend', 'sysfs'))
+live_data = get_live_data_writer(config)
+# one pack per MAC address, all packs are polled concurrently from one event loop
+mac_addresses = config['bms'].get('mac_addresses') or [config['bms']['mac_address']]
+cell_schema = get_cell_schema(config['bms'])
 
-import asyncio
-import multiprocessing
 
-class DalyBMSConnection():
-    def __init__(self, mac_address, logger, metrics_queue):
+class BMSMonitor:
+    def __init__(self, logger, metrics_queue, capture=None, client_factory=None):
         self.logger = logger
-        self.bt_bms = DalyBMSBluetooth(logger=logger)
-        self.mac_address = mac_address
         self.metrics_queue = metrics_queue
-        self.last_data_received = None
-
-    async def connect(self):
-        await self.bt_bms.connect(mac_address=self.mac_address)
-
-    async def update_cell_voltages(self):
-        cell_voltages = await self.bt_bms.get_cell_voltages()
-        logger.debug(cell_voltages)
-        points = []
-
-        if not cell_voltages:
-            logger.warning("failed to receive cell voltages")
-            return
-        cell_voltages_time = time.time()
-        for cell, voltage in cell_voltages.items():
-            points.append({
-                "measurement": "SmartBMSCellVoltages",
-                "tags": {
-                    "mac_address": self.mac_address,
-                    "cell": cell,
-                },
-                "time": cell_voltages_time,
-                "fields": {'voltage': voltage},
-            })
-
-            if voltage < 2.9 and battery_inverter_relay_ac.get_state() == 1:
-                logger.warning(f"voltage {voltage} of cell {cell} is low, turning off inverter")
-                battery_inverter_relay_ac.set_state(False)
-        self.last_data_received = time.time()
-        self.metrics_queue.put(points)
-
+        # checks every cell voltage frame when it arrives, not only the complete update
+        self.protection = get_cell_protection(config['bms'], relay=battery_inverter_relay_ac, logger=logger,
+                                              on_trip=self.protection_tripped)
+        self.packs = [DalyBMSPack(mac_address=mac_address, logger=logger, callback=self.update,
+                                  interval=config['bms'].get('interval', 10), capture=capture,
+                                  client_factory=client_factory, frame_listener=self.check_frame)
+                      for mac_address in mac_addresses]
+        self.received_data = False
+        # last update of every pack for the live data
+        self.latest = {}
+
+    def check_frame(self, mac_address, command, data, received):
+        if command == CMD_CELL_VOLTAGES:
+            self.protection.check_frame(mac_address, data, received)
+
+    def protection_tripped(self, mac_address, cell, voltage, latency):
+        fields = self.protection.get_fields()
+        fields['cell'] = cell
+        fields['latency'] = latency
+        if voltage is not None:
+            fields['voltage'] = voltage
+        self.metrics_queue.put([{
+            "measurement": "SmartBMSProtection",
+            "tags": {
+                "mac_address": mac_address,
+            },
+            "time": time.time(),
+            "fields": fields,
+        }])
 
-    async def update_soc(self):
-        soc = await self.bt_bms.get_soc()
-        self.logger.debug(soc)
-        if not soc:
-            logger.warning("failed to receive SOC")
-            return
-        point = {
+    async def update(self, pack, soc, status, cell_voltages):
+        ts = time.time()
+        self.logger.debug("%s %s %s" % (soc, status, cell_voltages))
+        points = [{
             "measurement": "SmartBMSStatus",
             "tags": {
-                "mac_address": self.mac_address,
+                "mac_address": pack.mac_address,
             },
-            "time": time.time(),
-            "fields": soc,
-        }
-        self.metrics_queue.put([point])
-        self.last_data_received = time.time()
-
-
-async def main(con):
-    logger.info("Connecting")
-    await con.connect()
-    logger.info("Starting loop")
-    received_data = False
-    while con.bt_bms.client.is_connected:
-        logger.debug("run start")
-        await con.update_soc()
-        await con.update_cell_voltages()
-        #all = await con.bt_bms.get_all()
-        #print(all)
-
-        if con.last_data_received is None:
-            logger.warning("Failed receive data")
+            "time": ts,
+            "fields": dict(soc, **status),
+        }]
+        points.extend(cell_voltage_points(pack.mac_address, cell_voltages, ts, schema=cell_schema))
+        self.metrics_queue.put(points)
+        if live_data:
+            # the controller has to see a low cell of any pack
+            self.latest[pack.mac_address] = (ts, soc, cell_voltages)
+            live_data.publish_packs(self.latest, ts)
+
+    async def watchdog(self):
+        while any(pack.is_running for pack in self.packs):
+            fresh = 0
+            for pack in self.packs:
+                if pack.last_data_received is None:
+                    continue
+                time_diff = time.time() - pack.last_data_received
+                if time_diff > 60:
+                    self.logger.error("[%s] no data for %0.1f seconds" % (pack.mac_address, time_diff))
+                else:
+                    fresh += 1
+            if fresh:
+                if not self.received_data:
+                    self.logger.info("First received data")
+                    notify(Notification.READY)
+                    self.received_data = True
+                # a pack that is out of range reconnects by itself, don't restart the others
+                notify(Notification.WATCHDOG)
             await asyncio.sleep(10)
-            continue
-        time_diff = time.time() - con.last_data_received
-        if time_diff > 30:
-            logger.error("BMS thread didn't receive data for %0.1f seconds" % time_diff)
-        else:
-            if not received_data:
-                logger.info("First received data")
-                notify(Notification.READY)
-                received_data = True
-            notify(Notification.WATCHDOG)
-
-        logger.debug("run done")
-        await asyncio.sleep(10)
-    await con.bt_bms.disconnect()
-    con.metrics_queue.close()
-    logger.info("Loop ended")
+
+    async def run(self):
+        self.logger.info("Starting %i pack(s)" % len(self.packs))
+        watchdog = asyncio.ensure_future(self.watchdog())
+        await asyncio.gather(*(pack.run() for pack in self.packs))
+        watchdog.cancel()
+        self.logger.info("Loop ended")
+
+    def stop(self):
+        for pack in self.packs:
+            pack.stop()
+
 
 def write_metric(queue):
     # Subprocess
-    metrics_connection = Metrics(database_name=config['influxdb']['database_name'])
+    metrics_connection = get_metrics(config['influxdb'])
     while True:
         try:
             points = queue.get(block=True)
+            if points is None:
+                break
             metrics_connection.write_metric(points=points)
         except KeyboardInterrupt:
             break
+    metrics_connection.stop()
+
+
+capture = CaptureWriter(args.capture) if args.capture else None
+client_factory = None
+if args.replay:
+    mac_addresses = mac_addresses[:1]
+    client_factory = lambda mac_address: ReplayClient(args.replay)
 
 metrics_queue = multiprocessing.Queue()
 p = multiprocessing.Process(target=write_metric, args=(metrics_queue,))
 p.start()
-con = DalyBMSConnection(mac_address=config['bms']['mac_address'], logger=logger,
-                            metrics_queue=metrics_queue)
+monitor = BMSMonitor(logger=logger, metrics_queue=metrics_queue, capture=capture, client_factory=client_factory)
 loop = asyncio.get_event_loop()
-asyncio.ensure_future(main(con))
+task = asyncio.ensure_future(monitor.run())
 try:
-    loop.run_forever()
+    loop.run_until_complete(task)
 except KeyboardInterrupt:
-    pass
+    monitor.stop()
+    loop.run_until_complete(task)
 
-loop.run_until_complete(con.bt_bms.disconnect())
-metrics_queue.close()
+if capture:
+    capture.close()
+metrics_queue.put(None)
+p.join(10)
 p.terminate()
 logger.info("Final End")
@@ -0,0 +1,120 @@
+import os
+
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.lp'
+
+
+class SpillLog:
+    """
+    Append-only log of line protocol segments for points that could not be written.
+    The oldest segments are removed first when the log grows above max_size.
+    """
+
+    def __init__(self, directory, segment_size=1024 * 1024, max_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+        self.segments = sorted(self._segment_number(f) for f in os.listdir(directory)
+                               if f.startswith(SEGMENT_PREFIX) and f.endswith(SEGMENT_SUFFIX))
+        self.sizes = {}
+        for number in self.segments:
+            self.sizes[number] = os.path.getsize(self._path(number))
+        if self.segments:
+            self.current = self.segments[-1]
+        else:
+            self.current = 0
+            self.segments.append(self.current)
+            self.sizes[self.current] = 0
+        self.file = None
+        # byte offset of the next line to replay in the oldest segment
+        self.read_offset = 0
+        self.pending_offset = 0
+
+    @staticmethod
+    def _segment_number(file_name):
+        return int(file_name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+    def _path(self, number):
+        return os.path.join(self.directory, '%s%010i%s' % (SEGMENT_PREFIX, number, SEGMENT_SUFFIX))
+
+    def size(self):
+        return sum(self.sizes.values())
+
+    def is_empty(self):
+        return self.size() - self.read_offset <= 0
+
+    def append(self, lines):
+        data = lines.encode('utf-8')
+        try:
+            if self.file is None:
+                self.file = open(self._path(self.current), 'ab')
+            self.file.write(data)
+            self.file.flush()
+        except OSError as e:
+            print('failed to write to spill log: %s' % e)
+            return False
+        self.sizes[self.current] += len(data)
+
+        if self.sizes[self.current] >= self.segment_size:
+            self._rotate()
+        self._evict()
+        return True
+
+    def _rotate(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+        self.current += 1
+        self.segments.append(self.current)
+        self.sizes[self.current] = 0
+
+    def _remove_oldest(self):
+        number = self.segments.pop(0)
+        del self.sizes[number]
+        self.read_offset = 0
+        self.pending_offset = 0
+        try:
+            os.remove(self._path(number))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while len(self.segments) > 1 and self.size() > self.max_size:
+            print('spill log larger than %i bytes, removing oldest segment' % self.max_size)
+            self._remove_oldest()
+
+    def read_lines(self, max_lines):
+        """
+        Return up to max_lines from the oldest segment, call commit() after they were written
+        """
+        if self.is_empty():
+            return []
+        if self.segments[0] == self.current:
+            # never read the segment that is still appended to
+            self._rotate()
+
+        lines = []
+        with open(self._path(self.segments[0]), 'rb') as f:
+            f.seek(self.read_offset)
+            while len(lines) < max_lines:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    # end of segment or a line cut by a crash
+                    break
+                lines.append(line[:-1].decode('utf-8'))
+            self.pending_offset = f.tell()
+        if not lines:
+            self._remove_oldest()
+        return lines
+
+    def commit(self):
+        self.read_offset = self.pending_offset
+        if self.read_offset >= self.sizes[self.segments[0]]:
+            self._remove_oldest()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,121 @@
+import logging
+import socket
+import threading
+import time
+
+import pytest
+
+from devices.aeconversion_bus import AEConversionBusThread
+from devices.aeconversion_emulator import EmulatedInverter
+
+
+class FakeMetrics:
+    def __init__(self):
+        self.points = []
+
+    def write_metric(self, points):
+        self.points += points
+
+
+class GatewayServer(threading.Thread):
+    """
+    RS485 to Ethernet gateway in transparent mode in front of an emulated inverter,
+    drop() closes the open connection like a restarting gateway
+    """
+
+    def __init__(self, inverter):
+        threading.Thread.__init__(self, daemon=True)
+        self.inverter = inverter
+        self.server = socket.create_server(('127.0.0.1', 0))
+        self.server.settimeout(0.1)
+        self.port = self.server.getsockname()[1]
+        self.conn = None
+        self.connections = 0
+        self.is_running = True
+
+    def run(self):
+        while self.is_running:
+            try:
+                conn, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            self.conn = conn
+            self.connections += 1
+            buffer = b''
+            while True:
+                try:
+                    data = conn.recv(4096)
+                except OSError:
+                    break
+                if not data:
+                    break
+                buffer += data
+                # a \x0d in the arguments is no frame end, the checksum does not match there
+                response = self.inverter.handle_request(buffer) if buffer.endswith(b'\x0d') else None
+                if response:
+                    buffer = b''
+                    conn.sendall(response)
+            conn.close()
+
+    def drop(self):
+        self.conn.shutdown(socket.SHUT_RDWR)
+
+    def stop(self):
+        self.is_running = False
+        self.join(1)
+        self.server.close()
+
+
+@pytest.fixture
+def gateway():
+    gateway = GatewayServer(EmulatedInverter(inverter_id=123, pv_watt=400.0))
+    gateway.start()
+    yield gateway
+    gateway.stop()
+
+
+def get_bus(gateway):
+    return AEConversionBusThread(config={'device': 'tcp://127.0.0.1:%i' % gateway.port, 'inverter_ids': [123]},
+                                 metrics=FakeMetrics(), logger=logging.getLogger('test'))
+
+
+def test_poll(gateway):
+    bus = get_bus(gateway)
+    bus._poll(123)
+    assert bus.inverters[123].device_parameters['type'] == '500-90'
+    bus._poll(123)
+    assert bus.data[123]['ac_watt'] == pytest.approx(380.0, abs=0.01)
+    bus.transport.close()
+
+
+def test_reconnect_after_gateway_restart(gateway):
+    bus = get_bus(gateway)
+    bus._poll(123)
+    gateway.drop()
+    time.sleep(0.1)
+    bus._poll(123)
+    assert not bus.transport.is_open()
+    assert not bus.inverters[123].device_parameters
+    # the next connection attempt after 60 seconds
+    bus._poll(123)
+    assert gateway.connections == 1
+    bus.last_connection_attempt[123] = 0
+    bus._poll(123)
+    assert bus.inverters[123].device_parameters
+    bus._poll(123)
+    assert bus.data[123]['ac_watt'] == pytest.approx(380.0, abs=0.01)
+    assert gateway.connections == 2
+    bus.transport.close()
+
+
+def test_command_reconnects_after_gateway_restart(gateway):
+    bus = get_bus(gateway)
+    bus._poll(123)
+    gateway.drop()
+    time.sleep(0.1)
+    bus.queue_command(123, 'set_limit', {'limit': 100})
+    bus._execute(bus.command_queue.get_nowait())
+    assert not bus.transport.is_open()
+    assert not bus.inverters[123].device_parameters
+    assert len(bus.command_queue) == 1
+    bus.transport.close()
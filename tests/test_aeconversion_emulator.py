@@ -0,0 +1,45 @@
+import pytest
+
+from devices.aeconversion_emulator import EmulatedInverter, PtyInverterEmulator
+from devices.aeconversion_inverter import AEConversionInverter
+
+
+@pytest.fixture
+def emulator():
+    inverter = EmulatedInverter(inverter_id=123, pv_watt=400.0)
+    emulator = PtyInverterEmulator([inverter], response_delay=0)
+    emulator.start()
+    yield emulator
+    emulator.stop()
+    emulator.join(1)
+    emulator.close()
+
+
+def test_get_data(emulator):
+    inverter = AEConversionInverter(device=emulator.port, inverter_id=123, request_retries=1, verbose=False)
+    assert inverter.connect()
+    data = inverter.get_data()
+    assert data['ac_watt'] == pytest.approx(380.0, abs=0.01)
+    assert data['pv_volt'] == pytest.approx(36.0, abs=0.01)
+
+
+@pytest.mark.parametrize('limit', [13, 250])
+def test_set_limit(emulator, limit):
+    # 13 W is sent as 0x000d0000, the request carries the frame end byte in its arguments
+    inverter = AEConversionInverter(device=emulator.port, inverter_id=123, request_retries=1, verbose=False)
+    assert inverter.connect()
+    assert inverter.set_limit(limit) == limit
+    assert emulator.inverters[123].limit == limit
+    assert emulator.get_stats()['invalid'] == 0
+
+
+def test_unknown_inverter_id():
+    emulator = PtyInverterEmulator([EmulatedInverter(inverter_id=123)], response_delay=0)
+    try:
+        emulator.buffer += AEConversionInverter(device=None, inverter_id=7)._calc_request_crc(b'\x03\xed')
+        request = emulator._next_request()
+        assert request is not None
+        emulator._handle(request)
+        assert emulator.get_stats()['invalid'] == 1
+    finally:
+        emulator.close()
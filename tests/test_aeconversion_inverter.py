@@ -0,0 +1,61 @@
+import pytest
+
+from devices import aeconversion_inverter
+from devices.aeconversion_emulator import EmulatedInverter
+from devices.aeconversion_inverter import AEConversionInverter
+from devices.rs485 import LoopbackTransport
+
+
+class Responder:
+    def __init__(self, inverter):
+        self.inverter = inverter
+        self.mute = False
+
+    def __call__(self, request):
+        if self.mute:
+            return None
+        return self.inverter.handle_request(request)
+
+
+@pytest.fixture
+def responder(monkeypatch):
+    # no pause between retries
+    monkeypatch.setattr(aeconversion_inverter.time, 'sleep', lambda seconds: None)
+    return Responder(EmulatedInverter(inverter_id=123, pv_watt=400.0))
+
+
+@pytest.fixture
+def inverter(responder):
+    inverter = AEConversionInverter(device='loopback', inverter_id=123, request_retries=1, verbose=False,
+                                    transport=LoopbackTransport(responder))
+    assert inverter.connect()
+    assert inverter.get_data()
+    return inverter
+
+
+def test_request_energy_sets_limit(inverter, responder):
+    # 380 W produced + 50 W requested + 20 W tolerance
+    assert inverter.request_energy(watt_request=50) == 450
+    assert responder.inverter.limit == 450
+    assert inverter.last_limit_change is not None
+
+
+def test_request_energy_waits_after_limit_change(inverter):
+    inverter.request_energy(watt_request=50)
+    last_limit_change = inverter.last_limit_change
+    assert inverter.request_energy(watt_request=0, set_limit_interval=60) is None
+    assert inverter.last_limit_change == last_limit_change
+
+
+def test_request_energy_in_tolerance(inverter):
+    inverter.request_energy(watt_request=50)
+    inverter.last_limit_change -= 120
+    last_limit_change = inverter.last_limit_change
+    assert inverter.request_energy(watt_request=60) is None
+    assert inverter.last_limit_change == last_limit_change
+
+
+def test_request_energy_failed(inverter, responder):
+    responder.mute = True
+    assert inverter.request_energy(watt_request=50) is False
+    assert inverter.last_limit is None
@@ -0,0 +1,90 @@
+import logging
+import time
+
+from controller.cell_protection import CELL_FRAME, CellProtection
+
+MAC = 'aa:bb:cc:dd:ee:ff'
+
+
+class FakeRelay:
+    def __init__(self, state=True):
+        self.state = state
+        self.writes = 0
+
+    def set_state(self, state):
+        if self.state == state:
+            return False
+        self.state = state
+        self.writes += 1
+        return True
+
+
+def frame(frame_number, *volts):
+    millivolts = [int(round(v * 1000)) for v in volts] + [0] * (3 - len(volts))
+    return CELL_FRAME.pack(frame_number, *millivolts)
+
+
+def check(protection, data):
+    return protection.check_frame(MAC, data, time.perf_counter())
+
+
+def get_protection(relay, **kwargs):
+    return CellProtection(relay=relay, logger=logging.getLogger('test'), max_cells=6, **kwargs)
+
+
+def test_ok_cells_keep_relay():
+    relay = FakeRelay()
+    protection = get_protection(relay)
+    assert check(protection, frame(1, 3.3, 3.3, 3.3)) is None
+    assert relay.state
+    assert not protection.is_active(MAC)
+
+
+def test_low_cell_opens_relay():
+    relay = FakeRelay()
+    trips = []
+    protection = get_protection(relay, on_trip=lambda *args: trips.append(args))
+    latency = check(protection, frame(2, 3.3, 2.8, 3.3))
+    assert latency is not None and latency >= 0
+    assert not relay.state
+    assert protection.is_active(MAC)
+    assert protection.trips == 1
+    assert trips[0][:3] == (MAC, 5, 2.8)
+    # relay already open, no second trip
+    assert check(protection, frame(2, 3.3, 2.8, 3.3)) is None
+    assert relay.writes == 1
+
+
+def test_hysteresis():
+    relay = FakeRelay()
+    protection = get_protection(relay, min_voltage=2.9, hysteresis=0.1)
+    check(protection, frame(1, 2.85, 3.3, 3.3))
+    # above the threshold but below threshold + hysteresis
+    check(protection, frame(1, 2.95, 3.3, 3.3))
+    assert protection.is_active(MAC)
+    # switched on again before the cell recovered
+    relay.state = True
+    assert check(protection, frame(1, 2.95, 3.3, 3.3)) is not None
+    assert not relay.state
+    assert protection.trips == 2
+    check(protection, frame(1, 3.0, 3.3, 3.3))
+    assert not protection.is_active(MAC)
+    relay.state = True
+    assert check(protection, frame(1, 2.95, 3.3, 3.3)) is None
+    assert relay.state
+
+
+def test_cell_thresholds():
+    relay = FakeRelay()
+    protection = get_protection(relay, min_voltage=2.9, cell_min_voltages={'2': 3.1})
+    assert check(protection, frame(1, 3.0, 3.05, 3.3)) is not None
+    assert protection.low_cells[MAC] == {2}
+
+
+def test_unused_slots_ignored():
+    relay = FakeRelay()
+    protection = get_protection(relay)
+    # cells 7 and 8 exceed max_cells, empty slots are 0
+    assert check(protection, frame(3, 3.3, 0.0)) is None
+    assert check(protection, frame(2, 3.3, 3.3, 3.3)) is None
+    assert relay.state
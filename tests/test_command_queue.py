@@ -0,0 +1,107 @@
+import pytest
+
+from devices import command_queue
+from devices.command_queue import CommandQueue
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(command_queue.time, 'time', clock.time)
+    return clock
+
+
+def test_coalesce_same_key(clock):
+    queue = CommandQueue()
+    queue.put('set_limit', (123, 50))
+    queue.put('set_limit', (123, 80))
+    assert len(queue) == 1
+    item = queue.get_nowait()
+    assert item.args == (123, 80)
+    assert queue.get_nowait() is None
+    assert queue.get_stats()['coalesced'] == 1
+
+
+def test_different_keys_not_coalesced(clock):
+    queue = CommandQueue()
+    queue.put('set_limit', (1, 50), key=('set_limit', 1))
+    queue.put('set_limit', (2, 50), key=('set_limit', 2))
+    assert len(queue) == 2
+    assert queue.get_stats()['coalesced'] == 0
+
+
+def test_priority_order(clock):
+    queue = CommandQueue()
+    queue.put('request_energy', (123,))
+    queue.put('set_limit', (123, 50))
+    assert queue.get_nowait().command == 'set_limit'
+    assert queue.get_nowait().command == 'request_energy'
+
+
+def test_unknown_command():
+    with pytest.raises(ValueError):
+        CommandQueue().put('reboot', ())
+
+
+def test_expired_dropped(clock):
+    queue = CommandQueue(max_age=60)
+    queue.put('request_energy', (123,))
+    queue.put('set_limit', (123, 50), max_age=5)
+    clock.now += 10
+    item = queue.get_nowait()
+    assert item.command == 'request_energy'
+    assert queue.get_nowait() is None
+    stats = queue.get_stats()
+    assert stats['expired'] == 1
+    assert stats['depth'] == 0
+
+
+def test_retry_until_max_attempts(clock):
+    queue = CommandQueue(max_attempts=2)
+    queue.put('set_limit', (123, 50))
+    item = queue.get_nowait()
+    assert queue.retry(item)
+    item = queue.get_nowait()
+    assert item.attempts == 2
+    assert not queue.retry(item)
+    assert queue.get_nowait() is None
+    stats = queue.get_stats()
+    assert stats['retried'] == 1
+    assert stats['failed'] == 1
+
+
+def test_retry_after_deadline(clock):
+    queue = CommandQueue(max_age=5)
+    queue.put('set_limit', (123, 50))
+    item = queue.get_nowait()
+    clock.now += 10
+    assert not queue.retry(item)
+    assert queue.get_stats()['failed'] == 1
+
+
+def test_retry_superseded_by_newer(clock):
+    queue = CommandQueue()
+    queue.put('set_limit', (123, 50))
+    item = queue.get_nowait()
+    queue.put('set_limit', (123, 80))
+    assert not queue.retry(item)
+    assert queue.get_nowait().args == (123, 80)
+    assert queue.get_stats()['coalesced'] == 1
+
+
+def test_done_wait_avg(clock):
+    queue = CommandQueue()
+    queue.put('set_limit', (123, 50))
+    clock.now += 2
+    queue.done(queue.get_nowait())
+    stats = queue.get_stats()
+    assert stats['executed'] == 1
+    assert stats['wait_avg'] == pytest.approx(2.0)
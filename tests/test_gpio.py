@@ -0,0 +1,69 @@
+import logging
+import threading
+
+import pytest
+
+from devices.gpio import FakeGpioPin, GpioEdgeMonitor
+
+
+@pytest.fixture
+def pin():
+    pin = FakeGpioPin(pin=17)
+    yield pin
+    pin.close()
+
+
+def read_value_file(pin):
+    with open("%s/value" % pin.pin_dir) as f:
+        return f.read()
+
+
+def test_set_state(pin):
+    assert pin.set_state(True)
+    assert read_value_file(pin) == '1\n'
+    assert pin.get_state() == 1
+    assert not pin.set_state(True)
+    assert pin.writes == 1
+    assert pin.set_state(False)
+    assert read_value_file(pin) == '0\n'
+
+
+def test_cache_expires(pin):
+    pin.set_state(True)
+    # switched by another process
+    pin.set_input(0)
+    assert pin.get_state() == 1
+    pin.max_cache_age = 0
+    assert pin.get_state() == 0
+
+
+def test_wait_for_edge():
+    pin = FakeGpioPin(pin=4, direction="in", edge="both")
+    try:
+        assert pin.wait_for_edge(timeout=0.01) is None
+        pin.set_input(1)
+        assert pin.wait_for_edge(timeout=1) == 1
+        assert pin.wait_for_edge(timeout=0.01) is None
+    finally:
+        pin.close()
+
+
+def test_edge_monitor():
+    pin = FakeGpioPin(pin=4, direction="in", edge="both")
+    edges = []
+    received = threading.Event()
+
+    def callback(number, value):
+        edges.append((number, value))
+        received.set()
+
+    monitor = GpioEdgeMonitor([pin], callback, logging.getLogger('test'), interval=0.05)
+    monitor.start()
+    try:
+        pin.set_input(1)
+        assert received.wait(2)
+        assert edges == [(4, 1)]
+    finally:
+        monitor.stop()
+        monitor.join(1)
+        pin.close()
@@ -0,0 +1,100 @@
+import pytest
+
+from controller.limit_controller import PILimitController, get_limit_controller
+
+
+def settled(limit=320, **kwargs):
+    """
+    Controller that wrote limit at ts 0 and sees the grid at the setpoint
+    """
+    controller = PILimitController(**kwargs)
+    controller.update(0, limit - 20, 0, 800, None)
+    return controller
+
+
+def test_first_update_feed_forward():
+    controller = PILimitController()
+    # 220 W above the setpoint of -20 W, the inverter produces 100 W
+    assert controller.update(0, 200, 100, 500, None) == 320.0
+    state = controller.get_state()
+    assert state['feed_forward']
+    assert state['integrator'] == 320.0
+
+
+def test_load_step_feed_forward():
+    controller = settled()
+    assert controller.update(20, 180, 320, 800, 320) == 520.0
+    assert controller.get_state()['feed_forward']
+
+
+def test_small_deviation_pi():
+    controller = settled()
+    # integrator 320 + 0.02 * 80 W * 10 s, output + 0.2 * 80 W
+    assert controller.update(10, 60, 320, 800, 320) == 352.0
+    state = controller.get_state()
+    assert not state['feed_forward']
+    assert state['integrator'] == pytest.approx(336.0)
+
+
+def test_deadband_not_integrated():
+    controller = settled()
+    assert controller.update(10, -5, 320, 800, 320) is None
+    assert controller.get_state()['integrator'] == 320.0
+
+
+def test_anti_windup():
+    controller = PILimitController()
+    assert controller.update(0, 500, 200, 300, None) == 300.0
+    assert controller.get_state()['saturated']
+    for ts in range(10, 200, 10):
+        controller.update(ts, 60, 300, 300, 300)
+        assert controller.get_state()['integrator'] == 300.0
+    # the load drops, without the clamp the integrator would hold the limit at the maximum
+    assert controller.update(200, -100, 300, 300, 300) == 268.0
+
+
+def test_increase_rate_limited():
+    controller = PILimitController()
+    controller.update(0, 80, 100, 800, 100)
+    assert controller.get_state()['limit'] == 200.0
+    assert controller.update(20, 480, 200, 800, 100) == 350.0
+    assert controller.get_state()['rate_limited']
+
+
+def test_decrease_at_once():
+    controller = settled(600)
+    assert controller.update(20, -420, 600, 800, 600) == 200.0
+    assert not controller.get_state()['rate_limited']
+
+
+def test_min_write_interval():
+    controller = settled()
+    assert controller.update(5, 180, 320, 800, 320) is None
+    assert not controller.get_state()['write']
+    assert controller.update(10, 180, 320, 800, 320) == 520.0
+
+
+def test_min_limit():
+    controller = settled(30)
+    # 20 W below the last limit is inside the deadband, the minimum is written anyway
+    assert controller.update(20, -200, 30, 800, 30) == 10.0
+
+
+def test_reset_after_relay_on():
+    controller = settled()
+    controller.reset()
+    # a small error after the reset jumps to the estimate, no integration over the time off
+    assert controller.update(1000, 30, 0, 800, 100) == 50.0
+    state = controller.get_state()
+    assert state['feed_forward']
+    assert state['integrator'] == 50.0
+
+
+def test_get_limit_controller():
+    assert get_limit_controller({}) is None
+    controller = get_limit_controller({'limit_mode': 'pi', 'watt_tolerance': 30})
+    assert isinstance(controller, PILimitController)
+    assert controller.deadband == 30
+    assert controller.setpoint == -30
+    with pytest.raises(ValueError):
+        get_limit_controller({'limit_mode': 'pid'})
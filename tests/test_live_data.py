@@ -0,0 +1,50 @@
+import pytest
+
+from live_data import LiveDataReader, LiveDataWriter
+
+
+@pytest.fixture
+def live_data(tmp_path):
+    path = str(tmp_path / 'live-data')
+    writer = LiveDataWriter(path=path)
+    reader = LiveDataReader(path=path)
+    yield writer, reader
+    reader.close()
+    writer.close()
+
+
+def test_publish_read(live_data):
+    writer, reader = live_data
+    assert reader.read('meter') == {}
+    writer.publish('meter', {'time': 100.0, 'p_import': 250.5})
+    assert reader.read('meter') == {'time': 100.0, 'p_import': 250.5}
+    assert reader.sequence('meter') == 2
+
+
+def test_publish_packs_lowest_cell(live_data):
+    writer, reader = live_data
+    packs = {
+        'pack-1': (100.0, {'soc_percent': 80.0}, {1: 3.30, 2: 3.31}),
+        'pack-2': (95.0, {'soc_percent': 40.0}, {1: 3.25, 2: 2.85}),
+    }
+    writer.publish_packs(packs, now=100.0)
+    bms = reader.read('bms')
+    assert bms['min_cell_voltage'] == 2.85
+    assert bms['pack_count'] == 2
+    assert bms['soc_percent'] == 40.0
+    assert bms['time'] == 95.0
+    assert bms['cell_2'] == 2.85
+
+
+def test_publish_packs_stale_pack_ignored(live_data):
+    writer, reader = live_data
+    packs = {
+        'pack-1': (100.0, {'soc_percent': 80.0}, {1: 3.30, 2: 3.31}),
+        'pack-2': (30.0, {'soc_percent': 40.0}, {1: 3.25, 2: 2.85}),
+    }
+    writer.publish_packs(packs, now=100.0)
+    bms = reader.read('bms')
+    assert bms['min_cell_voltage'] == 3.30
+    assert bms['pack_count'] == 1
+    writer.publish_packs({'pack-2': packs['pack-2']}, now=100.0)
+    assert reader.read('bms')['pack_count'] == 1
@@ -0,0 +1,89 @@
+import pytest
+import requests
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+
+import metrics
+from metrics import Metrics
+from spill_log import SpillLog
+
+
+class FakeClient:
+    """
+    Raises the queued errors on the next writes, None writes the points
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.errors = []
+        self.written = []
+
+    def get_list_database(self):
+        return [{'name': 'test'}]
+
+    def switch_database(self, database):
+        pass
+
+    def write_points(self, points, **kwargs):
+        error = self.errors.pop(0) if self.errors else None
+        if error:
+            raise error
+        self.written += points
+
+
+@pytest.fixture
+def metric(monkeypatch, tmp_path):
+    monkeypatch.setattr(metrics, 'InfluxDBClient', FakeClient)
+    metric = Metrics(database_name='test', spill_log=SpillLog(str(tmp_path)))
+    yield metric
+    metric.stop()
+
+
+def points():
+    return [{'measurement': 'test', 'tags': {}, 'time': 1.0, 'fields': {'value': 1.0}}]
+
+
+def replay(metric, errors=()):
+    metric.client.errors = [None] + list(errors)
+    # the replay rate allows lines again
+    metric.last_replay -= 10
+    metric.write_metric(points())
+
+
+@pytest.mark.parametrize('error', [requests.exceptions.ConnectionError('refused'),
+                                   InfluxDBServerError('timeout'),
+                                   InfluxDBClientError('too many requests', 429)])
+def test_spill_on_temporary_error(metric, error):
+    metric.client.errors = [error]
+    metric.write_metric(points())
+    assert metric.get_stats()['spilled'] == 1
+    replay(metric)
+    assert metric.get_stats()['replayed'] == 1
+    assert metric.spill_log.is_empty()
+
+
+def test_rejected_not_spilled(metric):
+    metric.client.errors = [InfluxDBClientError('field type conflict', 400)]
+    metric.write_metric(points())
+    stats = metric.get_stats()
+    assert stats['rejected'] == 1
+    assert stats['spilled'] == 0
+    assert metric.spill_log.is_empty()
+
+
+def test_rejected_replay_committed(metric):
+    metric.client.errors = [requests.exceptions.ConnectionError('refused')]
+    metric.write_metric(points())
+    replay(metric, [InfluxDBClientError('field type conflict', 400)])
+    stats = metric.get_stats()
+    assert stats['rejected'] == 1
+    assert stats['replayed'] == 0
+    assert metric.spill_log.is_empty()
+
+
+def test_failed_replay_kept(metric):
+    metric.client.errors = [requests.exceptions.ConnectionError('refused')]
+    metric.write_metric(points())
+    replay(metric, [InfluxDBServerError('timeout')])
+    assert not metric.spill_log.is_empty()
+    replay(metric)
+    assert metric.get_stats()['replayed'] == 1
+    assert metric.spill_log.is_empty()
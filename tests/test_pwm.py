@@ -0,0 +1,62 @@
+import logging
+import os
+
+import pytest
+
+from devices.pwm import FakePWM
+
+LOGGER = logging.getLogger('test')
+
+
+@pytest.fixture
+def pwm():
+    pwm = FakePWM(logger=LOGGER)
+    yield pwm
+    pwm.close()
+
+
+def read_duty_file(pwm):
+    with open(os.path.join(pwm.base_dir, pwm.DUTY_FILE)) as f:
+        return f.read()
+
+
+def test_set_volt(pwm):
+    pwm.set_pwm_volt(1.5)
+    assert read_duty_file(pwm) == '%i\n' % pwm.volt_to_duty(1.5)
+    assert pwm.get_pwm_volt() == pytest.approx(1.5, abs=0.01)
+    # a shorter value does not leave digits of the old one behind
+    pwm.set_pwm_volt(0.0)
+    assert read_duty_file(pwm) == '0\n'
+
+
+def test_unchanged_duty_not_written(pwm):
+    pwm.set_pwm_volt(1.0)
+    pwm.set_pwm_volt(1.0)
+    assert pwm.writes == 1
+
+
+def test_max_voltage(pwm):
+    pwm.set_pwm_volt(5.0)
+    assert pwm.duty == pwm.volt_to_duty(pwm.MAX_VOLTAGE)
+
+
+def test_ramp():
+    pwm = FakePWM(logger=LOGGER, ramp_step=0.5, ramp_interval=0)
+    try:
+        pwm.set_pwm_volt(2.0)
+        assert pwm.writes == 4
+        assert pwm.get_pwm_volt() == pytest.approx(2.0, abs=0.01)
+        pwm.set_pwm_volt(0.0, ramp=False)
+        assert pwm.writes == 5
+    finally:
+        pwm.close()
+
+
+def test_reopen_keeps_duty(tmp_path):
+    pwm = FakePWM(logger=LOGGER, base_dir=str(tmp_path))
+    pwm.set_pwm_volt(1.0)
+    pwm.close()
+    assert tmp_path.exists()
+    pwm = FakePWM(logger=LOGGER, base_dir=str(tmp_path))
+    assert pwm.duty == pwm.volt_to_duty(1.0)
+    pwm.close()
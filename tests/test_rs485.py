@@ -0,0 +1,114 @@
+import socket
+import time
+
+import pytest
+
+from devices.rs485 import FRAME_END, FrameReader, LoopbackTransport, TcpTransport, calc_crc, get_transport
+
+
+def response_frame(payload):
+    return b'\x21' + payload + bytes([calc_crc(payload)]) + bytes([FRAME_END])
+
+
+class ChunkTransport:
+    """
+    Returns the queued bytes in chunks of the given sizes, 0 when nothing is left
+    """
+
+    def __init__(self, data, chunks):
+        self.data = bytearray(data)
+        self.chunks = list(chunks)
+
+    def read_into(self, view):
+        size = self.chunks.pop(0) if self.chunks else len(self.data)
+        n = min(size, len(view), len(self.data))
+        view[:n] = self.data[:n]
+        del self.data[:n]
+        return n
+
+
+def test_calc_crc():
+    assert calc_crc(b'') == 0
+    assert calc_crc(b'\x27\x10') == 0x37
+    payload = bytes(range(40))
+    assert calc_crc(payload + bytes([calc_crc(payload)])) == 0
+
+
+def test_read_frame_round_trip():
+    payload = b'\x27\x11' + bytes(range(32))
+    frame = response_frame(payload)
+    transport = LoopbackTransport(lambda request: frame)
+    transport.write(b'request')
+    data, error = FrameReader().read_frame(transport)
+    assert error is None
+    assert data == frame[:-1]
+
+
+def test_read_frame_with_frame_end_in_payload():
+    payload = b'\x27\x11\x00\x0d\x01\x0d\x02'
+    frame = response_frame(payload)
+    data, error = FrameReader().read_frame(ChunkTransport(frame, [3, 2, 1, 4]))
+    assert error is None
+    assert data == frame[:-1]
+
+
+def test_read_frame_split_into_single_bytes():
+    frame = response_frame(b'\x27\x16' + bytes(range(70)))
+    data, error = FrameReader().read_frame(ChunkTransport(frame, [1] * len(frame)))
+    assert error is None
+    assert data == frame[:-1]
+
+
+def test_read_frame_wrong_checksum():
+    frame = bytearray(response_frame(b'\x27\x10\x01\x02'))
+    frame[-2] ^= 0xff
+    data, error = FrameReader().read_frame(ChunkTransport(frame, []), timeout=0.1)
+    assert data is False
+    assert error == 'crc'
+
+
+def test_read_frame_incomplete():
+    frame = response_frame(b'\x27\x10\x01\x02')
+    data, error = FrameReader().read_frame(ChunkTransport(frame[:3], []))
+    assert data is False
+    assert error == 'incomplete'
+
+
+def test_read_frame_overflow():
+    data, error = FrameReader(size=16).read_frame(ChunkTransport(b'\x21' + bytes(40), []))
+    assert data is False
+    assert error == 'overflow'
+
+
+@pytest.fixture
+def server():
+    server = socket.create_server(('127.0.0.1', 0))
+    server.settimeout(1)
+    yield server
+    server.close()
+
+
+@pytest.mark.parametrize('method', ['read_into', 'reset_input_buffer'])
+def test_tcp_transport_reconnects_after_close(server, method):
+    transport = get_transport('tcp://127.0.0.1:%i' % server.getsockname()[1])
+    assert isinstance(transport, TcpTransport)
+    transport.open()
+    conn, _ = server.accept()
+    # the gateway restarts
+    conn.close()
+    time.sleep(0.1)
+    with pytest.raises(ConnectionResetError):
+        if method == 'read_into':
+            transport.read_into(memoryview(bytearray(16)))
+        else:
+            transport.reset_input_buffer()
+    assert not transport.is_open()
+
+    transport.open()
+    conn, _ = server.accept()
+    conn.sendall(b'\x21\x27')
+    buffer = bytearray(16)
+    assert transport.read_into(memoryview(buffer)) == 2
+    assert buffer[:2] == b'\x21\x27'
+    conn.close()
+    transport.close()
@@ -0,0 +1,50 @@
+import json
+import logging
+import os
+
+import pytest
+
+from devices.sma_energy_manager import SMAEnergyManager, SpeedwireParser
+
+FRAMES_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks',
+                           'golden_frames.json')
+
+
+@pytest.fixture
+def datagram():
+    with open(FRAMES_FILE) as f:
+        return bytearray.fromhex(json.load(f)['speedwire'])
+
+
+def test_parse_matches_block_bytes(datagram):
+    em = SMAEnergyManager(logger=logging.getLogger('test'))
+    expected = em.parse_block_bytes(bytes(datagram[32:156]), counter=True)
+    parser = SpeedwireParser(phases=True, counter=True)
+    for _ in range(2):
+        # walked, then decoded with the cached layout
+        serial_number, data = parser.parse(memoryview(datagram), len(datagram))
+        assert serial_number == 3002851234
+        for key, value in expected.items():
+            assert data['sum'][key] == pytest.approx(value)
+        assert set(data) == {'sum', 'L1', 'L2', 'L3'}
+    assert len(parser.layouts) == 1
+
+
+def test_selected_channels(datagram):
+    parser = SpeedwireParser(channels=('p_import', 'p_export'))
+    for _ in range(2):
+        assert parser.parse(memoryview(datagram), len(datagram))[1] == {'sum': {'p_import': 440.2, 'p_export': 386.3}}
+
+
+def test_changed_layout_same_length(datagram):
+    parser = SpeedwireParser(phases=True, counter=True)
+    parser.parse(memoryview(datagram), len(datagram))
+    # swap the first two OBIS entries, the length stays the same
+    changed = bytearray(datagram)
+    changed[32:52] = datagram[40:52] + datagram[32:40]
+    expected = SpeedwireParser(phases=True, counter=True).walk(memoryview(changed), len(changed))
+    assert parser.parse(memoryview(changed), len(changed)) == expected
+
+
+def test_not_speedwire():
+    assert SpeedwireParser().parse(memoryview(bytearray(64)), 64) == (None, None)
@@ -0,0 +1,27 @@
+import pytest
+
+from devices.snapshot import InverterSnapshot, MeterSnapshot
+
+
+def test_fields():
+    snapshot = MeterSnapshot(1, 100.0, {'p_import': 250.0, 'p_export': 0.0, 'unknown': 1})
+    assert snapshot['p_import'] == 250.0
+    assert snapshot['time'] == 100.0
+    assert 'q_import' in snapshot
+    assert snapshot.get('q_import', 5) == 5
+    with pytest.raises(KeyError):
+        snapshot['unknown']
+    assert snapshot.to_point('meter', {})['fields'] == {'p_import': 250.0, 'p_export': 0.0}
+
+
+def test_immutable():
+    snapshot = InverterSnapshot(1, 100.0, {'ac_watt': 100.0})
+    with pytest.raises(AttributeError):
+        snapshot.ac_watt = 200.0
+    with pytest.raises(AttributeError):
+        snapshot.time = 200.0
+    with pytest.raises(AttributeError):
+        del snapshot.ac_watt
+    with pytest.raises(AttributeError):
+        snapshot.extra = 1
+    assert snapshot['ac_watt'] == 100.0
@@ -0,0 +1,79 @@
+import pytest
+
+from metrics import WindowAggregator
+
+TAGS = {'device': 'sma'}
+
+
+def feed(aggregator, samples):
+    points = []
+    for ts, values in samples:
+        points += aggregator.add(ts, values)
+    return points + aggregator.flush()
+
+
+def energy(points, measurement):
+    return sum(p['fields'].get('p_import_wh', 0.0) for p in points if p['measurement'] == measurement)
+
+
+def test_constant_power_one_hour():
+    aggregator = WindowAggregator('grid', TAGS, integrate=('p_import',))
+    points = feed(aggregator, [(ts, {'p_import': 100.0}) for ts in range(0, 3601)])
+    assert energy(points, 'grid') == pytest.approx(100.0)
+    assert energy(points, 'grid_900s') == pytest.approx(100.0)
+    assert len([p for p in points if p['measurement'] == 'grid']) == 61
+    assert len([p for p in points if p['measurement'] == 'grid_900s']) == 5
+
+
+def test_segment_split_at_window_boundary():
+    aggregator = WindowAggregator('grid', TAGS, tiers=(60,), integrate=('p_import',), max_gap=60)
+    # ramp from 0 W to 720 W over 40 s, 10 s of it in the first window
+    points = feed(aggregator, [(50, {'p_import': 0.0}), (90, {'p_import': 720.0})])
+    assert [p['time'] for p in points] == [0, 60]
+    # 10 s from 0 to 180 W, 30 s from 180 to 720 W
+    assert points[0]['fields']['p_import_wh'] == pytest.approx(0.25)
+    assert points[1]['fields']['p_import_wh'] == pytest.approx(3.75)
+    assert sum(p['fields']['p_import_wh'] for p in points) == pytest.approx(720 * 40 / 7200)
+
+
+def test_irregular_samples_conserve_energy():
+    aggregator = WindowAggregator('grid', TAGS, tiers=(60, 900), integrate=('p_import',), max_gap=30)
+    samples = []
+    ts = 0.0
+    for i in range(400):
+        samples.append((ts, {'p_import': float(i % 7) * 50}))
+        ts += 1.5 + (i % 5) * 2.3
+    points = feed(aggregator, samples)
+    expected = sum((a[1]['p_import'] + b[1]['p_import']) * (b[0] - a[0]) / 7200 for a, b in zip(samples, samples[1:]))
+    assert energy(points, 'grid') == pytest.approx(expected)
+    assert energy(points, 'grid_900s') == pytest.approx(expected)
+
+
+def test_min_max_mean():
+    aggregator = WindowAggregator('grid', TAGS, tiers=(60,))
+    points = feed(aggregator, [(0, {'u': 230.0}), (10, {'u': 228.0}), (20, {'u': 235.0}), (60, {'u': 231.0})])
+    fields = points[0]['fields']
+    assert fields['samples'] == 3
+    assert fields['u'] == pytest.approx(231.0)
+    assert fields['u_min'] == 228.0
+    assert fields['u_max'] == 235.0
+    assert points[0]['tags'] == TAGS
+    assert points[1]['fields']['samples'] == 1
+
+
+def test_gap_not_integrated():
+    aggregator = WindowAggregator('grid', TAGS, tiers=(60,), integrate=('p_import',), max_gap=10)
+    points = feed(aggregator, [(0, {'p_import': 100.0}), (5, {'p_import': 100.0}), (30, {'p_import': 100.0}),
+                               (35, {'p_import': 100.0})])
+    assert points[0]['fields']['p_import_wh'] == pytest.approx(100 * 10 / 3600)
+
+
+def test_flush_resets():
+    aggregator = WindowAggregator('grid', TAGS, tiers=(60,), integrate=('p_import',))
+    aggregator.add(0, {'p_import': 100.0})
+    aggregator.add(1, {'p_import': 100.0})
+    assert len(aggregator.flush()) == 1
+    assert aggregator.flush() == []
+    # no integral over the time before the flush
+    aggregator.add(2, {'p_import': 100.0})
+    assert 'p_import_wh' not in aggregator.flush()[0]['fields']